@@ -23,7 +23,7 @@
 from r2.lib.utils import tup
 
 
-__all__ = ["MessageQueue", "declare_queues"]
+__all__ = ["MessageQueue", "declare_queues", "shard_queue_name"]
 
 
 class Queues(dict):
@@ -47,19 +47,49 @@ class Queues(dict):
                 queue._bind(name)
         self.update(queues)
 
+    def shard(self, name, num_shards):
+        """Split a queue into num_shards queues, each bound to itself.
+
+        The shards are named after the queue: vote_link_q is split into
+        vote_link_0_q, vote_link_1_q and so on. The original queue is left
+        declared so that anything already in it still gets consumed.
+
+        """
+        queue = self[name]
+        queue.shard_names = [shard_queue_name(name, i)
+                             for i in xrange(num_shards)]
+        self.declare({shard_name: MessageQueue(bind_to_self=True,
+                                               consumer=queue.consumer,
+                                               consumer_takes_queue=True)
+                      for shard_name in queue.shard_names})
+
+
+def shard_queue_name(name, shard):
+    base = name[:-len("_q")] if name.endswith("_q") else name
+    return "%s_%d_q" % (base, shard)
+
 
 class MessageQueue(object):
     """A representation of an AMQP message queue.
 
     This class is solely intended for use with the Queues class above.
 
+    consumer is the "module:function" that processes the queue, for the
+    queue supervisor (r2.lib.queue_supervisor) to run. It's called with the
+    name of the queue to consume if consumer_takes_queue is set, which is
+    required for a queue to be sharded.
+
     """
     def __init__(self, durable=True, exclusive=False,
-                 auto_delete=False, bind_to_self=False):
+                 auto_delete=False, bind_to_self=False,
+                 consumer=None, consumer_takes_queue=False):
         self.durable = durable
         self.exclusive = exclusive
         self.auto_delete = auto_delete
         self.bind_to_self = bind_to_self
+        self.consumer = consumer
+        self.consumer_takes_queue = consumer_takes_queue
+        self.shard_names = []
 
     def _bind(self, routing_key):
         self.bindings.add((self.name, routing_key))
@@ -73,30 +103,51 @@ class MessageQueue(object):
 
 def declare_queues(g):
     queues = Queues({
-        "scraper_q": MessageQueue(),
-        "newcomments_q": MessageQueue(),
-        "commentstree_q": MessageQueue(bind_to_self=True),
-        "commentstree_fastlane_q": MessageQueue(bind_to_self=True),
-        "vote_link_q": MessageQueue(bind_to_self=True),
-        "vote_comment_q": MessageQueue(bind_to_self=True),
-        "vote_fastlane_q": MessageQueue(bind_to_self=True),
+        "scraper_q": MessageQueue(consumer="r2.lib.media:run"),
+        "newcomments_q": MessageQueue(
+            consumer="r2.lib.db.queries:run_new_comments"),
+        "commentstree_q": MessageQueue(
+            bind_to_self=True,
+            consumer="r2.lib.db.queries:run_commentstree",
+            consumer_takes_queue=True),
+        "commentstree_fastlane_q": MessageQueue(
+            bind_to_self=True,
+            consumer="r2.lib.db.queries:run_commentstree",
+            consumer_takes_queue=True),
+        "vote_link_q": MessageQueue(
+            bind_to_self=True,
+            consumer="r2.lib.db.queries:process_votes",
+            consumer_takes_queue=True),
+        "vote_comment_q": MessageQueue(
+            bind_to_self=True,
+            consumer="r2.lib.db.queries:process_votes",
+            consumer_takes_queue=True),
+        "vote_fastlane_q": MessageQueue(
+            bind_to_self=True,
+            consumer="r2.lib.db.queries:process_votes",
+            consumer_takes_queue=True),
         "log_q": MessageQueue(bind_to_self=True),
-        "cloudsearch_changes": MessageQueue(bind_to_self=True),
-        "update_promos_q": MessageQueue(bind_to_self=True),
-        "butler_q": MessageQueue(),
+        "cloudsearch_changes": MessageQueue(
+            bind_to_self=True,
+            consumer="r2.lib.cloudsearch:run_changed"),
+        "update_promos_q": MessageQueue(
+            bind_to_self=True,
+            consumer="r2.lib.promote:run_changed"),
+        "butler_q": MessageQueue(consumer="r2.lib.butler:run"),
     })
 
+    queue_shards = dict(g.queue_shards)
     if g.shard_link_vote_queues:
-        sharded_vote_queues = {"vote_link_%d_q" % i :
-                               MessageQueue(bind_to_self=True)
-                               for i in xrange(10)}
-        queues.declare(sharded_vote_queues)
-
+        queue_shards.setdefault("vote_link_q", 10)
     if g.shard_commentstree_queues:
-        sharded_commentstree_queues = {"commentstree_%d_q" % i :
-                                       MessageQueue(bind_to_self=True)
-                                       for i in xrange(10)}
-        queues.declare(sharded_commentstree_queues)
+        queue_shards.setdefault("commentstree_q", 10)
+
+    for name, num_shards in queue_shards.iteritems():
+        if num_shards <= 1:
+            continue
+        if not queues[name].consumer_takes_queue:
+            raise ValueError("queue %s can't be sharded" % name)
+        queues.shard(name, num_shards)
 
     queues.cloudsearch_changes << "search_changes"
     queues.scraper_q << "new_link"
@@ -56,6 +56,7 @@ from r2.lib.errors import (
     reddit_http_error,
 )
 from r2.lib.filters import _force_utf8, _force_unicode
+from r2.lib.gzipper import PRECOMPRESS_ENVIRON_KEY, PRECOMPRESSED_ENVIRON_KEY
 from r2.lib.strings import strings
 from r2.lib.template_helpers import add_sr, JSPreload
 from r2.lib.tracking import encrypt, decrypt
@@ -135,6 +136,10 @@ def pagecache_policy(policy):
 
 
 cache_affecting_cookies = ('over18', '_options')
+# part of request_key. bump it when what's stored in the pagecache changes
+# shape, so that old and new app servers running side by side during a
+# deploy don't read each other's entries.
+PAGECACHE_VERSION = 2
 
 class Cookies(dict):
     def add(self, name, value, *k, **kw):
@@ -713,7 +718,7 @@ class MinimalController(BaseController):
         except CookieError:
             cookies_key = ''
 
-        return make_key('request',
+        return make_key('request.v%d' % PAGECACHE_VERSION,
                         c.lang,
                         c.content_langs,
                         request.host,
@@ -795,7 +800,11 @@ class MinimalController(BaseController):
                 return
 
             if r:
-                r, c.cookies = r
+                # the response and cookies, plus a gzipped copy of the body
+                # (if there is one) for the gzip middleware to send.
+                r, c.cookies, precompressed = r
+                if precompressed:
+                    request.environ[PRECOMPRESSED_ENVIRON_KEY] = precompressed
                 response.headers = r.headers
                 response.body = r.body
                 response.status_int = r.status_int
@@ -838,9 +847,19 @@ class MinimalController(BaseController):
             and response.status_int not in (304, 429)
             and not response.status.startswith("5")
             and not c.is_exception_response):
+            # compress the body once now rather than on every hit
+            precompress = request.environ.get(PRECOMPRESS_ENVIRON_KEY)
+            precompressed = None
+            if precompress:
+                precompressed = precompress(response.headerlist,
+                                            response.body)
+                if precompressed:
+                    request.environ[PRECOMPRESSED_ENVIRON_KEY] = precompressed
+
             try:
                 g.pagecache.set(self.request_key(),
-                                (response._current_obj(), c.cookies),
+                                (response._current_obj(), c.cookies,
+                                 precompressed),
                                 g.page_cache_time)
             except MemcachedError as e:
                 # this codepath will actually never be hit as long as
@@ -27,8 +27,10 @@ import os
 import sys
 import time
 import errno
+import signal
 import socket
 import itertools
+import zlib
 import cPickle as pickle
 
 from amqplib import client_0_8 as amqp
@@ -196,6 +198,69 @@ def add_item(routing_key, body, message_id=None,
 def add_kw(routing_key, **kw):
     add_item(routing_key, pickle.dumps(kw))
 
+def shard_for(key, num_shards):
+    """Pick a shard in [0, num_shards) for key.
+
+    This is a jump consistent hash (Lamping & Veach), so the same key always
+    lands on the same shard, and changing the number of shards only moves
+    the keys that have to move.
+
+    """
+    h = zlib.crc32(str(key)) & 0xffffffff
+    b, j = -1, 0
+    while j < num_shards:
+        b = j
+        h = (h * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((h >> 33) + 1)))
+    return b
+
+def shard_queue(queue, key):
+    """The queue to put an item for key in: a shard of queue, if it has any.
+
+    Everything for the same key goes to the same shard so it's processed in
+    the order it was added.
+
+    """
+    shard_names = queues[queue].shard_names
+    if not shard_names:
+        return queue
+    return shard_names[shard_for(key, len(shard_names))]
+
+def queue_length(queue):
+    """The number of messages waiting in queue."""
+    chan = connection_manager.get_channel()
+    name, message_count, consumer_count = chan.queue_declare(queue=queue,
+                                                             passive=True)
+    return message_count
+
+
+class ShutdownRequested(Exception):
+    pass
+
+
+class _StopSignal(object):
+    """Lets SIGTERM stop a consumer between messages instead of during one.
+
+    With interrupt_idle set, a consumer that's waiting for a message is
+    stopped right away by raising ShutdownRequested. Otherwise the consumer
+    is expected to check requested itself.
+
+    """
+    def __init__(self, interrupt_idle):
+        self.interrupt_idle = interrupt_idle
+        self.requested = False
+        self.busy = False
+        try:
+            signal.signal(signal.SIGTERM, self)
+        except ValueError:
+            # signals can only be handled in the main thread
+            pass
+
+    def __call__(self, signum, frame):
+        self.requested = True
+        if self.interrupt_idle and not self.busy:
+            raise ShutdownRequested()
+
 def consume_items(queue, callback, verbose=True):
     """A lighter-weight version of handle_items that uses AMQP's
        basic.consume instead of basic.get. Callback is only passed a
@@ -218,7 +283,10 @@ def consume_items(queue, callback, verbose=True):
         a_global=False
     )
 
+    stop = _StopSignal(interrupt_idle=True)
+
     def _callback(msg):
+        stop.busy = True
         if verbose:
             count_str = ''
             if 'message_count' in msg.delivery_info:
@@ -234,6 +302,9 @@ def consume_items(queue, callback, verbose=True):
         ret = callback(msg)
         msg.channel.basic_ack(msg.delivery_tag)
         sys.stdout.flush()
+        stop.busy = False
+        if stop.requested:
+            raise ShutdownRequested()
         return ret
 
     chan.basic_consume(queue=queue, callback=_callback)
@@ -242,9 +313,12 @@ def consume_items(queue, callback, verbose=True):
         while chan.callbacks:
             try:
                 chan.wait()
-            except KeyboardInterrupt:
+            except (KeyboardInterrupt, ShutdownRequested):
                 break
     finally:
+        # let the caller clean up without being interrupted by another
+        # SIGTERM
+        stop.interrupt_idle = False
         worker.join()
         if chan.is_open:
             chan.close()
@@ -260,10 +334,11 @@ def handle_items(queue, callback, ack=True, limit=1, min_size=0,
 
     chan = connection_manager.get_channel()
     countdown = None
+    stop = _StopSignal(interrupt_idle=False)
 
     while True:
         # NB: None != 0, so we don't need an "is not None" check here
-        if countdown == 0:
+        if countdown == 0 or stop.requested:
             break
 
         msg = chan.basic_get(queue)
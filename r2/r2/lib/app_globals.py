@@ -43,6 +43,7 @@ import pytz
 
 from r2.config import queues
 from r2.lib.cache import (
+    BoundedLocalCache,
     CacheChain,
     CassandraCache,
     CassandraCacheChain,
@@ -53,10 +54,14 @@ from r2.lib.cache import (
     HardcacheChain,
     LocalCache,
     MemcacheChain,
-    SelfEmptyingCache,
+    ProcessCache,
     StaleCacheChain,
 )
 from r2.lib.configparse import ConfigValue, ConfigValueParser
+from r2.lib.invalidation import (
+    AmqpInvalidationChannel,
+    LocalInvalidationChannel,
+)
 from r2.lib.contrib import ipaddress
 from r2.lib.lock import make_lock_factory
 from r2.lib.manager import db_manager
@@ -141,6 +146,9 @@ class Globals(object):
             'min_membership_create_community',
             'bcrypt_work_factor',
             'cassandra_pool_size',
+            'cassandra_column_fetch_fanout',
+            'prefetch_threads',
+            'vote_batch_size',
             'sr_banned_quota',
             'sr_wikibanned_quota',
             'sr_wikicontributor_quota',
@@ -152,8 +160,12 @@ class Globals(object):
             'wiki_max_page_length_bytes',
             'wiki_max_page_name_length',
             'wiki_max_page_separators',
+            'processcache_time',
             'min_promote_future',
             'max_promote_future',
+            'queue_backlog_per_worker',
+            'queue_supervisor_interval',
+            'queue_drain_timeout',
         ],
 
         ConfigValue.float: [
@@ -161,6 +173,7 @@ class Globals(object):
             'max_promote_bid',
             'statsd_sample_rate',
             'querycache_prune_chance',
+            'querycache_batch_window',
         ],
 
         ConfigValue.bool: [
@@ -187,6 +200,9 @@ class Globals(object):
             'shard_link_vote_queues',
             'shard_commentstree_queues',
             'subreddit_stylesheets_static',
+            'sgm_leases',
+            'querycache_packed_writes',
+            'concurrent_prefetch',
         ],
 
         ConfigValue.tuple: [
@@ -211,10 +227,14 @@ class Globals(object):
             'TRAFFIC_LOG_HOSTS',
             'exempt_login_user_agents',
             'timed_templates',
+            'processcache_prefixes',
         ],
 
         ConfigValue.dict(ConfigValue.str, ConfigValue.int): [
             'agents',
+            'queue_shards',
+            'queue_min_workers',
+            'queue_max_workers',
         ],
 
         ConfigValue.str: [
@@ -223,6 +243,10 @@ class Globals(object):
             'wiki_page_user_agreement',
             'wiki_page_gold_bottlecaps',
             'adserver_click_domain',
+            'processcache_invalidation',
+            'search_backend',
+            'search_index_dir',
+            'subreddit_autocomplete_path',
         ],
 
         ConfigValue.choice: {
@@ -571,17 +595,39 @@ class Globals(object):
         # to cache_chains (closed around by reset_caches) so that they
         # can properly reset their local components
         cache_chains = {}
-        localcache_cls = (SelfEmptyingCache if self.running_as_script
+        # scripts and queue consumers are long-lived, so bound their local
+        # caches rather than letting them grow forever
+        localcache_cls = (BoundedLocalCache if self.running_as_script
                           else LocalCache)
 
+        # the process cache survives between requests and sits in front of
+        # memcache for hot objects (see processcache_prefixes in the ini)
+        if self.processcache_prefixes:
+            if self.processcache_invalidation == "amqp":
+                channel = AmqpInvalidationChannel()
+            else:
+                channel = LocalInvalidationChannel()
+            self.process_cache = ProcessCache(
+                self.processcache_prefixes,
+                time=self.processcache_time,
+                channel=channel,
+            )
+        else:
+            self.process_cache = None
+
+        localcache = localcache_cls()
         if stalecaches:
             self.cache = StaleCacheChain(
-                localcache_cls(),
+                localcache,
                 stalecaches,
                 self.memcache,
+                processcache=self.process_cache,
             )
+        elif self.process_cache:
+            self.cache = MemcacheChain(
+                (localcache, self.process_cache, self.memcache))
         else:
-            self.cache = MemcacheChain((localcache_cls(), self.memcache))
+            self.cache = MemcacheChain((localcache, self.memcache))
         cache_chains.update(cache=self.cache)
 
         if stalecaches:
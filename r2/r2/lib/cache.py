@@ -20,10 +20,14 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-from threading import local
+from threading import local, RLock
 from hashlib import md5
+from collections import OrderedDict
 import cPickle as pickle
 from copy import copy
+import os
+import sys
+import time as time_module
 
 import pylibmc
 from _pylibmc import MemcachedError
@@ -300,6 +304,296 @@ class LocalCache(dict, CacheUtils):
     def __repr__(self):
         return "<LocalCache(%d)>" % (len(self),)
 
+# memcache treats expiry times longer than this as absolute unix timestamps
+MAX_RELATIVE_TIME = 60 * 60 * 24 * 30
+
+
+class BoundedLocalCache(LocalCache):
+    """A LocalCache with a bound on its size and support for expiry.
+
+    Entries are evicted least-recently-used first once there are more than
+    `max_items` of them or their estimated size exceeds `max_bytes`, and
+    expire after the `time` they were set with (using memcache's semantics
+    for `time`). Hits, misses, evictions and expirations are counted so
+    they can be reported.
+
+    Sizes are estimates: the length of string values and the shallow
+    `sys.getsizeof` of anything else, plus the key.
+
+    """
+
+    max_items = 10 * 1000
+    max_bytes = 64 * 1024 * 1024
+
+    def __init__(self, max_items=None, max_bytes=None):
+        LocalCache.__init__(self)
+        if max_items is not None:
+            self.max_items = max_items
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._lock = RLock()
+        # key -> (expiry timestamp or None, estimated size), in LRU order
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _sizeof(key, val):
+        if isinstance(val, str):
+            return len(key) + len(val)
+        return len(key) + sys.getsizeof(val)
+
+    @staticmethod
+    def _expiry(time):
+        if not time:
+            return None
+        elif time > MAX_RELATIVE_TIME:
+            return time
+        return time_module.time() + time
+
+    def _live(self, key):
+        """Whether key is present and unexpired. Expired keys are removed.
+        Must be called with the lock held."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+
+        expiry = entry[0]
+        if expiry is not None and expiry <= time_module.time():
+            self._remove(key)
+            self.expirations += 1
+            return False
+        return True
+
+    def _touch(self, key):
+        entry = self._entries.pop(key)
+        self._entries[key] = entry
+
+    def _remove(self, key):
+        expiry, size = self._entries.pop(key)
+        self.bytes -= size
+        dict.__delitem__(self, key)
+
+    def _store(self, key, val, expiry):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            size = self._sizeof(key, val)
+            dict.__setitem__(self, key, val)
+            self._entries[key] = (expiry, size)
+            self.bytes += size
+
+            while self._entries and (len(self._entries) > self.max_items or
+                                     self.bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _lookup(self, key):
+        """Returns (found, value), counting the hit or miss."""
+        with self._lock:
+            if self._live(key):
+                self._touch(key)
+                self.hits += 1
+                return True, dict.__getitem__(self, key)
+            self.misses += 1
+            return False, None
+
+    # the dict interface, used directly by StaleCacheChain and friends
+    def __contains__(self, key):
+        with self._lock:
+            return self._live(key)
+
+    has_key = __contains__
+
+    def __getitem__(self, key):
+        found, val = self._lookup(key)
+        if not found:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self, key, val):
+        # plain assignment (including incr/append and friends) keeps
+        # whatever expiry the key already had
+        with self._lock:
+            entry = self._entries.get(key)
+            self._store(key, val, entry[0] if entry else None)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._entries:
+                raise KeyError(key)
+            self._remove(key)
+
+    def update(self, *a, **kw):
+        for k, v in dict(*a, **kw).iteritems():
+            self[k] = v
+
+    def setdefault(self, key, val):
+        with self._lock:
+            if self._live(key):
+                return dict.__getitem__(self, key)
+            self[key] = val
+            return val
+
+    def pop(self, key, *default):
+        with self._lock:
+            if self._live(key):
+                val = dict.__getitem__(self, key)
+                self._remove(key)
+                return val
+            if default:
+                return default[0]
+            raise KeyError(key)
+
+    def clear(self):
+        with self._lock:
+            dict.clear(self)
+            self._entries.clear()
+            self.bytes = 0
+
+    # the cache interface
+    def get(self, key, default=None):
+        found, val = self._lookup(key)
+        if not found or val is None:
+            return default
+        return val
+
+    def simple_get_multi(self, keys):
+        out = {}
+        for k in keys:
+            found, val = self._lookup(k)
+            if found:
+                out[k] = val
+        return out
+
+    def set(self, key, val, time=0):
+        self._check_key(key)
+        self._store(key, val, self._expiry(time))
+
+    def add(self, key, val, time=0):
+        self._check_key(key)
+        with self._lock:
+            if self._live(key):
+                return False
+            self._store(key, val, self._expiry(time))
+            return True
+
+    def __repr__(self):
+        return "<%s(%d items, %d bytes, %d hits, %d misses, %d evictions)>" % (
+            self.__class__.__name__, len(self), self.bytes, self.hits,
+            self.misses, self.evictions)
+
+
+class ProcessCache(CacheUtils):
+    """A cache tier shared by every request in this process.
+
+    Unlike the LocalCache at the head of a chain it isn't thrown away by
+    `reset`, so hot objects can be served without a trip to memcache on
+    every request. Only keys starting with one of `prefixes` are kept, and
+    only for `time` seconds. Values are stored pickled so that requests
+    each get their own copy to mutate.
+
+    Writes made by other processes are learned about through `channel`
+    (see r2.lib.invalidation) which is subscribed to lazily, once per
+    process, so that forked workers each get their own subscription.
+
+    """
+
+    def __init__(self, prefixes, time=30, channel=None, max_items=None,
+                 max_bytes=None):
+        self.prefixes = tuple(prefixes)
+        self.time = time
+        self.channel = channel
+        self.cache = BoundedLocalCache(max_items=max_items,
+                                       max_bytes=max_bytes)
+        self._subscribed_pid = None
+
+    def _wanted(self, key):
+        return key.startswith(self.prefixes)
+
+    def _maybe_subscribe(self):
+        pid = os.getpid()
+        if self.channel and self._subscribed_pid != pid:
+            self._subscribed_pid = pid
+            # anything we have may have been changed while we weren't
+            # listening
+            self.cache.clear()
+            self.channel.subscribe(self.invalidate)
+
+    def get(self, key, default=None):
+        self._maybe_subscribe()
+        if not self._wanted(key):
+            return default
+        pickled = self.cache.get(key)
+        if pickled is None:
+            return default
+        return pickle.loads(pickled)
+
+    def simple_get_multi(self, keys):
+        self._maybe_subscribe()
+        wanted = [key for key in keys if self._wanted(key)]
+        return dict((key, pickle.loads(pickled))
+                    for key, pickled
+                    in self.cache.simple_get_multi(wanted).iteritems())
+
+    def set(self, key, val, time=0):
+        self._maybe_subscribe()
+        if self._wanted(key):
+            time = min(time, self.time) if time else self.time
+            self.cache.set(key, pickle.dumps(val, pickle.HIGHEST_PROTOCOL),
+                           time=time)
+
+    def set_multi(self, keys, prefix='', time=0):
+        for k, v in keys.iteritems():
+            self.set(prefix + str(k), v, time=time)
+
+    def delete(self, key, time=0):
+        self.cache.delete(key)
+
+    def delete_multi(self, keys, prefix=''):
+        self.cache.delete_multi([prefix + str(key) for key in keys])
+
+    def invalidate(self, keys):
+        """Drop keys that have been written elsewhere. A `keys` of None
+        means we can't be sure what's changed, so everything goes."""
+        if keys is None:
+            self.cache.clear()
+        else:
+            self.cache.delete_multi(keys)
+
+    def publish_invalidation(self, keys):
+        """Tell the other processes that keys have been written."""
+        keys = [key for key in keys if self._wanted(key)]
+        if keys and self.channel:
+            self.channel.publish(keys)
+
+    # we can't apply these to the pickled values (and add's result depends
+    # on the authoritative cache), so just forget what we had
+    def _forget(self, key, *a, **kw):
+        self.cache.delete(key)
+
+    add = append = prepend = replace = incr = decr = _forget
+
+    def _forget_multi(self, keys, prefix='', *a, **kw):
+        self.delete_multi(keys, prefix=prefix)
+
+    add_multi = incr_multi = _forget_multi
+
+    def flush_all(self):
+        self.cache.clear()
+
+    def __repr__(self):
+        return '<%s(%r, %r)>' % (self.__class__.__name__, self.prefixes,
+                                 self.cache)
+
+
+# caches that are skipped when a chain is asked not to use local results
+IN_PROCESS_CACHES = (LocalCache, ProcessCache)
+
 class CacheChain(CacheUtils, local):
     def __init__(self, caches, cache_negative_results=False):
         self.caches = caches
@@ -339,7 +633,7 @@ class CacheChain(CacheUtils, local):
         stat_outcome = False  # assume a miss until a result is found
         try:
             for c in self.caches:
-                if not allow_local and isinstance(c,LocalCache):
+                if not allow_local and isinstance(c, IN_PROCESS_CACHES):
                     continue
 
                 val = c.get(key)
@@ -381,7 +675,7 @@ class CacheChain(CacheUtils, local):
         hits = 0
         misses = 0
         for c in self.caches:
-            if not allow_local and isinstance(c, LocalCache):
+            if not allow_local and isinstance(c, IN_PROCESS_CACHES):
                 continue
 
             if c.permanent and not misses:
@@ -481,12 +775,18 @@ class StaleCacheChain(CacheChain):
        cache. Probably doesn't play well with NoneResult cacheing"""
     staleness = 30
 
-    def __init__(self, localcache, stalecache, realcache):
+    def __init__(self, localcache, stalecache, realcache, processcache=None):
         self.localcache = localcache
         self.stalecache = stalecache
         self.realcache = realcache
-        self.caches = (localcache, realcache) # for the other
-                                              # CacheChain machinery
+        self.processcache = processcache
+        # for the other CacheChain machinery. the process cache is a tier
+        # of its own (rather than part of realcache) so that lookups with
+        # allow_local=False skip it
+        if processcache:
+            self.caches = (localcache, processcache, realcache)
+        else:
+            self.caches = (localcache, realcache)
         self.stats = None
 
     def get(self, key, default=None, stale = False, **kw):
@@ -529,8 +829,16 @@ class StaleCacheChain(CacheChain):
                 ret[k] = v
                 keys.remove(k)
 
+        if keys and self.processcache and kw.get('allow_local', True):
+            values = self.processcache.simple_get_multi(keys)
+            self.localcache.update(values)
+            ret.update(values)
+            keys.difference_update(values)
+
         if keys:
             values = self.realcache.simple_get_multi(keys)
+            if values and self.processcache:
+                self.processcache.set_multi(values)
             if values and stale:
                 self.stalecache.set_multi(values, time=self.staleness)
             self.localcache.update(values)
@@ -28,15 +28,20 @@ import httplib
 import json
 from lxml import etree
 from pylons import g, c
+import os
+import Queue
 import re
+import socket
+import sys
+import threading
 import time
 import urllib
 
 import l2cs
 
-from r2.lib import amqp, filters
+from r2.lib import amqp, filters, localsearch
 from r2.lib.db.operators import desc
-from r2.lib.db.sorts import epoch_seconds
+from r2.lib.db.sorts import epoch_seconds, _hot
 import r2.lib.utils as r2utils
 from r2.models import (Account, Link, Subreddit, Thing, All, DefaultSR,
                        MultiReddit, DomainSR, Friends, ModContribSR,
@@ -83,6 +88,164 @@ class CloudSearchHTTPError(httplib.HTTPException): pass
 class InvalidQuery(Exception): pass
 
 
+class _PendingPost(object):
+    def __init__(self, data, token):
+        self.data = data
+        self.token = token
+        self.done = threading.Event()
+        self.response = None
+        self.exc_info = None
+
+    def result(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.token, self.response
+
+
+class CloudSearchDocumentClient(object):
+    '''Send document batches to a cloudsearch document endpoint over
+    persistent (keep-alive) connections, one per thread.
+
+    With connections > 1, post_many keeps up to that many batches in
+    flight at once, each on its own connection.
+
+    '''
+    path = "/2011-02-01/documents/batch"
+
+    def __init__(self, doc_api, port=80, connections=1, timeout=None):
+        self.doc_api = doc_api
+        self.port = port
+        self.connections = max(connections, 1)
+        self.timeout = timeout
+        self.elapsed = 0.
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _get_connection(self):
+        '''Return this thread's connection, and whether it's been used'''
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            return connection, True
+        connection = httplib.HTTPConnection(self.doc_api, self.port,
+                                            timeout=self.timeout)
+        self._local.connection = connection
+        return connection, False
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            connection.close()
+
+    def _post(self, data):
+        headers = {'Content-Type': 'application/xml'}
+        while True:
+            connection, reused = self._get_connection()
+            try:
+                # HTTPLib calculates Content-Length header automatically
+                connection.request('POST', self.path, data, headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if reused:
+                    # the server probably dropped the idle connection, so
+                    # try again on a new one
+                    continue
+                raise
+            break
+
+        if response.will_close:
+            self.close()
+        if not 200 <= response.status < 300:
+            raise CloudSearchHTTPError(response.status, response.reason, body)
+        return body
+
+    def post(self, data, retries=0):
+        '''POST one batch, and return the response body.
+
+        Raises CloudSearchHTTPError if the endpoint indicates a failure
+        (after retrying up to `retries` times)
+
+        '''
+        for attempt in xrange(retries + 1):
+            start = time.time()
+            try:
+                return self._post(data)
+            except (httplib.HTTPException, socket.error) as err:
+                if attempt == retries:
+                    raise
+                g.log.warning("Got %s, sleeping %s secs", err, attempt)
+                time.sleep(attempt)
+            finally:
+                with self._lock:
+                    self.elapsed += time.time() - start
+
+    def post_many(self, batches, retries=0):
+        '''POST each of `batches`, an iterable of (data, token) pairs.
+
+        Yields (token, response body) pairs in the same order. `batches` is
+        consumed lazily: at most twice `connections` of them are held at a
+        time.
+
+        '''
+        if self.connections == 1:
+            for data, token in batches:
+                yield token, self.post(data, retries=retries)
+            return
+
+        requests = Queue.Queue()
+
+        def worker():
+            try:
+                while True:
+                    pending = requests.get()
+                    if pending is None:
+                        return
+                    try:
+                        pending.response = self.post(pending.data,
+                                                     retries=retries)
+                    except Exception:
+                        pending.exc_info = sys.exc_info()
+                    pending.data = None
+                    pending.done.set()
+            finally:
+                self.close()
+
+        workers = [threading.Thread(target=worker)
+                   for x in xrange(self.connections)]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+
+        window = collections.deque()
+        try:
+            for data, token in batches:
+                pending = _PendingPost(data, token)
+                requests.put(pending)
+                window.append(pending)
+                if len(window) >= 2 * self.connections:
+                    yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+        finally:
+            for thread in workers:
+                requests.put(None)
+
+
+_document_clients = {}
+
+def get_document_client(doc_api, connections=1, local_index="links"):
+    if g.search_backend == "local":
+        return localsearch.LocalDocumentClient(get_local_index(local_index))
+    key = (doc_api, connections)
+    if key not in _document_clients:
+        _document_clients[key] = CloudSearchDocumentClient(
+            doc_api, connections=connections)
+    return _document_clients[key]
+
+
 Field = collections.namedtuple("Field", "name cloudsearch_type "
                                "lucene_type function")
 SAME_AS_CLOUDSEARCH = object()
@@ -326,14 +489,50 @@ class SubredditFields(FieldsBase):
         return self.sr._type_id
 
 
+### Local search backend ###
+_LOCAL_SCHEMAS = {
+    "links": localsearch.IndexSchema(
+        text_fields=["title", "selftext", "url", "flair_text"],
+        int_fields=LinkFields.cloudsearch_fieldnames(type_=int),
+        default_fields=["title", "selftext"],
+        stored_fields=["title"],
+        rank_expressions={
+            "hot2": lambda hit: _hot(hit.get("ups"), hit.get("downs"),
+                                     hit.get("timestamp")),
+            "top": lambda hit: hit.get("ups") - hit.get("downs"),
+        },
+    ),
+    "subreddits": localsearch.IndexSchema(
+        text_fields=["name", "title", "header_title", "description",
+                     "sidebar"],
+        int_fields=(SubredditFields.cloudsearch_fieldnames(type_=int) +
+                    ["activity", "subscribers", "type_id"]),
+        default_fields=["name", "title", "header_title", "description"],
+        stored_fields=["title"],
+    ),
+}
+
+
+def get_local_index(name):
+    '''The local index (see search_backend in the ini) for "links" or
+    "subreddits"'''
+    return localsearch.get_index(os.path.join(g.search_index_dir, name),
+                                 _LOCAL_SCHEMAS[name])
+
+
 class CloudSearchUploader(object):
     use_safe_get = False
     types = ()
+    local_index = "links"
 
-    def __init__(self, doc_api, fullnames=None, version_offset=_VERSION_OFFSET):
+    def __init__(self, doc_api, fullnames=None, version_offset=_VERSION_OFFSET,
+                 things=None, connections=1):
         self.doc_api = doc_api
         self._version_offset = version_offset
         self.fullnames = fullnames
+        self.things = things
+        self.client = get_document_client(doc_api, connections,
+                                          local_index=self.local_index)
 
     @classmethod
     def desired_fullnames(cls, items):
@@ -397,16 +596,23 @@ class CloudSearchUploader(object):
         
         '''
         batch = etree.Element("batch")
+        batch.extend(self.iter_xml_from_things())
+        return batch
+
+    def iter_xml_from_things(self):
+        '''Generate the add/delete XML elements for the given things, one
+        at a time
+
+        '''
         self.batch_lookups()
         version = self._version()
         for thing in self.things:
+            node = None
             try:
                 if thing._spam or thing._deleted:
-                    delete_node = self.delete_xml(thing, version)
-                    batch.append(delete_node)
+                    node = self.delete_xml(thing, version)
                 elif self.should_index(thing):
-                    add_node = self.add_xml(thing, version)
-                    batch.append(add_node)
+                    node = self.add_xml(thing, version)
             except (AttributeError, KeyError) as e:
                 # Problem! Bail out, which means these items won't get
                 # "consumed" from the queue. If the problem is from DB
@@ -419,12 +625,16 @@ class CloudSearchUploader(object):
                 else:
                     g.log.warning("Ignoring problem on thing %r.\n\n%r",
                                   thing, e)
-        return batch
+            if node is not None:
+                yield node
 
     def should_index(self, thing):
         raise NotImplementedError
 
     def batch_lookups(self):
+        if self.fullnames is None:
+            # we were given the things themselves
+            return
         try:
             self.things = Thing._by_fullname(self.fullnames, data=True,
                                              return_dict=False)
@@ -443,15 +653,22 @@ class CloudSearchUploader(object):
         of the communication with the cloudsearch endpoint
         
         '''
-        xml_things = self.xml_from_things()
+        start = self.client.elapsed
+        batches = chunk_docs(self.iter_xml_from_things())
+        sent = [response for token, response
+                in self.client.post_many((data, None) for data in batches)]
 
-        if not len(xml_things):
+        if not sent:
             return 0
 
-        cs_start = datetime.now(g.tz)
-        sent = self.send_documents(xml_things)
-        cs_time = (datetime.now(g.tz) - cs_start).total_seconds()
+        self.report(sent, quiet=quiet)
+        return self.client.elapsed - start
+
+    def report(self, sent, quiet=False):
+        '''Record stats for (and unless `quiet`, print) the responses to
+        some uploads
 
+        '''
         adds, deletes, warnings = 0, 0, []
         for record in sent:
             response = etree.fromstring(record)
@@ -472,42 +689,25 @@ class CloudSearchUploader(object):
                 print "%s Warnings: %s" % (self.__class__.__name__,
                                            "; ".join(warnings))
 
-        return cs_time
-
     def send_documents(self, docs):
-        '''Open a connection to the cloudsearch endpoint, and send the documents
-        for indexing. Multiple requests are sent if a large number of documents
-        are being sent (see chunk_xml())
+        '''Send the documents for indexing over our keep-alive connection.
+        Multiple requests are sent if a large number of documents are being
+        sent (see chunk_docs())
         
         Raises CloudSearchHTTPError if the endpoint indicates a failure
         '''
-        responses = []
-        connection = httplib.HTTPConnection(self.doc_api, 80)
-        chunker = chunk_xml(docs)
-        try:
-            for data in chunker:
-                headers = {}
-                headers['Content-Type'] = 'application/xml'
-                # HTTPLib calculates Content-Length header automatically
-                connection.request('POST', "/2011-02-01/documents/batch",
-                                   data, headers)
-                response = connection.getresponse()
-                if 200 <= response.status < 300:
-                    responses.append(response.read())
-                else:
-                    raise CloudSearchHTTPError(response.status,
-                                               response.reason,
-                                               response.read())
-        finally:
-            connection.close()
-        return responses
+        return [response for token, response
+                in self.client.post_many((data, None)
+                                         for data in chunk_docs(docs))]
 
 
 class LinkUploader(CloudSearchUploader):
     types = (Link,)
 
-    def __init__(self, doc_api, fullnames=None, version_offset=_VERSION_OFFSET):
-        super(LinkUploader, self).__init__(doc_api, fullnames, version_offset)
+    def __init__(self, doc_api, fullnames=None, version_offset=_VERSION_OFFSET,
+                 **kw):
+        super(LinkUploader, self).__init__(doc_api, fullnames, version_offset,
+                                           **kw)
         self.accounts = {}
         self.srs = {}
 
@@ -548,6 +748,7 @@ class LinkUploader(CloudSearchUploader):
 
 class SubredditUploader(CloudSearchUploader):
     types = (Subreddit,)
+    local_index = "subreddits"
     _version = CloudSearchUploader._version_seconds
 
     def fields(self, thing):
@@ -557,28 +758,27 @@ class SubredditUploader(CloudSearchUploader):
         return getattr(thing, 'author_id', None) != -1
 
 
-def chunk_xml(xml, depth=0):
-    '''Chunk POST data into pieces that are smaller than the 20 MB limit.
-    
-    Ideally, this never happens (if chunking is necessary, would be better
-    to avoid xml'ifying before testing content_length)'''
-    data = etree.tostring(xml)
-    content_length = len(data)
-    if content_length < _CHUNK_SIZE:
-        yield data
-    else:
-        depth += 1
-        print "WARNING: Chunking (depth=%s)" % depth
-        half = len(xml) / 2
-        left_half = xml # for ease of reading
-        right_half = etree.Element("batch")
-        # etree magic simultaneously removes the elements from one tree
-        # when they are appended to a different tree
-        right_half.append(xml[half:])
-        for chunk in chunk_xml(left_half, depth=depth):
-            yield chunk
-        for chunk in chunk_xml(right_half, depth=depth):
-            yield chunk
+def chunk_docs(docs, max_size=_CHUNK_SIZE):
+    '''Serialize docs (an iterable of XML elements, such as a <batch>) into
+    <batch> POST bodies of less than max_size bytes each.
+
+    Each body is yielded as soon as it's full, so only one is held in memory
+    at a time. A single document bigger than max_size gets a body of its own.
+
+    '''
+    empty_size = len("<batch></batch>")
+    parts = []
+    size = empty_size
+    for doc in docs:
+        data = etree.tostring(doc)
+        if parts and size + len(data) >= max_size:
+            yield "<batch>%s</batch>" % "".join(parts)
+            parts = []
+            size = empty_size
+        parts.append(data)
+        size += len(data)
+    if parts:
+        yield "<batch>%s</batch>" % "".join(parts)
 
 
 @g.stats.amqp_processor('cloudsearch_q')
@@ -633,10 +833,10 @@ _REBUILD_INDEX_CACHE_KEY = "cloudsearch_cursor_%s"
 
 def rebuild_link_index(start_at=None, sleeptime=1, cls=Link,
                        uploader=LinkUploader, doc_api='CLOUDSEARCH_DOC_API',
-                       estimate=50000000, chunk_size=1000):
+                       estimate=50000000, chunk_size=1000, connections=1):
     cache_key = _REBUILD_INDEX_CACHE_KEY % uploader.__name__.lower()
     doc_api = getattr(g, doc_api)
-    uploader = uploader(doc_api)
+    uploader = uploader(doc_api, connections=connections)
 
     if start_at is _REBUILD_INDEX_CACHE_KEY:
         start_at = g.cache.get(cache_key)
@@ -653,22 +853,26 @@ def rebuild_link_index(start_at=None, sleeptime=1, cls=Link,
     q = r2utils.fetch_things2(q, chunk_size=chunk_size)
     q = r2utils.progress(q, verbosity=1000, estimate=estimate, persec=True,
                          key=_progress_key)
-    for chunk in r2utils.in_chunks(q, size=chunk_size):
-        uploader.things = chunk
-        for x in range(5):
-            try:
-                uploader.inject()
-            except httplib.HTTPException as err:
-                print "Got %s, sleeping %s secs" % (err, x)
-                time.sleep(x)
-                continue
-            else:
-                break
-        else:
-            raise err
-        last_update = chunk[-1]
-        g.cache.set(cache_key, last_update._fullname)
-        time.sleep(sleeptime)
+
+    def batches():
+        # the last batch for each chunk carries the fullname to resume from
+        # once it's been sent
+        for chunk in r2utils.in_chunks(q, size=chunk_size):
+            uploader.things = chunk
+            last = None
+            for data in chunk_docs(uploader.iter_xml_from_things()):
+                if last is not None:
+                    yield last, None
+                last = data
+            if last is not None:
+                yield last, chunk[-1]._fullname
+
+    for last_update, response in uploader.client.post_many(batches(),
+                                                           retries=4):
+        uploader.report([response])
+        if last_update:
+            g.cache.set(cache_key, last_update)
+            time.sleep(sleeptime)
 
 
 rebuild_subreddit_index = functools.partial(rebuild_link_index,
@@ -738,11 +942,20 @@ INVALID_QUERY_CODES = ('CS-UnknownFieldInMatchExpression',
 DEFAULT_FACETS = {"reddit": {"count":20}}
 def basic_query(query=None, bq=None, faceting=None, size=1000,
                 start=0, rank="-relevance", return_fields=None, record_stats=False,
-                search_api=None):
+                search_api=None, local_index="links"):
     if search_api is None:
         search_api = g.CLOUDSEARCH_SEARCH_API
     if faceting is None:
         faceting = DEFAULT_FACETS
+    if g.search_backend == "local":
+        return _local_query(local_index, query, bq, faceting, size, start,
+                            rank, return_fields, record_stats)
+    return _cloudsearch_query(search_api, query, bq, faceting, size, start,
+                              rank, return_fields, record_stats)
+
+
+def _cloudsearch_query(search_api, query, bq, faceting, size, start, rank,
+                       return_fields, record_stats):
     path = _encode_query(query, bq, faceting, size, start, rank, return_fields)
     timer = None
     if record_stats:
@@ -776,6 +989,31 @@ def basic_query(query=None, bq=None, faceting=None, size=1000,
     return json.loads(response)
 
 
+def _local_query(local_index, query, bq, faceting, size, start, rank,
+                 return_fields, record_stats):
+    '''basic_query, against the local index instead of cloudsearch'''
+    index = get_local_index(local_index)
+    timer = None
+    if record_stats:
+        timer = g.stats.get_timer("cloudsearch_timer")
+        timer.start()
+    try:
+        response = index.search(query=query, bq=bq, faceting=faceting,
+                                size=size, start=start, rank=rank,
+                                return_fields=return_fields)
+    except localsearch.QueryError as e:
+        if record_stats:
+            g.stats.action_count("event.search_query", 400)
+        raise InvalidQuery(400, "Bad Request", str(e), query or bq)
+    finally:
+        if timer is not None:
+            timer.stop()
+
+    if record_stats:
+        g.stats.action_count("event.search_query", 200)
+    return response
+
+
 basic_link = functools.partial(basic_query, size=10, start=0,
                                rank="-relevance",
                                return_fields=['title', 'reddit',
@@ -791,7 +1029,8 @@ basic_subreddit = functools.partial(basic_query,
                                     return_fields=['title', 'reddit',
                                                    'author_fullname'],
                                     record_stats=False,
-                                    search_api=g.CLOUDSEARCH_SUBREDDIT_SEARCH_API)
+                                    search_api=g.CLOUDSEARCH_SUBREDDIT_SEARCH_API,
+                                    local_index="subreddits")
 
 
 def _encode_query(query, bq, faceting, size, start, rank, return_fields):
@@ -822,6 +1061,7 @@ def _encode_query(query, bq, faceting, size, start, rank, return_fields):
 class CloudSearchQuery(object):
     '''Represents a search query sent to cloudsearch'''
     search_api = None
+    local_index = "links"
     sorts = {}
     sorts_menu_mapping = {}
     recents = {None: None}
@@ -934,7 +1174,8 @@ class CloudSearchQuery(object):
             return Results([], 0, {})
         response = basic_query(query=query, bq=bq, size=num, start=start,
                                rank=sort, search_api=cls.search_api,
-                               faceting=faceting, record_stats=True)
+                               faceting=faceting, record_stats=True,
+                               local_index=cls.local_index)
 
         warnings = response['info'].get('messages', [])
         for warning in warnings:
@@ -1048,6 +1289,7 @@ class LinkSearchQuery(CloudSearchQuery):
 
 class SubredditSearchQuery(CloudSearchQuery):
     search_api = g.CLOUDSEARCH_SUBREDDIT_SEARCH_API
+    local_index = "subreddits"
     sorts = {'relevance': '-activity',
              None: '-activity',
              }
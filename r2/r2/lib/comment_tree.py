@@ -23,6 +23,7 @@
 from pylons import g, c
 from itertools import chain
 from r2.lib.utils import SimpleSillyStub, tup, to36
+from r2.lib.db import sorts
 from r2.lib.db.sorts import epoch_seconds
 from r2.lib.cache import sgm
 from r2.models.comment_tree import CommentTree
@@ -48,6 +49,24 @@ def _get_sort_value(comment, sort):
         return epoch_seconds(comment._date)
     return getattr(comment, sort)
 
+COMMENT_SORTS = ("_controversy", "_hot", "_confidence", "_score", "_date")
+# below this many comments the batch sorts cost more than they save
+BATCH_SORT_THRESHOLD = 50
+
+def _get_sort_values_batch(comments):
+    """All of the COMMENT_SORTS for comments at once, as a dict of sort ->
+    list of values in the same order as comments."""
+    ups = [cm._ups for cm in comments]
+    downs = [cm._downs for cm in comments]
+    dates = [epoch_seconds(cm._date) for cm in comments]
+    return {
+        "_controversy": sorts.controversy_batch(ups, downs).tolist(),
+        "_hot": sorts.hot_batch(ups, downs, dates).tolist(),
+        "_confidence": sorts.confidence_batch(ups, downs).tolist(),
+        "_score": sorts.score_batch(ups, downs).tolist(),
+        "_date": dates,
+    }
+
 def add_comments(comments):
     links = Link._byID([com.link_id for com in tup(comments)], data=True)
     comments = tup(comments)
@@ -88,12 +107,18 @@ def update_comment_votes(comments, write_consistency_level = None):
         link_map.setdefault(com.link_id, []).append(com)
 
     for link_id, coms in link_map.iteritems():
-        for sort in ("_controversy", "_hot", "_confidence", "_score", "_date"):
+        if len(coms) >= BATCH_SORT_THRESHOLD and sorts.batch_available:
+            sort_values = _get_sort_values_batch(coms)
+        else:
+            sort_values = dict((sort, [_get_sort_value(cm, sort)
+                                       for cm in coms])
+                               for sort in COMMENT_SORTS)
+
+        for sort in COMMENT_SORTS:
             # Cassandra always uses the id36 instead of the integer
             # ID, so we'll map that first before sending it
             c_key = sort_comments_key(link_id, sort)
-            c_r = dict((cm._id36, _get_sort_value(cm, sort))
-                       for cm in coms)
+            c_r = dict(zip((cm._id36 for cm in coms), sort_values[sort]))
             CommentSortsCache._set_values(c_key, c_r,
                                           write_consistency_level = write_consistency_level)
 
@@ -150,17 +175,25 @@ def link_comments_and_sort(link, sort):
     #    These are represented by a Cassandra model
     #    (CommentSortsCache) rather than a permacache key. One of
     #    these exists for each sort (hot, new, etc)
+    #
+    # Trees stored in Cassandra (version 2) come back as a
+    # CompactCommentTree, and the tree, depth, num_children and parents
+    # returned for them are read-only views over its arrays (with
+    # parents always available) instead of dicts.
 
     timer = g.stats.get_timer('comment_tree.get.%s' % link.comment_tree_version)
     timer.start()
 
     link_id = link._id
     cache = get_comment_tree(link, timer=timer)
-    cids = cache.cids
-    tree = cache.tree
-    depth = cache.depth
-    num_children = cache.num_children
-    parents = cache.parents
+    # trees loaded in compact form are handed out as views over their
+    # arrays rather than being turned into dicts
+    source = cache.compact if cache.compact is not None else cache
+    cids = source.cids
+    tree = source.tree
+    depth = source.depth
+    num_children = source.num_children
+    parents = source.parents
 
     # load the sorter
     sorter = _get_comment_sorter(link_id, sort)
@@ -183,26 +216,28 @@ def link_comments_and_sort(link, sort):
         sorter.update(_comment_sorter_from_cids(sorter_needed, sort))
         timer.intermediate('sort')
 
-    if parents is None:
-        g.log.debug("comment_tree.py: parents cache miss for Link %s"
-                    % link_id)
-        parents = {}
-    elif cids and not all(x in parents for x in cids):
-        g.log.debug("Error in comment_tree: parents inconsistent for Link %s"
-                    % link_id)
-        parents = {}
-
-    if not parents and len(cids) > 0:
-        with CommentTree.mutation_context(link):
-            # reload under lock so the sorter and parents are consistent
-            timer.intermediate('lock')
-            cache = get_comment_tree(link, timer=timer)
-            cache.parents = cache.parent_dict_from_tree(cache.tree)
+    if source is cache:
+        if parents is None:
+            g.log.debug("comment_tree.py: parents cache miss for Link %s"
+                        % link_id)
+            parents = {}
+        elif cids and not all(x in parents for x in cids):
+            g.log.debug("Error in comment_tree: parents inconsistent for Link %s"
+                        % link_id)
+            parents = {}
+
+        if not parents and len(cids) > 0:
+            with CommentTree.mutation_context(link):
+                # reload under lock so the sorter and parents are consistent
+                timer.intermediate('lock')
+                cache = get_comment_tree(link, timer=timer)
+                cache.parents = cache.parent_dict_from_tree(cache.tree)
+            source = cache
 
     timer.stop()
 
-    return (cache.cids, cache.tree, cache.depth, cache.num_children,
-            cache.parents, sorter)
+    return (source.cids, source.tree, source.depth, source.num_children,
+            source.parents, sorter)
 
 def get_comment_tree(link, _update=False, timer=None):
     if timer is None:
@@ -449,4 +484,8 @@ def _populate(after_id = None, estimate=54301242):
 
     for chunk in utils.in_chunks(q, chunk_size):
         chunk = filter(lambda x: hasattr(x, 'link_id'), chunk)
-        update_comment_votes(chunk, write_consistency_level = tdb_cassandra.CL.ONE)
+        # send the sorts for the whole chunk in a few big mutations
+        # instead of one per link and sort
+        with tdb_cassandra.batched_commits(
+                write_consistency_level=tdb_cassandra.CL.ONE):
+            update_comment_votes(chunk)
@@ -23,6 +23,11 @@
 from datetime import datetime, timedelta
 from pylons import g
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 cdef extern from "math.h":
     double log10(double)
     double sqrt(double)
@@ -89,3 +94,82 @@ def confidence(int ups, int downs):
         return _confidences[downs + ups * down_range]
     else:
         return _confidence(ups, downs)
+
+
+# batch versions of the above. these take sequences (or arrays) of ups,
+# downs and epoch seconds and return numpy arrays. they call the same C
+# functions as the scalar versions, so the results are identical.
+
+batch_available = numpy is not None
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("numpy is required for batch sorts")
+
+def _longs(values):
+    return numpy.ascontiguousarray(values, dtype=numpy.int_)
+
+def _doubles(values):
+    return numpy.ascontiguousarray(values, dtype=numpy.float64)
+
+def score_batch(ups, downs):
+    _require_numpy()
+    cdef long[:] u = _longs(ups)
+    cdef long[:] d = _longs(downs)
+    if u.shape[0] != d.shape[0]:
+        raise ValueError("ups and downs must be the same length")
+    out = numpy.empty(u.shape[0], dtype=numpy.int_)
+    cdef long[:] o = out
+    cdef Py_ssize_t i
+    for i in range(u.shape[0]):
+        o[i] = score(u[i], d[i])
+    return out
+
+def hot_batch(ups, downs, dates):
+    """Like _hot, so dates are in epoch seconds."""
+    _require_numpy()
+    cdef long[:] u = _longs(ups)
+    cdef long[:] d = _longs(downs)
+    cdef double[:] t = _doubles(dates)
+    if not u.shape[0] == d.shape[0] == t.shape[0]:
+        raise ValueError("ups, downs and dates must be the same length")
+    out = numpy.empty(u.shape[0], dtype=numpy.float64)
+    cdef double[:] o = out
+    cdef Py_ssize_t i
+    for i in range(u.shape[0]):
+        o[i] = _hot(u[i], d[i], t[i])
+    return out
+
+def controversy_batch(ups, downs):
+    _require_numpy()
+    cdef long[:] u = _longs(ups)
+    cdef long[:] d = _longs(downs)
+    if u.shape[0] != d.shape[0]:
+        raise ValueError("ups and downs must be the same length")
+    out = numpy.empty(u.shape[0], dtype=numpy.float64)
+    cdef double[:] o = out
+    cdef Py_ssize_t i
+    for i in range(u.shape[0]):
+        o[i] = controversy(u[i], d[i])
+    return out
+
+def confidence_batch(ups, downs):
+    _require_numpy()
+    cdef long[:] u = _longs(ups)
+    cdef long[:] d = _longs(downs)
+    if u.shape[0] != d.shape[0]:
+        raise ValueError("ups and downs must be the same length")
+    out = numpy.empty(u.shape[0], dtype=numpy.float64)
+    cdef double[:] o = out
+    cdef Py_ssize_t i
+    cdef long up, down
+    for i in range(u.shape[0]):
+        up = u[i]
+        down = d[i]
+        if up + down == 0:
+            o[i] = 0
+        elif up < up_range and down < down_range:
+            o[i] = _confidences[down + up * down_range]
+        else:
+            o[i] = _confidence(up, down)
+    return out
@@ -0,0 +1,142 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+"""A compact storage format for the tuples stored by CachedResults.
+
+CachedResults listings are lists of (fullname, sort_col, sort_col, ...)
+tuples, kept sorted descending by their sort columns. Pickled as-is, every
+tuple carries its own copy of the fullname's type prefix and every number
+is a separate pickled object. Packed, a listing is a short header, the
+shared type prefix, the thing IDs as unsigned 64 bit ints and each sort
+column as an array of doubles.
+
+Sort columns come back as floats. Listings that can't be packed (mixed
+thing types, non-numeric sort values) are left as plain lists, and
+`unpack_results` passes lists through untouched, so old pickled values can
+still be read.
+
+"""
+
+import bisect
+import struct
+
+from r2.lib.utils import to36
+
+
+MAGIC = 'PQR1'
+# magic, number of sort columns, length of the fullname prefix, number of
+# items
+HEADER = struct.Struct('<4sBHI')
+
+
+def _split_fullname(fullname):
+    prefix, sep, id36 = fullname.rpartition('_')
+    return prefix + sep, int(id36, 36)
+
+
+def pack_results(tuples):
+    """Pack a list of CachedResults tuples, or return it as-is if it can't
+    be packed."""
+    if not tuples:
+        return tuples
+
+    num_cols = len(tuples[0]) - 1
+    prefix = None
+    ids = []
+    for t in tuples:
+        if len(t) != num_cols + 1:
+            return tuples
+        try:
+            item_prefix, thing_id = _split_fullname(t[0])
+        except (AttributeError, ValueError):
+            return tuples
+        if prefix is None:
+            prefix = item_prefix
+        elif item_prefix != prefix:
+            return tuples
+        ids.append(thing_id)
+
+    parts = [HEADER.pack(MAGIC, num_cols, len(prefix), len(tuples)),
+             prefix,
+             struct.pack('<%dQ' % len(ids), *ids)]
+    for i in xrange(1, num_cols + 1):
+        col = [t[i] for t in tuples]
+        if not all(isinstance(v, (int, long, float)) for v in col):
+            return tuples
+        parts.append(struct.pack('<%dd' % len(col), *col))
+    return ''.join(parts)
+
+
+def is_packed(value):
+    return isinstance(value, str) and value.startswith(MAGIC)
+
+
+def unpack_results(value):
+    """Unpack a value made by pack_results. Anything else (an old pickled
+    list, or None) is returned unchanged."""
+    if not is_packed(value):
+        return value
+
+    magic, num_cols, prefix_len, count = HEADER.unpack_from(value)
+    offset = HEADER.size
+    prefix = value[offset:offset + prefix_len]
+    offset += prefix_len
+
+    ids = struct.unpack_from('<%dQ' % count, value, offset)
+    offset += 8 * count
+    columns = [[prefix + to36(i) for i in ids]]
+    for i in xrange(num_cols):
+        columns.append(struct.unpack_from('<%dd' % count, value, offset))
+        offset += 8 * count
+
+    return zip(*columns)
+
+
+class _DescendingSortKeys(object):
+    """A read-only sequence view of the negated sort columns of a listing,
+    so that bisect can search a listing that's sorted descending."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, i):
+        return _Reversed(self.data[i][1:])
+
+
+class _Reversed(object):
+    __slots__ = ('val',)
+
+    def __init__(self, val):
+        self.val = val
+
+    def __lt__(self, other):
+        return other.val < self.val
+
+
+def insert_sorted(data, t):
+    """Insert a tuple into a listing sorted descending by its sort columns,
+    after any items that it ties with (as a stable sort would)."""
+    i = bisect.bisect_right(_DescendingSortKeys(data), _Reversed(t[1:]))
+    data.insert(i, t)
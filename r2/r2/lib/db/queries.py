@@ -20,11 +20,12 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-from r2.models import Account, Link, Comment, Vote, Report
+from r2.models import Account, Link, Comment, Vote, VoteDirections, Report
 from r2.models import Message, Inbox, Subreddit, ModContribSR, ModeratorInbox, MultiReddit
 from r2.lib.db.thing import Thing, Merge
 from r2.lib.db.operators import asc, desc, timeago
 from r2.lib.db.sorts import epoch_seconds
+from r2.lib.db.packed_results import pack_results, unpack_results, insert_sorted
 from r2.lib.utils import fetch_things2, tup, UniqueIterator, set_last_modified
 from r2.lib import utils
 from r2.lib import amqp, sup, filters
@@ -46,11 +47,14 @@ from r2.lib.utils import SimpleSillyStub
 
 import cPickle as pickle
 
+from contextlib import contextmanager
 from datetime import datetime
 from time import mktime
 import pytz
 import itertools
 import collections
+import threading
+import time
 from copy import deepcopy
 from r2.lib.db.operators import and_, or_
 
@@ -123,7 +127,7 @@ class CachedResults(object):
         cached = query_cache.get_multi([cr.iden for cr in unfetched],
                                        allow_local = not force)
         for cr in unfetched:
-            cr.data = cached.get(cr.iden) or []
+            cr.data = unpack_results(cached.get(cr.iden)) or []
             cr._fetched = True
 
     def make_item_tuple(self, item):
@@ -167,8 +171,23 @@ class CachedResults(object):
         "True if a item can be removed from the listing, always true for now."
         return True
 
+    @staticmethod
+    def _pack(data):
+        # only write the packed format once everything can read it
+        if g.querycache_packed_writes:
+            return pack_results(data)
+        return data
+
     def _mutate(self, fn, willread=True):
-        self.data = query_cache.mutate(self.iden, fn, default=[], willread=willread)
+        unpacked = {}
+        def _packed_mutate(data):
+            data = fn(unpack_results(data))
+            unpacked['data'] = data
+            return self._pack(data)
+
+        query_cache.mutate(self.iden, _packed_mutate, default=[],
+                           willread=willread)
+        self.data = unpacked['data']
         self._fetched=True
 
     def insert(self, items):
@@ -189,15 +208,38 @@ class CachedResults(object):
                         for x in t)):
                 return data
 
-            # insert the new items, remove the duplicates (keeping the
-            # one being inserted over the stored value if applicable),
-            # and sort the result
+            # remove the duplicates (keeping the one being inserted over
+            # the stored value if applicable) and insert the new items
+            # where they belong. data is already sorted so this doesn't
+            # need a full sort.
             newfnames = set(x[0] for x in t)
-            data = filter(lambda x: x[0] not in newfnames, data)
-            data.extend(t)
-            data.sort(reverse=True, key=lambda x: x[1:])
-            if len(t) + len(data) > precompute_limit:
-                data = data[:precompute_limit]
+            data = [x for x in data if x[0] not in newfnames]
+            for x in t:
+                insert_sorted(data, x)
+            del data[precompute_limit:]
+            return data
+
+        self._mutate(_mutate)
+
+    def _apply_changes(self, changes):
+        """Apply many inserts and deletes in one mutation. changes maps
+           fullname -> tuple to insert, or None to delete it."""
+        fnames = set(changes)
+        inserts = [t for t in changes.itervalues() if t is not None]
+        only_inserts = len(inserts) == len(fnames)
+
+        def _mutate(data):
+            data = data or []
+
+            # same short-circuit as _insert_tuples
+            if (only_inserts and len(data) >= precompute_limit
+                and all(x[1:] < data[-1][1:] for x in inserts)):
+                return data
+
+            data = [x for x in data if x[0] not in fnames]
+            for x in inserts:
+                insert_sorted(data, x)
+            del data[precompute_limit:]
             return data
 
         self._mutate(_mutate)
@@ -221,12 +263,26 @@ class CachedResults(object):
             return tuples
         self._mutate(_mutate, willread=False)
 
+    @classmethod
+    def _replace_multi(cls, replacements):
+        """Like _replace, for many queries in one write: replacements
+           is a list of (CachedResults, tuples). This doesn't take the
+           mutation locks that _replace does, so it's only for listings
+           that are rebuilt wholesale (mr_top's), where a concurrent
+           delete is at worst undone until the next rebuild."""
+        packed = {}
+        for results, tuples in replacements:
+            results.data = tuples
+            results._fetched = True
+            packed[results.iden] = cls._pack(tuples)
+        query_cache.set_multi(packed)
+
     def update(self):
         """Runs the query and stores the result in the cache. This is
            only run by hand."""
         self.data = [self.make_item_tuple(i) for i in self.query]
         self._fetched = True
-        query_cache.set(self.iden, self.data)
+        query_cache.set(self.iden, self._pack(self.data))
 
     def __repr__(self):
         return '<CachedResults %s %s>' % (self.query._rules, self.query._sort)
@@ -800,20 +856,163 @@ def get_gilded_user_comments(user_id):
 def get_user_gildings(user_id):
     return
 
+class CachedResultsBatcher(object):
+    """Write-behind for inserts into and deletes from CachedResults.
+
+    Changes are collected per listing (by iden) and every `window` seconds
+    (or whenever flush is called, if window is None) each listing gets a
+    single mutation with all of them merged, so a hot listing takes one
+    lock and one read-modify-write for many votes rather than one each.
+    The last change to an item wins, and flushes are applied one at a time
+    in order so an older batch can't overwrite a newer one.
+
+    Changes are lost if the process dies before they're flushed, so this
+    is only for callers whose changes would otherwise go through the amqp
+    worker thread, which loses them the same way (run_new_comments). Queue
+    processors that are stopped flush what's left with drain_batcher.
+    Anything that must be applied before its message is acked (votes)
+    should flush with window=None before acking instead, as
+    process_votes_batched does.
+
+    """
+
+    def __init__(self, name, window):
+        self.name = name
+        self.window = window
+        self.lock = threading.RLock()
+        # held while a batch is applied, so that the flusher thread and a
+        # drain_batcher can't apply two at once (or out of order)
+        self.apply_lock = threading.Lock()
+        self.queries = {}
+        self.pending = {}
+        self.received = 0
+        self.flusher = None
+
+    def _changes(self, query):
+        self.queries[query.iden] = query
+        return self.pending.setdefault(query.iden, collections.OrderedDict())
+
+    def insert(self, query, items):
+        with self.lock:
+            changes = self._changes(query)
+            for item in tup(items):
+                t = query.make_item_tuple(item)
+                changes.pop(t[0], None)
+                changes[t[0]] = t
+                self.received += 1
+        self._start_flusher()
+
+    def delete(self, query, items):
+        with self.lock:
+            changes = self._changes(query)
+            for item in tup(items):
+                fname = query.filter(item)._fullname
+                changes.pop(fname, None)
+                changes[fname] = None
+                self.received += 1
+        self._start_flusher()
+
+    def merge(self, other):
+        """Take on the changes another batcher has collected, as though
+        they'd been made here after everything else."""
+        with other.lock:
+            pending = other.pending
+            queries = other.queries
+            received = other.received
+
+        with self.lock:
+            for iden, changes in pending.iteritems():
+                mine = self._changes(queries[iden])
+                for key, t in changes.iteritems():
+                    mine.pop(key, None)
+                    mine[key] = t
+            self.received += received
+        self._start_flusher()
+
+    def flush(self):
+        with self.apply_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                queries, self.queries = self.queries, {}
+                received, self.received = self.received, 0
+
+            for iden, changes in pending.iteritems():
+                try:
+                    queries[iden]._apply_changes(changes)
+                except:
+                    log.exception("failed to apply %d changes to %r",
+                                  len(changes), queries[iden])
+
+        if received:
+            event = 'querycache_batch.%s' % self.name
+            stats.simple_event(event + '.received', delta=received)
+            stats.simple_event(event + '.applied', delta=len(pending))
+            stats.simple_event(event + '.coalesced',
+                               delta=received - len(pending))
+
+    def _start_flusher(self):
+        # without a window it's up to the owner to flush
+        if self.flusher or not self.window:
+            return
+
+        def _flush_forever():
+            while True:
+                time.sleep(self.window)
+                g.reset_caches()
+                self.flush()
+
+        self.flusher = threading.Thread(target=_flush_forever)
+        self.flusher.setDaemon(True)
+        self.flusher.start()
+
+
+_batching = threading.local()
+
+@contextmanager
+def batched_query_updates(batcher):
+    """Send add_queries calls made in this block through batcher (if it
+       isn't None) rather than applying them right away."""
+    previous = getattr(_batching, 'batcher', None)
+    _batching.batcher = batcher
+    try:
+        yield
+    finally:
+        _batching.batcher = previous
+
+def make_batcher(name):
+    """A CachedResultsBatcher for a queue processor, or None if write-behind
+       is disabled."""
+    if g.querycache_batch_window > 0:
+        return CachedResultsBatcher(name, g.querycache_batch_window)
+    return None
+
+def drain_batcher(batcher):
+    """Apply whatever batcher (if it isn't None) is still holding. Queue
+       processors call this on their way out, since the flusher is a
+       daemon thread and won't."""
+    if batcher:
+        g.reset_caches()
+        batcher.flush()
+
 def add_queries(queries, insert_items=None, delete_items=None, foreground=False):
     """Adds multiple queries to the query queue. If insert_items or
        delete_items is specified, the query may not need to be
        recomputed against the database."""
+    batcher = getattr(_batching, 'batcher', None)
     for q in queries:
         if insert_items and q.can_insert():
             log.debug("Inserting %s into query %s" % (insert_items, q))
-            if foreground:
+            if batcher:
+                batcher.insert(q, insert_items)
+            elif foreground:
                 q.insert(insert_items)
             else:
                 worker.do(q.insert, insert_items)
         elif delete_items and q.can_delete():
             log.debug("Deleting %s from query %s" % (delete_items, q))
-            if foreground:
+            if batcher:
+                batcher.delete(q, delete_items)
+            elif foreground:
                 q.delete(delete_items)
             else:
                 worker.do(q.delete, delete_items)
@@ -901,11 +1100,11 @@ def new_comment(comment, inbox_rels):
 
             if utils.to36(comment.link_id) in g.live_config["fastlane_links"]:
                 amqp.add_item('commentstree_fastlane_q', comment._fullname)
-            elif g.shard_commentstree_queues:
-                amqp.add_item('commentstree_%d_q' % (comment.link_id % 10),
-                              comment._fullname)
             else:
-                amqp.add_item('commentstree_q', comment._fullname)
+                # keep each link's comments on one shard, in order
+                amqp.add_item(amqp.shard_queue('commentstree_q',
+                                               comment.link_id),
+                              comment._fullname)
 
             if not g.amqp_host:
                 add_comments([comment])
@@ -1393,20 +1592,26 @@ def run_new_comments(limit=1000):
     # this is done as a queue because otherwise the contention for the
     # lock on the query would be very high
 
+    batcher = make_batcher('newcomments_q')
+
     @g.stats.amqp_processor('newcomments_q')
     def _run_new_comments(msgs, chan):
         fnames = [msg.body for msg in msgs]
 
         comments = Comment._by_fullname(fnames, data=True, return_dict=False)
-        add_queries([get_all_comments()],
-                    insert_items=comments)
+        with batched_query_updates(batcher):
+            add_queries([get_all_comments()],
+                        insert_items=comments)
 
-        bysrid = _by_srid(comments, False)
-        for srid, sr_comments in bysrid.iteritems():
-            add_queries([_get_sr_comments(srid)],
-                        insert_items=sr_comments)
+            bysrid = _by_srid(comments, False)
+            for srid, sr_comments in bysrid.iteritems():
+                add_queries([_get_sr_comments(srid)],
+                            insert_items=sr_comments)
 
-    amqp.handle_items('newcomments_q', _run_new_comments, limit=limit)
+    try:
+        amqp.handle_items('newcomments_q', _run_new_comments, limit=limit)
+    finally:
+        drain_batcher(batcher)
 
 def run_commentstree(qname="commentstree_q", limit=100):
     """Add new incoming comments to their respective comments trees"""
@@ -1449,10 +1654,9 @@ def queue_vote(user, thing, dir, ip, vote_info=None,
                 if thing._id36 in g.live_config["fastlane_links"]:
                     qname = vote_fastlane_q
                 else:
-                    if g.shard_link_vote_queues:
-                        qname = "vote_link_%s_q" % str(thing.sr_id)[-1]
-                    else:
-                        qname = vote_link_q
+                    # a subreddit's votes go to one shard, to keep down
+                    # contention on its listings
+                    qname = amqp.shard_queue(vote_link_q, thing.sr_id)
 
             elif isinstance(thing, Comment):
                 if utils.to36(thing.link_id) in g.live_config["fastlane_links"]:
@@ -1477,12 +1681,21 @@ def get_likes(user, items):
     if not user or not items:
         return {}
 
+    return get_likes_multi((user, item) for item in items)
+
+def get_likes_multi(pairs):
+    """Look up the vote directions for many (user, item) pairs at once.
+
+    The users can all be different: the recent votes of all of them come
+    from one memcache get_multi, and the rest from one multiget per vote rel.
+
+    """
     res = {}
 
     # check the prequeued_vote_keys
     keys = {}
-    for item in items:
-        if (user, item) in res:
+    for user, item in pairs:
+        if not user:
             continue
 
         key = prequeued_vote_key(user, item)
@@ -1494,7 +1707,8 @@ def get_likes(user, items):
                               else False if v == '-1'
                               else None)
 
-    for item in items:
+    to_fetch = []
+    for user, item in keys.itervalues():
         # already retrieved above
         if (user, item) in res:
             continue
@@ -1502,13 +1716,23 @@ def get_likes(user, items):
         # we can only vote on links and comments
         if not isinstance(item, (Link, Comment)):
             res[(user, item)] = None
+        else:
+            to_fetch.append((user, item))
 
-    likes = Vote.likes(user, [i for i in items if (user, i) not in res])
+    likes = Vote.likes_multi(to_fetch)
 
     res.update(likes)
 
     return res
 
+def get_vote_directions(users, items):
+    """The votes of each of the users on items, as a VoteDirections."""
+    directions = VoteDirections(items)
+    directions.update(get_likes_multi((user, item)
+                                      for user in users
+                                      for item in items))
+    return directions
+
 def handle_vote(user, thing, dir, ip, vote_info,
                 cheater=False, foreground=False, timer=None, date=None):
     if timer is None:
@@ -1557,11 +1781,23 @@ def handle_vote(user, thing, dir, ip, vote_info,
     timer.intermediate("last_modified")
 
 
+def _vote_stats_qname(qname):
+    if qname.startswith("vote_link"):
+        return "vote_link_q"
+    return qname
+
+def _vote_date(msg):
+    # Convert the naive timestamp we got from amqplib to a
+    # timezone aware one.
+    tt = mktime(msg.timestamp.timetuple())
+    return datetime.utcfromtimestamp(tt).replace(tzinfo=pytz.UTC)
+
 def process_votes(qname, limit=0):
     # limit is taken but ignored for backwards compatibility
-    stats_qname = qname
-    if stats_qname.startswith("vote_link"):
-        stats_qname = "vote_link_q"
+    if g.vote_batch_size > 1:
+        return process_votes_batched(qname, limit=g.vote_batch_size)
+
+    stats_qname = _vote_stats_qname(qname)
 
     @g.stats.amqp_processor(stats_qname)
     def _handle_vote(msg):
@@ -1576,10 +1812,7 @@ def process_votes(qname, limit=0):
         votee = Thing._by_fullname(tid, data = True)
         timer.intermediate("preamble")
 
-        # Convert the naive timestamp we got from amqplib to a
-        # timezone aware one.
-        tt = mktime(msg.timestamp.timetuple())
-        date = datetime.utcfromtimestamp(tt).replace(tzinfo=pytz.UTC)
+        date = _vote_date(msg)
 
         # I don't know how, but somebody is sneaking in votes
         # for subreddits
@@ -1599,3 +1832,90 @@ def process_votes(qname, limit=0):
         timer.flush()
 
     amqp.consume_items(qname, _handle_vote, verbose = False)
+
+def process_votes_batched(qname, limit=100):
+    """Like process_votes, but handles up to `limit` votes at a time.
+
+    The voters and votees for the whole batch are loaded with one _byID
+    each, changes to listings are merged and applied once per listing at
+    the end of the batch and the batch is acknowledged with a single ack.
+    A vote that fails is requeued on its own (or dropped, if it had already
+    been redelivered) without holding up the rest of the batch, and none
+    of its listing changes are applied. process_votes hands over to this
+    when vote_batch_size is set in the ini.
+    """
+    stats_qname = _vote_stats_qname(qname)
+
+    @g.stats.amqp_processor(stats_qname)
+    def _handle_votes(msgs, chan):
+        timer = stats.get_timer("service_time." + stats_qname)
+        timer.start()
+
+        def reject(msg):
+            redelivered = msg.delivery_info.get('redelivered')
+            g.log.exception("failed to process vote %r%s", msg.body,
+                            " (dropping it)" if redelivered else "")
+            chan.basic_reject(msg.delivery_tag, requeue=not redelivered)
+            stats.simple_event('vote.failed')
+
+        votes = []
+        for msg in msgs:
+            try:
+                votes.append((msg, pickle.loads(msg.body)))
+            except Exception:
+                reject(msg)
+
+        uids = list(set(r[0] for msg, r in votes))
+        tids = list(set(r[1] for msg, r in votes))
+        voters = Account._byID(uids, data=True, ignore_missing=True)
+        votees = Thing._by_fullname(tids, data=True, ignore_missing=True)
+        timer.intermediate("preamble")
+
+        batcher = CachedResultsBatcher(stats_qname, window=None)
+        comments = {}
+        last_ok = None
+        for msg, (uid, tid, dir, ip, vote_info, cheater) in votes:
+            # the vote's listing changes are kept to one side until it's
+            # gone through, so a vote that's requeued doesn't leave any
+            # behind to be applied twice
+            vote_changes = CachedResultsBatcher(stats_qname, window=None)
+            try:
+                voter = voters[uid]
+                votee = votees[tid]
+
+                # I don't know how, but somebody is sneaking in votes
+                # for subreddits
+                if isinstance(votee, (Link, Comment)):
+                    with batched_query_updates(vote_changes):
+                        handle_vote(voter, votee, dir, ip, vote_info,
+                                    cheater=cheater, foreground=True,
+                                    timer=timer, date=_vote_date(msg))
+            except Exception:
+                reject(msg)
+                continue
+
+            batcher.merge(vote_changes)
+            if isinstance(votee, Comment):
+                comments[votee._id] = votee
+            last_ok = msg.delivery_tag
+            stats.simple_event('vote.total')
+            if cheater:
+                stats.simple_event('vote.cheater')
+        timer.intermediate("votes")
+
+        batcher.flush()
+        timer.intermediate("permacache_flush")
+
+        if comments:
+            update_comment_votes(comments.values())
+            timer.intermediate("update_comment_votes")
+
+        if last_ok is not None:
+            # the failures have already been rejected, so this acks
+            # everything else at once
+            chan.basic_ack(last_ok, multiple=True)
+
+        timer.flush()
+
+    amqp.handle_items(qname, _handle_votes, limit=limit, ack=False,
+                      verbose=False)
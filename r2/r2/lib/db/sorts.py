@@ -22,3 +22,10 @@
 
 from r2.lib.db._sorts import epoch_seconds, score, hot, _hot
 from r2.lib.db._sorts import controversy, confidence
+from r2.lib.db._sorts import (
+    batch_available,
+    score_batch,
+    hot_batch,
+    controversy_batch,
+    confidence_batch,
+)
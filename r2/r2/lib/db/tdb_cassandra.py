@@ -29,6 +29,7 @@ from socket import gethostbyaddr
 from pylons import g
 
 from pycassa import ColumnFamily
+from pycassa.batch import Mutator
 from pycassa.pool import MaximumRetryException
 from pycassa.cassandra.ttypes import ConsistencyLevel, NotFoundException
 from pycassa.system_manager import (SystemManager, UTF8_TYPE,
@@ -37,11 +38,14 @@ from pycassa.system_manager import (SystemManager, UTF8_TYPE,
 from pycassa.types import DateType, LongType, IntegerType
 from r2.lib.utils import tup, Storage
 from r2.lib import cache
+from r2.lib.prefetch import LazyThreadPool
 from uuid import uuid1, UUID
 from itertools import chain
 import cPickle as pickle
 from pycassa.util import OrderedDict
 import base64
+from contextlib import contextmanager
+from threading import local
 
 connection_pools = g.cassandra_pools
 default_connection_pool = g.cassandra_default_pool
@@ -56,6 +60,7 @@ write_consistency_level = g.cassandra_wcl
 debug = g.debug
 make_lock = g.make_lock
 db_create_tables = g.db_create_tables
+column_fetch_fanout = g.cassandra_column_fetch_fanout
 
 thing_types = {}
 
@@ -108,6 +113,167 @@ def will_write(fn):
         return fn(*a, **kw)
     return _fn
 
+# threads for paging through the rest of wide rows, shared by every request
+# in the process so they hold no more than this many connections between them
+_column_fetch_pool = LazyThreadPool(lambda: column_fetch_fanout)
+
+def run_concurrently(fns, max_workers):
+    """Call each of fns in up to max_workers of the process's column fetch
+       threads and return their results in the same order. The first
+       exception raised by any of them is re-raised here once they've all
+       finished."""
+    return _column_fetch_pool.run(fns, max_workers)
+
+def get_column_range(cf, key, column_start='', column_finish='',
+                     page_size=max_column_count):
+    """All of the columns of a row between column_start and column_finish
+       (inclusive), fetched page_size at a time."""
+    columns = OrderedDict()
+    while True:
+        try:
+            page = cf.get(key, column_start=column_start,
+                          column_finish=column_finish,
+                          column_count=page_size)
+        except NotFoundException:
+            break
+        columns.update(page)
+        if len(page) < page_size:
+            break
+        # the start is inclusive so the next page repeats this column
+        column_start = next(reversed(page))
+    return columns
+
+def get_column_ranges(cf, ranges, page_size=max_column_count,
+                      max_workers=None):
+    """get_column_range for each (key, column_start, column_finish) in
+       ranges, with up to max_workers ranges being paged through at once.
+
+       Fetching the rest of several wide rows (or several slices of one)
+       like this costs about as much latency as fetching the longest one
+       rather than all of them back to back."""
+    if max_workers is None:
+        max_workers = column_fetch_fanout
+    fns = [(lambda r=r: get_column_range(cf, *r, page_size=page_size))
+           for r in ranges]
+    return run_concurrently(fns, max_workers)
+
+class CommitBatch(object):
+    """Writes for many objects, collected to be sent together.
+
+       Objects are committed batch_size at a time: their columns go out
+       as multi-row mutations (one per connection pool and consistency
+       level) and they're put in the thing_cache with a single set_multi.
+       Rows written with View._set_values are batched the same way."""
+
+    def __init__(self, batch_size=100, write_consistency_level=None):
+        self.batch_size = batch_size
+        self.write_consistency_level = write_consistency_level
+        self.things = OrderedDict()
+        self.values = []
+        self.flushing = False
+
+    def __len__(self):
+        return len(self.things) + len(self.values)
+
+    def add(self, thing, write_consistency_level=None):
+        """Commit thing with the next batch"""
+        wcl = write_consistency_level or self.write_consistency_level
+        # committing the same object twice only needs one write
+        self.things[id(thing)] = (thing, wcl)
+        self._maybe_flush()
+
+    def set_values(self, cls, row_key, columns, ttl=None,
+                   write_consistency_level=None):
+        """View._set_values with the next batch. columns must already be
+           serialized"""
+        wcl = write_consistency_level or self.write_consistency_level
+        self.values.append((cls, row_key, columns, ttl, wcl))
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if len(self) >= self.batch_size and not self.flushing:
+            self.flush()
+
+    def flush(self):
+        self.flushing = True
+        try:
+            # the _on_create/_on_commit hooks can commit more objects,
+            # which are picked up by the next time around
+            while self.things or self.values:
+                things, self.things = self.things.values(), OrderedDict()
+                values, self.values = self.values, []
+                self._write(things, values)
+        finally:
+            self.flushing = False
+
+    def _write(self, things, values):
+        mutators = {}
+
+        def get_mutator(cls, wcl):
+            wcl = cls._wcl(wcl)
+            key = (cls._cf.pool, wcl)
+            if key not in mutators:
+                mutators[key] = Mutator(cls._cf.pool,
+                                        queue_size=self.batch_size,
+                                        write_consistency_level=wcl)
+            return mutators[key]
+
+        written = []
+        for thing, wcl in things:
+            changes = thing._prepare_commit()
+            if changes is None:
+                continue
+            inserts, deletes = changes
+            m = get_mutator(thing.__class__, wcl)
+            for columns, ttl in inserts:
+                m.insert(thing._cf, thing._id, columns, ttl=ttl)
+            if deletes:
+                m.remove(thing._cf, thing._id, deletes)
+            written.append(thing)
+
+        for cls, row_key, columns, ttl, wcl in values:
+            m = get_mutator(cls, wcl)
+            for k, v in columns.iteritems():
+                m.insert(cls._cf, row_key, {k: v},
+                         ttl=cls._default_ttls.get(k, ttl))
+
+        for m in mutators.itervalues():
+            m.send()
+
+        for thing in written:
+            thing._finish_commit()
+
+        if written:
+            thing_cache.set_multi(dict((thing._cache_key(), thing)
+                                       for thing in written))
+        if values:
+            thing_cache.delete_multi(set(cls._cache_key_id(row_key)
+                                         for cls, row_key, c, t, w in values))
+
+_commit_batches = local()
+
+def current_commit_batch():
+    return getattr(_commit_batches, 'batch', None)
+
+@contextmanager
+def batched_commits(batch_size=100, write_consistency_level=None):
+    """Collect the _commit and View._set_values writes made on this thread
+       into a CommitBatch for the duration of the block.
+
+       Nothing written in the block is in Cassandra or the thing_cache
+       until its batch is flushed, which happens every batch_size objects
+       and when the block exits. If the block raises, anything not yet
+       flushed is dropped."""
+    commit_batch = CommitBatch(batch_size=batch_size,
+                               write_consistency_level=write_consistency_level)
+    previous = current_commit_batch()
+    _commit_batches.batch = commit_batch
+    try:
+        yield commit_batch
+        commit_batch.flush()
+    finally:
+        _commit_batches.batch = previous
+
 def get_manager(seeds):
     # n.b. does not retry against multiple servers
     server = seeds[0]
@@ -369,13 +535,12 @@ class ThingBase(object):
                 # probably clipped. in this case, we should fetch the remaining
                 # columns for that row and add them to the result.
                 if cls._fetch_all_columns:
-                    for key, row in rows.iteritems():
-                        if len(row) == max_column_count:
-                            last_column_seen = next(reversed(row))
-                            cols = cls._cf.xget(key,
-                                                column_start=last_column_seen,
-                                                buffer_size=max_column_count)
-                            row.update(cols)
+                    clipped = [(key, next(reversed(row)), '')
+                               for key, row in rows.iteritems()
+                               if len(row) == max_column_count]
+                    remainders = get_column_ranges(cls._cf, clipped)
+                    for (key, start, finish), cols in zip(clipped, remainders):
+                        rows[key].update(cols)
             else:
                 rows = cls._cf.multiget(l_ids, columns = willask_properties)
 
@@ -555,8 +720,34 @@ class ThingBase(object):
 
     @will_write
     def _commit(self, write_consistency_level = None):
-        if not self._dirty:
+        commit_batch = current_commit_batch()
+        if commit_batch is not None:
+            commit_batch.add(self, write_consistency_level)
+            return
+
+        changes = self._prepare_commit()
+        if changes is None:
             return
+        inserts, deletes = changes
+
+        # actually write out the changes to the CF
+        wcl = self._wcl(write_consistency_level)
+        with self._cf.batch(write_consistency_level = wcl) as b:
+            for columns, ttl in inserts:
+                b.insert(self._id, columns, ttl=ttl)
+            if deletes:
+                b.remove(self._id, deletes)
+
+        self._finish_commit()
+
+        thing_cache.set(self._cache_key(), self)
+
+    def _prepare_commit(self):
+        """Work out what _commit needs to write. Returns a list of
+           (columns, ttl) to insert and a set of columns to remove, or
+           None if there's nothing to write"""
+        if not self._dirty:
+            return None
 
         if self._id is None:
             raise TdbException("Can't commit %r without an ID" % (self,))
@@ -607,19 +798,18 @@ class ThingBase(object):
 
         if not updates and not self._deletes:
             self._dirties.clear()
-            return
+            return None
 
-        # actually write out the changes to the CF
-        wcl = self._wcl(write_consistency_level)
-        with self._cf.batch(write_consistency_level = wcl) as b:
-            if updates:
-                for k, v in updates.iteritems():
-                    b.insert(self._id,
-                             {k: v},
-                             ttl=self._column_ttls.get(k, self._ttl))
-            if self._deletes:
-                b.remove(self._id, self._deletes)
+        by_ttl = {}
+        for k, v in updates.iteritems():
+            ttl = self._column_ttls.get(k, self._ttl)
+            by_ttl.setdefault(ttl, {})[k] = v
+        inserts = [(columns, ttl) for ttl, columns in by_ttl.iteritems()]
+
+        return inserts, set(self._deletes)
 
+    def _finish_commit(self):
+        """Update our state once _commit's changes have been written"""
         self._orig.update(self._dirties)
         self._column_ttls.clear()
         self._dirties.clear()
@@ -637,8 +827,6 @@ class ThingBase(object):
 
         self._committed = True
 
-        thing_cache.set(self._cache_key(), self)
-
     def _revert(self):
         if not self._committed:
             raise TdbException("Revert to what?")
@@ -953,6 +1141,60 @@ class DenormalizedRelation(object):
                 raise NotFound("<%s %r>" % (cls.__name__, (thing1._id36,
                                                            thing2._id36)))
 
+    @classmethod
+    def fast_query_multi(cls, pairs):
+        """Find relationships for many (thing1, thing2) pairs at once.
+
+        Like fast_query, but for any number of thing1s: their rows are read
+        with a single multiget (and a single last modified lookup).
+        Returns {(thing1, thing2): value} for the pairs that have one.
+
+        """
+        thing2s_by_thing1 = {}
+        thing1s = {}
+        for thing1, thing2 in pairs:
+            if not thing1:
+                continue
+            thing1s[thing1._id36] = thing1
+            thing2s = thing2s_by_thing1.setdefault(thing1._id36, {})
+            thing2s[thing2._id36] = thing2
+
+        if cls._last_modified_name and thing1s:
+            from r2.models.last_modified import LastModified
+            fullnames = {thing1._fullname: id36
+                         for id36, thing1 in thing1s.iteritems()}
+            timestamps = LastModified.get_multi(fullnames.keys(),
+                                                cls._last_modified_name)
+            for fullname, id36 in fullnames.iteritems():
+                timestamp = timestamps.get(fullname)
+                thing2s = thing2s_by_thing1[id36]
+                for thing2_id36, thing2 in thing2s.items():
+                    if not timestamp or thing2._date > timestamp:
+                        del thing2s[thing2_id36]
+
+        thing2s_by_thing1 = {id36: thing2s
+                             for id36, thing2s in thing2s_by_thing1.iteritems()
+                             if thing2s}
+        if not thing2s_by_thing1:
+            return {}
+
+        columns = set()
+        for thing2s in thing2s_by_thing1.itervalues():
+            columns.update(thing2s)
+        rows = cls._cf.multiget(thing2s_by_thing1.keys(), columns=list(columns))
+
+        # the union of the columns was fetched for every row, so only keep
+        # the pairs that were asked for
+        res = {}
+        for id36, results in rows.iteritems():
+            thing1 = thing1s[id36]
+            thing2s = thing2s_by_thing1[id36]
+            for column, value in results.iteritems():
+                thing2 = thing2s.get(column)
+                if thing2 is not None:
+                    res[(thing1, thing2)] = value
+        return res
+
 
 class ColumnQuery(object):
     """
@@ -1330,9 +1572,16 @@ class View(ThingBase):
         # there is a default set on either the row or the column
         default_ttl = ttl or cls._ttl
 
+        commit_batch = current_commit_batch()
+        if commit_batch is not None:
+            commit_batch.set_values(cls, row_key, updates, default_ttl,
+                                    write_consistency_level)
+            return
+
         with cls._cf.batch(write_consistency_level = cls._wcl(write_consistency_level)) as b:
             # with some quick tweaks we could have a version that
-            # operates across multiple row keys, but this is not it
+            # operates across multiple row keys, but this is not it (see
+            # CommitBatch for that)
             for k, v in updates.iteritems():
                 b.insert(row_key, {k: v},
                          ttl=cls._default_ttls.get(k, default_ttl))
@@ -24,6 +24,7 @@ from __future__ import with_statement
 
 import new, sys
 import hashlib
+import heapq
 from datetime import datetime
 from copy import copy, deepcopy
 
@@ -207,6 +208,8 @@ class DataThing(object):
     def _cache_myself(self):
         ck = self._cache_key()
         cache.set(ck, self)
+        if g.process_cache:
+            g.process_cache.publish_invalidation([ck])
 
     def _sync_latest(self):
         """Load myself from the cache to and re-apply the .dirties
@@ -403,8 +406,12 @@ class DataThing(object):
 
             return items
 
+        # concurrent misses on a hot thing share one trip to the database.
+        # with sgm_leases that extends to the other app processes too.
+        lease_cache = g.lock_cache if g.sgm_leases else None
         bases = sgm(cache, ids, items_db, prefix, stale=stale,
-                    found_fn=count_found)
+                    found_fn=count_found, single_flight=True,
+                    lease_cache=lease_cache)
 
         # Check to see if we found everything we asked for
         missing = []
@@ -1158,61 +1165,123 @@ class MultiCursor(object):
 
         return [i for i in self._cursor]
 
+class _Descending(object):
+    """Wraps a value so that it sorts in reverse, for descending sort
+    columns."""
+    __slots__ = ('val',)
+
+    def __init__(self, val):
+        self.val = val
+
+    def __lt__(self, other):
+        if not isinstance(other, _Descending):
+            return NotImplemented
+        return other.val < self.val
+
+    def __eq__(self, other):
+        if not isinstance(other, _Descending):
+            return NotImplemented
+        return self.val == other.val
+
+    def __ne__(self, other):
+        if not isinstance(other, _Descending):
+            return NotImplemented
+        return self.val != other.val
+
+
 class MergeCursor(MultiCursor):
+    """Merges cursors that are each already in `sorts` order.
+
+    The next row is picked by the first sort column whose value isn't the
+    same for every cursor's current row: the row with the best value for
+    that column, from the earliest cursor if there's a tie. If all of the
+    columns are the same, the earliest cursor's row goes first.
+
+    Each column keeps a heap of the current rows' values and a count of
+    the distinct ones, so a row costs O(columns * log cursors) instead of
+    a scan of every cursor.
+    """
     def _execute(self, cursors, sorts):
-        #a "pair" is a (cursor, item, done) tuple
+        cols = [(s.col, not isinstance(s, operators.asc)) for s in sorts or ()]
+
         def safe_next(c):
+            #hack to keep searching even if fetching a thing returns notfound
+            while True:
+                try:
+                    return c.fetchone()
+                except NotFound:
+                    #skips the broken item
+                    pass
+
+        # the current row of each cursor (None once it's done), and how
+        # many rows it's had so that old heap entries can be told apart
+        heads = [None] * len(cursors)
+        seqs = [0] * len(cursors)
+        live = range(len(cursors))
+        # for each column, a heap of (value, cursor index, seq) and
+        # value -> how many of the current rows have it
+        heaps = [[] for col in cols]
+        counts = [{} for col in cols]
+
+        def push(heap, desc, val, i):
+            # the index breaks ties in favour of the earlier query and
+            # keeps the comparison from ever reaching the seqs
+            heapq.heappush(heap, (_Descending(val) if desc else val,
+                                  i, seqs[i]))
+
+        def advance(i):
+            if heads[i] is not None:
+                for (col, desc), count in zip(cols, counts):
+                    val = getattr(heads[i], col)
+                    count[val] -= 1
+                    if not count[val]:
+                        del count[val]
+
             try:
-                #hack to keep searching even if fetching a thing returns notfound
-                while True:
-                    try:
-                        return [c, c.fetchone(), False]
-                    except NotFound:
-                        #skips the broken item
-                        pass
+                heads[i] = item = safe_next(cursors[i])
             except StopIteration:
-                return c, None, True
-
-        def undone(pairs):
-            return [p for p in pairs if not p[2]]
-
-        pairs = undone(safe_next(c) for c in cursors)
-
-        while pairs:
-            #only one query left, just dump it
-            if len(pairs) == 1:
-                c, item, done = pair = pairs[0]
-                while not done:
-                    yield item
-                    c, item, done = safe_next(c)
-                    pair[:] = c, item, done
-            else:
-                #by default, yield the first item
-                yield_pair = pairs[0]
-                for s in sorts:
-                    col = s.col
-                    #sort direction?
-                    max_fn = min if isinstance(s, operators.asc) else max
-
-                    #find the max (or min) val
-                    vals = [(getattr(i[1], col), i) for i in pairs]
-                    max_pair = vals[0]
-                    all_equal = True
-                    for pair in vals[1:]:
-                        if all_equal and pair[0] != max_pair[0]:
-                            all_equal = False
-                        max_pair = max_fn(max_pair, pair, key=lambda x: x[0])
-
-                    if not all_equal:
-                        yield_pair = max_pair[1]
-                        break
-
-                c, item, done = yield_pair
+                heads[i] = None
+                live.remove(i)
+                return
+            seqs[i] += 1
+
+            for (col, desc), heap, count in zip(cols, heaps, counts):
+                val = getattr(item, col)
+                count[val] = count.get(val, 0) + 1
+                if len(heap) > 2 * len(cursors):
+                    # columns that haven't been needed pile up old entries
+                    del heap[:]
+                    for j in live:
+                        if j != i and heads[j] is not None:
+                            push(heap, desc, getattr(heads[j], col), j)
+                push(heap, desc, val, i)
+
+        for i in list(live):
+            advance(i)
+
+        while len(live) > 1:
+            i = live[0]
+            for heap, count in zip(heaps, counts):
+                if len(count) > 1:
+                    while True:
+                        val, i, seq = heap[0]
+                        if heads[i] is not None and seqs[i] == seq:
+                            break
+                        heapq.heappop(heap)
+                    break
+            yield heads[i]
+            advance(i)
+
+        #only one query left, just dump it
+        if live:
+            i = live[0]
+            item = heads[i]
+            while True:
                 yield item
-                yield_pair[:] = safe_next(c)
-
-            pairs = undone(pairs)
-        raise StopIteration
+                try:
+                    item = safe_next(cursors[i])
+                except StopIteration:
+                    break
 
 class MultiQuery(Query):
     def __init__(self, queries, *rules, **kw):
@@ -21,6 +21,7 @@
 ###############################################################################
 
 import cgi
+import hashlib
 import os
 import urllib
 import re
@@ -30,8 +31,6 @@ from collections import Counter
 import snudown
 from cStringIO import StringIO
 
-from xml.sax.handler import ContentHandler
-from lxml.sax import saxify
 import lxml.etree
 from BeautifulSoup import BeautifulSoup, Tag
 
@@ -153,26 +152,44 @@ valid_link_schemes = (
     'ts3server://',
 )
 
-class SouptestSaxHandler(ContentHandler):
+class SouptestTarget(object):
+    """An lxml parser target that checks each tag as it's parsed.
+
+    This way the document is checked in the same pass that parses it, without
+    building a tree to walk afterwards.
+
+    """
     def __init__(self, ok_tags):
         self.ok_tags = ok_tags
 
-    def startElementNS(self, tagname, qname, attrs):
-        if qname not in self.ok_tags:
-            raise ValueError('HAX: Unknown tag: %r' % qname)
+    def start(self, tagname, attrs):
+        if tagname.startswith('{'):
+            raise ValueError('HAX: Unknown namespace? Seriously? %r' % tagname)
 
-        for (ns, name), val in attrs.items():
-            if ns is not None:
-                raise ValueError('HAX: Unknown namespace? Seriously? %r' % ns)
+        if tagname not in self.ok_tags:
+            raise ValueError('HAX: Unknown tag: %r' % tagname)
 
-            if name not in self.ok_tags[qname]:
+        for name, val in attrs.iteritems():
+            if name.startswith('{'):
+                raise ValueError('HAX: Unknown namespace? Seriously? %r' % name)
+
+            if name not in self.ok_tags[tagname]:
                 raise ValueError('HAX: Unknown attribute-name %r' % name)
 
-            if qname == 'a' and name == 'href':
+            if tagname == 'a' and name == 'href':
                 lv = val.lower()
                 if not any(lv.startswith(scheme) for scheme in valid_link_schemes):
                     raise ValueError('HAX: Unsupported link scheme %r' % val)
 
+    def end(self, tagname):
+        pass
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        pass
+
 markdown_ok_tags = {
     'div': ('class'),
     'a': set(('href', 'title', 'target', 'nofollow', 'rel')),
@@ -212,31 +229,123 @@ def markdown_souptest(text, nofollow=False, target=None, renderer='reddit'):
     smd_with_dtd = markdown_dtd + smd
 
     s = StringIO(smd_with_dtd)
-    parser = lxml.etree.XMLParser(load_dtd=True)
-    tree = lxml.etree.parse(s, parser)
-    handler = SouptestSaxHandler(markdown_ok_tags)
-    saxify(tree, handler)
+    parser = lxml.etree.XMLParser(load_dtd=True,
+                                  target=SouptestTarget(markdown_ok_tags))
+    lxml.etree.parse(s, parser)
 
     return smd
 
-#TODO markdown should be looked up in batch?
-#@memoize('markdown')
-def safemarkdown(text, nofollow=False, wrap=True, **kwargs):
-    if not text:
-        return None
+# rendered markdown is kept in the rendercache under a hash of everything
+# that goes into rendering it, so it never needs invalidating.
+MARKDOWN_CACHE_TIME = 24 * 60 * 60
+MARKDOWN_CACHE_PREFIX = "md%s-" % getattr(snudown, "__version__", "")
+
+def _markdown_key(text, nofollow, target, renderer="reddit"):
+    h = hashlib.sha1(text)
+    h.update("\0%d\0%s\0%s" % (bool(nofollow), target or "", renderer))
+    return h.hexdigest()
+
+def _request_dict(name):
+    """A dict kept on c for the rest of the request, or None outside one."""
+    try:
+        d = getattr(c, name, None)
+        if not isinstance(d, dict):
+            d = {}
+            setattr(c, name, d)
+    except TypeError:
+        # not in a request
+        d = None
+    return d
+
+def _markdown_renders():
+    """The markdown renders that have been looked up for this request."""
+    return _request_dict("markdown_renders")
 
+def _markdown_pending():
+    """The texts prefetch_markdown was given that haven't been looked up."""
+    return _request_dict("markdown_pending")
+
+def _markdown_target(kwargs):
     # this lets us skip the c.cname lookup (which is apparently quite
     # slow) if target was explicitly passed to this function.
     target = kwargs.get("target", None)
     if "target" not in kwargs and c.cname:
         target = "_top"
+    return target
+
+def prefetch_markdown(texts):
+    """Get the rendered markdown for many texts ready for safemarkdown.
 
-    text = snudown.markdown(_force_utf8(text), nofollow, target)
+    texts is a list of (text, nofollow, target) as they'll be passed to
+    safemarkdown. Nothing is looked up until safemarkdown is asked for one
+    of them, since what's being wrapped isn't always rendered (a page that
+    comes from the pagecache, say). Then all of their renders are looked up
+    in the rendercache in one go, and the ones that aren't there are
+    rendered and stored.
+
+    """
+    renders = _markdown_renders()
+    if renders is None:
+        return
+
+    pending = _markdown_pending()
+    for text, nofollow, target in texts:
+        if not text:
+            continue
+        text = _force_utf8(text)
+        key = _markdown_key(text, nofollow, target)
+        if key not in renders:
+            pending[key] = (text, nofollow, target)
+
+def _load_markdown(renders, pending):
+    """Look up (or render and store) everything that's pending."""
+    by_key = dict(pending)
+    pending.clear()
+
+    timer = g.stats.get_timer("markdown")
+    timer.start()
+    found = g.rendercache.get_multi(by_key.keys(),
+                                    prefix=MARKDOWN_CACHE_PREFIX)
+    renders.update(found)
+    timer.intermediate("lookup")
+
+    rendered = {}
+    for key, (text, nofollow, target) in by_key.iteritems():
+        if key not in found:
+            rendered[key] = snudown.markdown(text, nofollow, target)
+    timer.intermediate("render")
+
+    if rendered:
+        renders.update(rendered)
+        g.rendercache.set_multi(rendered, prefix=MARKDOWN_CACHE_PREFIX,
+                                time=MARKDOWN_CACHE_TIME)
+    timer.stop()
+    g.stats.cache_count_multi({"markdown.hit": len(found),
+                               "markdown.miss": len(rendered)})
+
+def safemarkdown(text, nofollow=False, wrap=True, **kwargs):
+    if not text:
+        return None
+
+    target = _markdown_target(kwargs)
+    text = _force_utf8(text)
+
+    renders = _markdown_renders()
+    pending = _markdown_pending()
+    html = None
+    if renders or pending:
+        key = _markdown_key(text, nofollow, target)
+        html = renders.get(key)
+        if html is None and key in pending:
+            _load_markdown(renders, pending)
+            html = renders.get(key)
+    if html is None:
+        html = snudown.markdown(text, nofollow, target)
 
     if wrap:
-        return SC_OFF + MD_START + text + MD_END + SC_ON
+        return SC_OFF + MD_START + html + MD_END + SC_ON
     else:
-        return SC_OFF + text + SC_ON
+        return SC_OFF + html + SC_ON
 
 def wikimarkdown(text, include_toc=True, target=None):
     from r2.lib.template_helpers import media_https_if_secure
@@ -245,41 +354,162 @@ def wikimarkdown(text, include_toc=True, target=None):
     # in the future to allow per-page images.
     from r2.models.wiki import ImagesByWikiPage
     page_images = ImagesByWikiPage.get_images(c.site, "config/stylesheet")
-    
-    def img_swap(tag):
-        name = tag.get('src')
-        name = custom_img_url.search(name)
+
+    def img_swap(src):
+        name = src and custom_img_url.search(src)
         name = name and name.group(1)
         if name and name in page_images:
-            url = page_images[name]
-            url = media_https_if_secure(url)
-            tag['src'] = url
-        else:
-            tag.extract()
-    
+            return media_https_if_secure(page_images[name])
+
     nofollow = True
-    
+
     text = snudown.markdown(_force_utf8(text), nofollow, target,
                             renderer=snudown.RENDERER_WIKI)
-    
-    # TODO: We should test how much of a load this adds to the app
-    soup = BeautifulSoup(text.decode('utf-8'))
-    images = soup.findAll('img')
-    
-    if images:
-        [img_swap(image) for image in images]
-    
-    if include_toc:
-        tocdiv = generate_table_of_contents(soup, prefix="wiki")
-        if tocdiv:
-            soup.insert(0, tocdiv)
-    
-    text = str(soup)
-    
+
+    text = wiki_postprocess(text.decode('utf-8'), img_swap,
+                            include_toc=include_toc, prefix="wiki")
+    text = text.encode('utf-8')
+
     return SC_OFF + WIKI_MD_START + text + WIKI_MD_END + SC_ON
 
+html_tag_re = re.compile(r"""<(/?)([a-zA-Z][a-zA-Z0-9]*)"""
+                         r"""((?:[^>"']|"[^"]*"|'[^']*')*)>""")
+src_attr_re = re.compile(r"""\ssrc\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+id_attr_re = re.compile(r"""\sid\s*=\s*(?:"[^"]*"|'[^']*')""")
+char_ref_re = re.compile(r'&(#[0-9]+|quot|apos);')
+
+def _decode_header_text(text):
+    """Decode the character references in a header's text for its id.
+
+    This decodes them the way BeautifulSoup (with XML_ENTITIES) used to, so
+    that the ids, and links to them, stay the same: numeric references and
+    &quot; and &apos; are decoded, but &, < and > are left escaped.
+
+    """
+    def replace(m):
+        ref = m.group(1)
+        if ref == 'quot':
+            return u'"'
+        elif ref == 'apos':
+            return u"'"
+        try:
+            char = unichr(int(ref[1:]))
+        except ValueError:
+            return m.group(0)
+        return cgi.escape(char)
+    return char_ref_re.sub(replace, text)
+
+def wiki_postprocess(html, img_swap, include_toc=True, prefix="wiki"):
+    """Swap the images in rendered wiki markdown and add a table of contents.
+
+    This makes one pass over snudown's output (which we know to be well
+    formed), looking only at the tags, instead of parsing it into a tree.
+    img_swap(src) returns the url to show an image with, or None to drop it.
+    With include_toc, each header gets an id and a table of contents of the
+    headers is put at the start, as generate_table_of_contents does.
+
+    """
+    out = []
+    # (index of the opening tag in out, level, pieces of the header's text)
+    headers = []
+    header = None
+    pos = 0
+    for m in html_tag_re.finditer(html):
+        text = html[pos:m.start()]
+        out.append(text)
+        if header:
+            header[2].append(text)
+        pos = m.end()
+
+        tag = m.group(0)
+        closing, name, attrs = m.groups()
+        name = name.lower()
+        if name == 'img':
+            src = src_attr_re.search(attrs)
+            url = src and img_swap(src.group(1) if src.group(1) is not None
+                                   else src.group(2))
+            if url:
+                tag = tag.replace(src.group(0),
+                                  u' src="%s"' % cgi.escape(url, True), 1)
+            else:
+                tag = u''
+        elif include_toc and header_re.match(name):
+            if not closing:
+                header = (len(out), int(name[1]), [])
+            elif header:
+                headers.append(header)
+                header = None
+        out.append(tag)
+    out.append(html[pos:])
+
+    if include_toc:
+        header_ids = Counter()
+        toc = []
+        for i, level, pieces in headers:
+            contents = u''.join(pieces)
+            # In the event of an empty header, skip
+            if not contents:
+                continue
+            aid = _header_id(contents, prefix, header_ids)
+            tag = id_attr_re.sub(u'', out[i])
+            out[i] = u'%s id="%s">' % (tag[:-1], aid)
+            toc.append((level, aid, contents))
+        if toc:
+            out.insert(0, _toc_html(toc))
+
+    return u''.join(out)
+
 title_re = re.compile('[^\w.-]')
 header_re = re.compile('^h[1-6]$')
+
+def _header_id(contents, prefix, header_ids):
+    """A unique id for a header, from its text."""
+    # Convert html entities to avoid ugly header ids
+    aid = _decode_header_text(contents)
+    # Prefix with PREFIX_ to avoid ID conflict with the rest of the page
+    aid = u'%s_%s' % (prefix, aid.replace(" ", "_").lower())
+    # Convert down to ascii replacing special characters with hex
+    aid = str(title_re.sub(lambda c: '.%X' % ord(c.group()), aid))
+
+    # Check to see if a tag with the same ID exists
+    id_num = header_ids[aid] + 1
+    header_ids[aid] += 1
+    # Only start numbering ids with the second instance of an id
+    if id_num > 1:
+        aid = '%s%d' % (aid, id_num)
+    return aid
+
+def _toc_html(toc):
+    """The table of contents for a list of (level, id, contents) headers."""
+    class TocList(list):
+        def __init__(self, level, parent=None):
+            self.level = level
+            self.parent = parent
+
+        def __unicode__(self):
+            return u'<ul>%s</ul>' % u''.join(unicode(i) for i in self)
+
+    parent = root = TocList(0)
+    level = 0
+    previous = 0
+    for thislevel, aid, contents in toc:
+        li = u'<li class="%s"><a href="#%s">%s</a></li>' % (aid, aid, contents)
+
+        if previous and thislevel > previous:
+            newul = TocList(thislevel, parent)
+            parent.append(newul)
+            parent = newul
+            level += 1
+        elif level and thislevel < previous:
+            while level and parent.level > thislevel:
+                parent = parent.parent
+                level -= 1
+
+        previous = thislevel
+        parent.append(li)
+
+    return u'<div class="toc">%s</div>' % unicode(root)
+
 def generate_table_of_contents(soup, prefix):
     header_ids = Counter()
     headers = soup.findAll(header_re)
@@ -297,21 +527,8 @@ def generate_table_of_contents(soup, prefix):
         # In the event of an empty header, skip
         if not contents:
             continue
-        
-        # Convert html entities to avoid ugly header ids
-        aid = unicode(BeautifulSoup(contents, convertEntities=BeautifulSoup.XML_ENTITIES))
-        # Prefix with PREFIX_ to avoid ID conflict with the rest of the page
-        aid = u'%s_%s' % (prefix, aid.replace(" ", "_").lower())
-        # Convert down to ascii replacing special characters with hex
-        aid = str(title_re.sub(lambda c: '.%X' % ord(c.group()), aid))
-        
-        # Check to see if a tag with the same ID exists
-        id_num = header_ids[aid] + 1
-        header_ids[aid] += 1
-        # Only start numbering ids with the second instance of an id
-        if id_num > 1:
-            aid = '%s%d' % (aid, id_num)
-        
+
+        aid = _header_id(contents, prefix, header_ids)
         header['id'] = aid
         
         li = Tag(soup, "li", [("class", aid)])
@@ -20,9 +20,8 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-import cStringIO
-import gzip
 import wsgiref.headers
+import zlib
 
 from paste.util.mimeparse import parse_mime_type, desired_matches
 
@@ -39,6 +38,37 @@ ENCODABLE_CONTENT_TYPES = {
     "text/xml",
 }
 
+# have zlib write a gzip header and trailer around the deflate stream
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# where the middleware and the app pass precompressed bodies to each other
+PRECOMPRESS_ENVIRON_KEY = "r2.gzip.precompress"
+PRECOMPRESSED_ENVIRON_KEY = "r2.gzip.precompressed"
+
+
+def gzip_chunks(chunks, compression_level):
+    """Yield the gzip-compressed form of an iterable of strings."""
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED,
+                                  GZIP_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def parse_content_type_levels(value):
+    """Parse "text/html:6, application/json:4" into a dict of levels."""
+    levels = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        content_type, sep, level = item.rpartition(":")
+        if not sep:
+            raise ValueError("expected content-type:level, got %r" % item)
+        levels[content_type.strip()] = int(level)
+    return levels
+
 
 class GzipMiddleware(object):
     """A middleware that transparently compresses content with gzip.
@@ -53,12 +83,31 @@ class GzipMiddleware(object):
     None of these are an issue for the reddit application, but use at your
     own risk.
 
+    Responses that are served many times (i.e. from the pagecache) can be
+    compressed once, ahead of time: the middleware puts a function in the
+    environ under PRECOMPRESS_ENVIRON_KEY which the app can call with a
+    response's headers and body to get a precompressed body to store with
+    it. When the app serves that body again it puts the precompressed body
+    in the environ under PRECOMPRESSED_ENVIRON_KEY and the middleware sends
+    it as is. Since that work is shared by every hit, it's done at
+    precompress_level rather than the (cheaper) per-response level.
+
+    Bodies of at least stream_min_size bytes are compressed as they're sent
+    rather than all at once up front.
+
     """
 
-    def __init__(self, app, compression_level, min_size):
+    def __init__(self, app, compression_level, min_size,
+                 precompress_level=None, stream_min_size=0,
+                 content_type_levels=None):
         self.app = app
         self.compression_level = compression_level
         self.min_size = min_size
+        if precompress_level is None:
+            precompress_level = compression_level
+        self.precompress_level = precompress_level
+        self.stream_min_size = stream_min_size
+        self.content_type_levels = content_type_levels or {}
 
     def _start_response(self, status, response_headers, exc_info=None):
         self.status = status
@@ -147,7 +196,39 @@ class GzipMiddleware(object):
         accept_encoding = environ.get("HTTP_ACCEPT_ENCODING", "identity")
         return "gzip" in desired_matches(["gzip"], accept_encoding)
 
+    def compression_level_for(self, headers):
+        type, subtype, params = parse_mime_type(headers["Content-Type"])
+        return self.content_type_levels.get("%s/%s" % (type, subtype),
+                                            self.compression_level)
+
+    def precompress(self, response_headers, body):
+        """Compress a response body ahead of time to be served again later.
+
+        Returns None if the response wouldn't be compressed anyway. The
+        result is opaque; to serve it, put it in the environ under
+        PRECOMPRESSED_ENVIRON_KEY when returning the same body.
+
+        """
+        headers = wsgiref.headers.Headers(list(response_headers))
+        if not self.should_gzip_response(headers, [body]):
+            return None
+        compressed = "".join(gzip_chunks([body], self.precompress_level))
+        return len(body), compressed
+
+    @staticmethod
+    def close_app_iter(app_iter):
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+
+    def stream_gzipped(self, app_iter, compression_level):
+        try:
+            for chunk in gzip_chunks(app_iter, compression_level):
+                yield chunk
+        finally:
+            self.close_app_iter(app_iter)
+
     def __call__(self, environ, start_response):
+        environ[PRECOMPRESS_ENVIRON_KEY] = self.precompress
         app_iter = self.app(environ, self._start_response)
         headers = wsgiref.headers.Headers(self.headers)
 
@@ -161,22 +242,30 @@ class GzipMiddleware(object):
         if response_compressible and self.request_accepts_gzip(environ):
             headers["Content-Encoding"] = "gzip"
 
-            response_buffer = cStringIO.StringIO()
-            gzipper = gzip.GzipFile(fileobj=response_buffer, mode="wb",
-                                    compresslevel=self.compression_level)
-            try:
-                for chunk in app_iter:
-                    gzipper.write(chunk)
-            finally:
-                if hasattr(app_iter, "close"):
-                    app_iter.close()
-
-            gzipper.close()
-            new_response = response_buffer.getvalue()
-            encoded_app_iter = [new_response]
-            response_buffer.close()
-
-            headers["Content-Length"] = str(len(new_response))
+            content_length = self.content_length(headers, app_iter)
+            precompressed = environ.get(PRECOMPRESSED_ENVIRON_KEY)
+            compression_level = self.compression_level_for(headers)
+
+            # the precompressed body is only good if the app is still
+            # sending the body it was made from; the length is a cheap check
+            if precompressed and precompressed[0] == content_length:
+                self.close_app_iter(app_iter)
+                new_response = precompressed[1]
+                encoded_app_iter = [new_response]
+                headers["Content-Length"] = str(len(new_response))
+            elif (self.stream_min_size and
+                  content_length >= self.stream_min_size):
+                del headers["Content-Length"]
+                encoded_app_iter = self.stream_gzipped(app_iter,
+                                                       compression_level)
+            else:
+                try:
+                    new_response = "".join(gzip_chunks(app_iter,
+                                                       compression_level))
+                finally:
+                    self.close_app_iter(app_iter)
+                encoded_app_iter = [new_response]
+                headers["Content-Length"] = str(len(new_response))
         else:
             encoded_app_iter = app_iter
 
@@ -185,6 +274,19 @@ class GzipMiddleware(object):
         return encoded_app_iter
 
 
-def make_gzip_middleware(app, global_conf=None, compress_level=9, min_size=0):
-    """Return a gzip-compressing middleware."""
-    return GzipMiddleware(app, int(compress_level), int(min_size))
+def make_gzip_middleware(app, global_conf=None, compress_level=9, min_size=0,
+                         precompress_level=None, stream_min_size=0,
+                         content_type_levels=""):
+    """Return a gzip-compressing middleware.
+
+    content_type_levels overrides compress_level for some content types,
+    e.g. "text/html:6, application/json:4".
+
+    """
+    if precompress_level is not None:
+        precompress_level = int(precompress_level)
+    return GzipMiddleware(app, int(compress_level), int(min_size),
+                          precompress_level=precompress_level,
+                          stream_min_size=int(stream_min_size),
+                          content_type_levels=parse_content_type_levels(
+                              content_type_levels))
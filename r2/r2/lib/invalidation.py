@@ -0,0 +1,139 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+"""Channels for telling other processes that cache keys have been written.
+
+These are used by the ProcessCache tier (see r2.lib.cache) which, unlike the
+per-request LocalCache, lives long enough that it needs to hear about writes
+made elsewhere.
+
+"""
+
+import cPickle as pickle
+import os
+import socket
+import time
+from threading import Thread
+
+
+class LocalInvalidationChannel(object):
+    """Deliver invalidations to subscribers in this process only.
+
+    This is a stand-in for single-process installs and tests where there's
+    nobody else to tell.
+
+    """
+
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def publish(self, keys):
+        for callback in self.subscribers:
+            callback(keys)
+
+
+class AmqpInvalidationChannel(object):
+    """Broadcast invalidations to every process through an AMQP fanout
+    exchange.
+
+    Each subscribing process binds its own exclusive queue to the exchange
+    and listens on it from a daemon thread. Messages are transient: a
+    process that loses its connection clears its cache when it reconnects
+    instead of relying on redelivery.
+
+    """
+
+    exchange = 'reddit_cache_invalidation'
+
+    def __init__(self):
+        # the channel the exchange was last declared on by _publish
+        self._declared_on = None
+
+    def _origin(self):
+        return '%s:%d' % (socket.gethostname(), os.getpid())
+
+    def _declare(self, chan):
+        chan.exchange_declare(exchange=self.exchange,
+                              type='fanout',
+                              durable=True,
+                              auto_delete=False)
+
+    def publish(self, keys):
+        from r2.lib import amqp
+        body = pickle.dumps(dict(origin=self._origin(), keys=list(keys)))
+        amqp.worker.do(self._publish, body)
+
+    def _publish(self, body):
+        from amqplib import client_0_8 as amqplib
+        from r2.lib import amqp
+
+        chan = amqp.connection_manager.get_channel()
+        # declare it once per connection rather than for every message
+        if chan is not self._declared_on:
+            self._declare(chan)
+            self._declared_on = chan
+        msg = amqplib.Message(body, delivery_mode=amqp.DELIVERY_TRANSIENT)
+        chan.basic_publish(msg, exchange=self.exchange)
+
+    def subscribe(self, callback):
+        thread = Thread(target=self._listen, args=(callback,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _listen(self, callback):
+        from r2.lib import amqp
+        from pylons import g
+
+        origin = self._origin()
+
+        def _callback(msg):
+            data = pickle.loads(msg.body)
+            if data['origin'] != origin:
+                callback(data['keys'])
+
+        first = True
+        while True:
+            try:
+                # the connection manager is thread-local so this thread gets
+                # a connection of its own
+                chan = amqp.connection_manager.get_channel(
+                    reconnect=not first)
+                self._declare(chan)
+                queue, _, _ = chan.queue_declare(exclusive=True,
+                                                 auto_delete=True)
+                chan.queue_bind(queue=queue, exchange=self.exchange)
+                chan.basic_consume(queue=queue, callback=_callback,
+                                   no_ack=True)
+
+                if not first:
+                    # we may have missed some while we were disconnected
+                    callback(None)
+                first = False
+
+                while chan.callbacks:
+                    chan.wait()
+            except Exception:
+                g.log.exception("cache invalidation listener failed")
+                time.sleep(1)
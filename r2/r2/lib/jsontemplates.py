@@ -42,13 +42,34 @@ def make_fullname(typ, _id):
     return '%s_%s' % (make_typename(typ), to36(_id))
 
 
+def epoch_seconds(date):
+    """The (float) unix timestamp of an aware datetime."""
+    return float(calendar.timegm(date.utctimetuple()))
+
+def local_epoch_seconds(date):
+    """What time.mktime(date.timetuple()) gives, for the "created" attrs.
+
+    That's the date's wall clock time read as if it were the server's
+    local time, which is what the api has always sent.
+
+    """
+    return calendar.timegm(date.timetuple()) + float(time.timezone)
+
+
 class ObjectTemplate(StringTemplate):
     def __init__(self, d):
         self.d = d
 
     def update(self, kw):
+        # nothing to substitute, and the json encoder doesn't care whether
+        # it gets str or unicode, lists or tuples.
+        if not kw:
+            return self
+
         def _update(obj):
             if isinstance(obj, (str, unicode)):
+                if StringTemplate.start_delim not in obj:
+                    return obj
                 return StringTemplate(obj).finalize(kw)
             elif isinstance(obj, dict):
                 return dict((k, _update(v)) for k, v in obj.iteritems())
@@ -63,6 +84,9 @@ class ObjectTemplate(StringTemplate):
 
     def finalize(self, kw = {}):
         return self.update(kw).d
+
+    def expand_stubs(self, expander):
+        return ObjectTemplate(expander.expand_object(self.d))
     
 class JsonTemplate(Template):
     def __init__(self): pass
@@ -105,6 +129,81 @@ class UserItemHTMLJsonTemplate(TableRowTemplate):
         return "thing"
 
 
+def _author(template, thing):
+    if thing.author._deleted:
+        return "[deleted]"
+    return thing.author.name
+
+def _author_flair(field):
+    def get_flair(template, thing):
+        if thing.author._deleted:
+            return None
+        if thing.author.flair_enabled_in_sr(thing.subreddit._id):
+            return getattr(thing.author,
+                           'flair_%s_%s' % (thing.subreddit._id, field),
+                           None)
+        else:
+            return None
+    return get_flair
+
+def _created(template, thing):
+    return local_epoch_seconds(thing._date)
+
+def _created_utc(template, thing):
+    return epoch_seconds(thing._date)
+
+def _child(template, thing):
+    return CachedVariable("childlisting")
+
+def _distinguished(template, thing):
+    distinguished = getattr(thing, 'distinguished', 'no')
+    if distinguished == 'no':
+        return None
+    return distinguished
+
+def _moderator_only(attr):
+    def get_moderator_attr(template, thing):
+        if c.user_is_loggedin and thing.subreddit.is_moderator(c.user):
+            if attr == "num_reports":
+                return thing.reported
+            ban_info = getattr(thing, "ban_info", {})
+            if attr == "banned_by":
+                banner = (ban_info.get("banner")
+                          if ban_info.get('moderator_banned')
+                          else True)
+                return banner if thing._spam else None
+            elif attr == "approved_by":
+                return ban_info.get("unbanner") if not thing._spam else None
+        return getattr(thing, attr, None)
+    return get_moderator_attr
+
+def _edited(template, thing):
+    if isinstance(thing.editted, bool):
+        return thing.editted
+    return epoch_seconds(thing.editted)
+
+def _subreddit_name(template, thing):
+    return thing.subreddit.name
+
+def _subreddit_fullname(template, thing):
+    return thing.subreddit._fullname
+
+def _constant(value):
+    def get_constant(template, thing):
+        return value
+    return get_constant
+
+def _thing_attr(attr):
+    def get_thing_attr(template, thing):
+        return template.thing_attr(thing, attr)
+    return get_thing_attr
+
+def _getattr(attr):
+    def get_attr(template, thing):
+        return getattr(thing, attr, None)
+    return get_attr
+
+
 class ThingJsonTemplate(JsonTemplate):
     _data_attrs_ = dict(
         created="created",
@@ -113,11 +212,58 @@ class ThingJsonTemplate(JsonTemplate):
         name="_fullname",
     )
 
+    # attributes (the right side of _data_attrs_) that need more work than
+    # a getattr, as functions of (template, thing).
+    _attr_getters_ = dict(
+        approved_by=_moderator_only("approved_by"),
+        author=_author,
+        author_flair_css_class=_author_flair("css_class"),
+        author_flair_text=_author_flair("text"),
+        banned_by=_moderator_only("banned_by"),
+        child=_child,
+        created=_created,
+        created_utc=_created_utc,
+        distinguished=_distinguished,
+        num_reports=_moderator_only("num_reports"),
+    )
+
     @classmethod
     def data_attrs(cls, **kw):
         d = cls._data_attrs_.copy()
         d.update(kw)
         return d
+
+    @classmethod
+    def attr_getters(cls, **kw):
+        d = cls._attr_getters_.copy()
+        d.update(kw)
+        return d
+
+    @classmethod
+    def compiled_attrs(cls):
+        """
+        The (key, getter) pairs that raw_data builds its dictionary from,
+        worked out once per class: each attribute in _data_attrs_ gets
+        its getter from _attr_getters_ or is a plain getattr, unless the
+        class overrides thing_attr, which then has the final say.
+        """
+        compiled = cls.__dict__.get("_compiled_attrs")
+        if compiled is not None:
+            return compiled
+
+        custom = (cls.thing_attr.im_func is not
+                  ThingJsonTemplate.thing_attr.im_func)
+        compiled = []
+        for key, attr in cls._data_attrs_.iteritems():
+            if custom:
+                getter = _thing_attr(attr)
+            elif attr in cls._attr_getters_:
+                getter = cls._attr_getters_[attr]
+            else:
+                getter = _getattr(attr)
+            compiled.append((key, getter))
+        cls._compiled_attrs = compiled
+        return compiled
     
     def kind(self, wrapped):
         """
@@ -150,8 +296,8 @@ class ThingJsonTemplate(JsonTemplate):
         Complement to rendered_data.  Called when a dictionary of
         thing data attributes is to be sent across the wire.
         """
-        return dict((k, self.thing_attr(thing, v))
-                    for k, v in self._data_attrs_.iteritems())
+        return dict((key, getter(self, thing))
+                    for key, getter in self.compiled_attrs())
             
     def thing_attr(self, thing, attr):
         """
@@ -159,56 +305,14 @@ class ThingJsonTemplate(JsonTemplate):
         require more work than a simple getattr (for example, 'author'
         which has to be gotten from the author_id attribute on most
         things).
-        """
-        if attr == "author":
-            if thing.author._deleted:
-                return "[deleted]"
-            return thing.author.name
-        if attr == "author_flair_text":
-            if thing.author._deleted:
-                return None
-            if thing.author.flair_enabled_in_sr(thing.subreddit._id):
-                return getattr(thing.author,
-                               'flair_%s_text' % (thing.subreddit._id),
-                               None)
-            else:
-                return None
-        if attr == "author_flair_css_class":
-            if thing.author._deleted:
-                return None
-            if thing.author.flair_enabled_in_sr(thing.subreddit._id):
-                return getattr(thing.author,
-                               'flair_%s_css_class' % (thing.subreddit._id),
-                               None)
-            else:
-                return None
-        elif attr == "created":
-            return time.mktime(thing._date.timetuple())
-        elif attr == "created_utc":
-            return (time.mktime(thing._date.astimezone(pytz.UTC).timetuple())
-                    - time.timezone)
-        elif attr == "child":
-            return CachedVariable("childlisting")
-
-        if attr == 'distinguished':
-            distinguished = getattr(thing, attr, 'no')
-            if distinguished == 'no':
-                return None
-            return distinguished
-        
-        if attr in ["num_reports", "banned_by", "approved_by"]:
-            if c.user_is_loggedin and thing.subreddit.is_moderator(c.user):
-                if attr == "num_reports":
-                    return thing.reported
-                ban_info = getattr(thing, "ban_info", {})
-                if attr == "banned_by":
-                    banner = (ban_info.get("banner")
-                              if ban_info.get('moderator_banned')
-                              else True)
-                    return banner if thing._spam else None
-                elif attr == "approved_by":
-                    return ban_info.get("unbanner") if not thing._spam else None
 
+        Subclasses should add to _attr_getters_ rather than override
+        this where they can, as overriding it means calling it for
+        every attribute.
+        """
+        getter = self._attr_getters_.get(attr)
+        if getter:
+            return getter(self, thing)
         return getattr(thing, attr, None)
 
     def data(self, thing):
@@ -381,6 +485,34 @@ class AccountJsonTemplate(IdentityJsonTemplate):
             data["modhash"] = c.modhash
         return data
 
+def _media_embed(attr):
+    def get_media_embed(template, thing):
+        from r2.lib.media import get_media_embed
+        media_object = getattr(thing, attr.replace("_embed", "_object"))
+        if media_object and not isinstance(media_object, basestring):
+            media_embed = get_media_embed(media_object)
+            if media_embed:
+                return {
+                    "scrolling": media_embed.scrolling,
+                    "width": media_embed.width,
+                    "height": media_embed.height,
+                    "content": media_embed.content,
+                }
+        return {}
+    return get_media_embed
+
+def _selftext(template, thing):
+    if not thing.expunged:
+        return thing.selftext
+    else:
+        return ''
+
+def _selftext_html(template, thing):
+    if not thing.expunged:
+        return safemarkdown(thing.selftext)
+    else:
+        return safemarkdown(_("[removed]"))
+
 class LinkJsonTemplate(ThingJsonTemplate):
     _data_attrs_ = ThingJsonTemplate.data_attrs(
         approved_by="approved_by",
@@ -420,41 +552,17 @@ class LinkJsonTemplate(ThingJsonTemplate):
         url="url",
     )
 
-    def thing_attr(self, thing, attr):
-        from r2.lib.media import get_media_embed
-        if attr in ("media_embed", "secure_media_embed"):
-            media_object = getattr(thing, attr.replace("_embed", "_object"))
-            if media_object and not isinstance(media_object, basestring):
-                media_embed = get_media_embed(media_object)
-                if media_embed:
-                    return {
-                        "scrolling": media_embed.scrolling,
-                        "width": media_embed.width,
-                        "height": media_embed.height,
-                        "content": media_embed.content,
-                    }
-            return {}
-        elif attr == "clicked":
-            # this hasn't been used in years.
-            return False
-        elif attr == "editted" and not isinstance(thing.editted, bool):
-            return (time.mktime(thing.editted.astimezone(pytz.UTC).timetuple())
-                    - time.timezone)
-        elif attr == 'subreddit':
-            return thing.subreddit.name
-        elif attr == 'subreddit_id':
-            return thing.subreddit._fullname
-        elif attr == 'selftext':
-            if not thing.expunged:
-                return thing.selftext
-            else:
-                return ''
-        elif attr == 'selftext_html':
-            if not thing.expunged:
-                return safemarkdown(thing.selftext)
-            else:
-                return safemarkdown(_("[removed]"))
-        return ThingJsonTemplate.thing_attr(self, thing, attr)
+    _attr_getters_ = ThingJsonTemplate.attr_getters(
+        # this hasn't been used in years.
+        clicked=_constant(False),
+        editted=_edited,
+        media_embed=_media_embed("media_embed"),
+        secure_media_embed=_media_embed("secure_media_embed"),
+        selftext=_selftext,
+        selftext_html=_selftext_html,
+        subreddit=_subreddit_name,
+        subreddit_id=_subreddit_fullname,
+    )
 
     def rendered_data(self, thing):
         d = ThingJsonTemplate.rendered_data(self, thing)
@@ -468,6 +576,23 @@ class PromotedLinkJsonTemplate(LinkJsonTemplate):
     )
     del _data_attrs_['author']
 
+def _comment_link_id(template, thing):
+    from r2.models import Link
+    return make_fullname(Link, thing.link_id)
+
+def _comment_parent_id(template, thing):
+    from r2.models import Comment, Link
+    if getattr(thing, "parent_id", None):
+        return make_fullname(Comment, thing.parent_id)
+    else:
+        return make_fullname(Link, thing.link_id)
+
+def _comment_body_html(template, thing):
+    return spaceCompress(safemarkdown(thing.body))
+
+def _comment_gilded(template, thing):
+    return thing.gildings
+
 class CommentJsonTemplate(ThingJsonTemplate):
     _data_attrs_ = ThingJsonTemplate.data_attrs(
         approved_by="approved_by",
@@ -492,27 +617,15 @@ class CommentJsonTemplate(ThingJsonTemplate):
         ups="upvotes",
     )
 
-    def thing_attr(self, thing, attr):
-        from r2.models import Comment, Link, Subreddit
-        if attr == 'link_id':
-            return make_fullname(Link, thing.link_id)
-        elif attr == "editted" and not isinstance(thing.editted, bool):
-            return (time.mktime(thing.editted.astimezone(pytz.UTC).timetuple())
-                    - time.timezone)
-        elif attr == 'subreddit':
-            return thing.subreddit.name
-        elif attr == 'subreddit_id':
-            return thing.subreddit._fullname
-        elif attr == "parent_id":
-            if getattr(thing, "parent_id", None):
-                return make_fullname(Comment, thing.parent_id)
-            else:
-                return make_fullname(Link, thing.link_id)
-        elif attr == "body_html":
-            return spaceCompress(safemarkdown(thing.body))
-        elif attr == "gilded":
-            return thing.gildings
-        return ThingJsonTemplate.thing_attr(self, thing, attr)
+    _attr_getters_ = ThingJsonTemplate.attr_getters(
+        body_html=_comment_body_html,
+        editted=_edited,
+        gilded=_comment_gilded,
+        link_id=_comment_link_id,
+        parent_id=_comment_parent_id,
+        subreddit=_subreddit_name,
+        subreddit_id=_subreddit_fullname,
+    )
 
     def kind(self, wrapped):
         from r2.models import Comment
@@ -534,6 +647,9 @@ class CommentJsonTemplate(ThingJsonTemplate):
         d['parent'] = self.thing_attr(wrapped, 'parent_id')
         return d
 
+def _more_children(template, thing):
+    return [to36(x) for x in thing.children]
+
 class MoreCommentJsonTemplate(CommentJsonTemplate):
     _data_attrs_ = dict(
         children="children",
@@ -546,12 +662,11 @@ class MoreCommentJsonTemplate(CommentJsonTemplate):
     def kind(self, wrapped):
         return "more"
 
-    def thing_attr(self, thing, attr):
-        if attr == 'children':
-            return [to36(x) for x in thing.children]
-        if attr in ('body', 'body_html'):
-            return ""
-        return CommentJsonTemplate.thing_attr(self, thing, attr)
+    _attr_getters_ = CommentJsonTemplate.attr_getters(
+        body=_constant(""),
+        body_html=_constant(""),
+        children=_more_children,
+    )
 
     def rendered_data(self, wrapped):
         return CommentJsonTemplate.rendered_data(self, wrapped)
@@ -645,6 +760,17 @@ class NullJsonTemplate(JsonTemplate):
     def get_def(self, name):
         return self
 
+def _modhash(template, thing):
+    return c.modhash
+
+def _listing_things(template, thing):
+    res = []
+    for a in thing.things:
+        a.childlisting = False
+        r = a.render()
+        res.append(r)
+    return res
+
 class ListingJsonTemplate(ThingJsonTemplate):
     _data_attrs_ = dict(
         after="after",
@@ -653,18 +779,10 @@ class ListingJsonTemplate(ThingJsonTemplate):
         modhash="modhash",
     )
     
-    def thing_attr(self, thing, attr):
-        if attr == "modhash":
-            return c.modhash
-        elif attr == "things":
-            res = []
-            for a in thing.things:
-                a.childlisting = False
-                r = a.render()
-                res.append(r)
-            return res
-        return ThingJsonTemplate.thing_attr(self, thing, attr)
-        
+    _attr_getters_ = ThingJsonTemplate.attr_getters(
+        modhash=_modhash,
+        things=_listing_things,
+    )
 
     def rendered_data(self, thing):
         return self.thing_attr(thing, "things")
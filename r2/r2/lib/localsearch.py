@@ -0,0 +1,946 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""An embedded search index that stands in for Amazon CloudSearch.
+
+It takes the same <batch> documents the cloudsearch uploaders send and
+answers the same boolean queries (bq), plain queries, rank expressions and
+facets that cloudsearch.basic_query asks for, returning responses in the
+shape of CloudSearch's JSON. Select it with search_backend = local.
+
+An index is a directory of immutable segment files plus a MANIFEST naming
+the live ones. Each write adds a segment, runs of similarly sized segments
+are merged as they build up, and readers in any process pick up the new
+MANIFEST on their next search. Segments a merge replaces are only deleted
+a while later, so readers still on the old MANIFEST can open them.
+Segments are memory-mapped: the term dictionary and stored fields are
+loaded when a segment is opened, while the postings are only read from the
+mapping as queries need them.
+
+"""
+
+import cPickle as pickle
+import fcntl
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import chain
+
+from lxml import etree
+
+
+class QueryError(ValueError):
+    pass
+
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text):
+    if not isinstance(text, unicode):
+        text = text.decode("utf-8", "replace")
+    return [word.lower() for word in _WORD.findall(text)]
+
+
+def _term_key(field, term):
+    if isinstance(term, unicode):
+        term = term.encode("utf-8")
+    return "%s\x00%s" % (field, term)
+
+
+class IndexSchema(object):
+    """How to index and rank the fields of an index's documents.
+
+    Text fields are tokenized, int fields can be searched by range and
+    ranked on, and every other field is a literal matched exactly (and
+    available for faceting). Stored fields can be asked for in results.
+    rank_expressions maps names usable in `rank` to functions of a Hit.
+
+    """
+
+    def __init__(self, text_fields=(), int_fields=(), default_fields=None,
+                 stored_fields=(), rank_expressions=None):
+        self.text_fields = frozenset(text_fields)
+        self.int_fields = frozenset(int_fields)
+        self.default_fields = tuple(default_fields or sorted(text_fields))
+        self.stored_fields = frozenset(stored_fields)
+        self.rank_expressions = rank_expressions or {}
+
+    def field_type(self, name):
+        if name in self.text_fields:
+            return "text"
+        elif name in self.int_fields:
+            return "int"
+        return "literal"
+
+
+class Hit(object):
+    """A matching document, as seen by rank expressions"""
+    __slots__ = ("segment", "docnum", "relevance")
+
+    def __init__(self, segment, docnum, relevance):
+        self.segment = segment
+        self.docnum = docnum
+        self.relevance = relevance
+
+    @property
+    def fullname(self):
+        return self.segment.fullnames[self.docnum]
+
+    def get(self, field, default=0):
+        return self.segment.ints.get(field, {}).get(self.docnum, default)
+
+
+### segments ###
+_HEADER = struct.Struct("<4sQ")
+_MAGIC = "RLS1"
+_POSTING_TYPE = "I"
+assert array(_POSTING_TYPE).itemsize == 4
+
+
+def _write_segment(path, fullnames, versions, postings, ints, literals,
+                   stored, tombstones):
+    """Write a segment file.
+
+    postings is an iterable of (key, docnums, term frequencies) in key
+    order, the rest are dicts keyed by docnum (or fullname, for the
+    tombstones)
+
+    """
+    terms = {}
+    sorted_terms = []
+    with open(path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, 0))
+        for key, docnums, freqs in postings:
+            terms[key] = (f.tell(), len(docnums))
+            sorted_terms.append(key)
+            f.write(array(_POSTING_TYPE, docnums).tostring())
+            f.write(array(_POSTING_TYPE, freqs).tostring())
+
+        directory_offset = f.tell()
+        directory = dict(
+            fullnames=fullnames,
+            versions=versions,
+            terms=terms,
+            sorted_terms=sorted_terms,
+            ints=dict(ints),
+            literals=dict(literals),
+            stored=dict(stored),
+            tombstones=tombstones,
+        )
+        pickle.dump(directory, f, pickle.HIGHEST_PROTOCOL)
+        f.seek(0)
+        f.write(_HEADER.pack(_MAGIC, directory_offset))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class Segment(object):
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, directory_offset = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or not directory_offset:
+            raise ValueError("%s is not a search index segment" % path)
+        directory = pickle.loads(self._mmap[directory_offset:])
+        self.fullnames = directory["fullnames"]
+        self.versions = directory["versions"]
+        self.terms = directory["terms"]
+        self.sorted_terms = directory["sorted_terms"]
+        self.ints = directory["ints"]
+        self.literals = directory["literals"]
+        self.stored = directory["stored"]
+        self.tombstones = directory["tombstones"]
+
+        # docnums superseded by later segments, kept up to date by the index
+        self.deleted = set()
+
+    def __len__(self):
+        return len(self.fullnames)
+
+    def close(self):
+        self._mmap.close()
+
+    def doc_freq(self, key):
+        return self.terms.get(key, (0, 0))[1]
+
+    def postings(self, key):
+        """The docnums containing key and how often, as two arrays"""
+        try:
+            offset, count = self.terms[key]
+        except KeyError:
+            return (), ()
+        size = 4 * count
+        docnums = array(_POSTING_TYPE)
+        docnums.fromstring(self._mmap[offset:offset + size])
+        freqs = array(_POSTING_TYPE)
+        freqs.fromstring(self._mmap[offset + size:offset + 2 * size])
+        return docnums, freqs
+
+    def keys_with_prefix(self, prefix):
+        i = bisect_left(self.sorted_terms, prefix)
+        while (i < len(self.sorted_terms) and
+               self.sorted_terms[i].startswith(prefix)):
+            yield self.sorted_terms[i]
+            i += 1
+
+    def live_docnums(self):
+        return set(xrange(len(self))) - self.deleted
+
+
+class SegmentBuilder(object):
+    """Collects new documents and deletions for a segment"""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.fullnames = []
+        self.versions = []
+        self.postings = defaultdict(lambda: defaultdict(int))
+        self.ints = defaultdict(dict)
+        self.literals = defaultdict(dict)
+        self.stored = defaultdict(dict)
+        self.tombstones = {}
+
+    def __len__(self):
+        return len(self.fullnames) + len(self.tombstones)
+
+    def add(self, fullname, version, fields):
+        """Index a document. fields maps field names to lists of values"""
+        docnum = len(self.fullnames)
+        self.fullnames.append(fullname)
+        self.versions.append(version)
+        for name, values in fields.iteritems():
+            kind = self.schema.field_type(name)
+            if kind == "int":
+                try:
+                    self.ints[name][docnum] = int(values[0])
+                except (ValueError, IndexError):
+                    pass
+                continue
+            elif kind == "text":
+                for value in values:
+                    for word in tokenize(value):
+                        self.postings[_term_key(name, word)][docnum] += 1
+            else:
+                self.literals[name][docnum] = tuple(values)
+                for value in values:
+                    self.postings[_term_key(name, value)][docnum] += 1
+            if name in self.schema.stored_fields:
+                self.stored[name][docnum] = values
+
+    def delete(self, fullname, version):
+        self.tombstones[fullname] = version
+
+    def write(self, path):
+        def postings():
+            for key in sorted(self.postings):
+                docs = self.postings[key]
+                docnums = sorted(docs)
+                yield key, docnums, [docs[d] for d in docnums]
+        _write_segment(path, self.fullnames, self.versions, postings(),
+                       self.ints, self.literals, self.stored, self.tombstones)
+
+
+def _merge_segments(path, segments, keep_tombstones=True):
+    """Write the live documents of segments (oldest first) to one segment.
+
+    Unless the segments are the oldest in the index, keep_tombstones must
+    be set: their tombstones may still be hiding documents in older ones.
+
+    """
+    remap = []
+    fullnames = []
+    versions = []
+    tombstones = {}
+    for segment in segments:
+        if keep_tombstones:
+            tombstones.update(segment.tombstones)
+        mapping = {}
+        for docnum in sorted(segment.live_docnums()):
+            mapping[docnum] = len(fullnames)
+            fullnames.append(segment.fullnames[docnum])
+            versions.append(segment.versions[docnum])
+            # re-added since it was deleted
+            tombstones.pop(segment.fullnames[docnum], None)
+        remap.append(mapping)
+
+    def merged(attr):
+        result = defaultdict(dict)
+        for segment, mapping in zip(segments, remap):
+            for field, values in getattr(segment, attr).iteritems():
+                for docnum, value in values.iteritems():
+                    if docnum in mapping:
+                        result[field][mapping[docnum]] = value
+        return result
+
+    def postings():
+        keys = heapq.merge(*[segment.sorted_terms for segment in segments])
+        last = None
+        for key in keys:
+            if key == last:
+                continue
+            last = key
+            docnums = []
+            freqs = []
+            for segment, mapping in zip(segments, remap):
+                for docnum, freq in zip(*segment.postings(key)):
+                    if docnum in mapping:
+                        docnums.append(mapping[docnum])
+                        freqs.append(freq)
+            if docnums:
+                yield key, docnums, freqs
+
+    _write_segment(path, fullnames, versions, postings(), merged("ints"),
+                   merged("literals"), merged("stored"), tombstones)
+
+
+### queries ###
+_BQ_TOKEN = re.compile(r"""\s*(?:(\()|(\))|'((?:[^'\\]|\\.)*)'|([^\s()']+))""",
+                       re.UNICODE)
+_UNESCAPE = re.compile(r"\\(.)")
+
+
+def _tokenize_bq(bq):
+    tokens = []
+    pos = 0
+    bq = bq.strip()
+    while pos < len(bq):
+        m = _BQ_TOKEN.match(bq, pos)
+        if not m or m.end() == pos:
+            raise QueryError("can't parse %r at %d" % (bq, pos))
+        pos = m.end()
+        opening, closing, quoted, atom = m.groups()
+        if opening:
+            tokens.append(("(", None))
+        elif closing:
+            tokens.append((")", None))
+        elif quoted is not None:
+            tokens.append(("str", _UNESCAPE.sub(r"\1", quoted)))
+        else:
+            tokens.append(("atom", atom))
+    return tokens
+
+
+def parse_bq(bq):
+    """Parse a CloudSearch boolean query into a tree of query nodes.
+
+    Understands (and ...), (or ...), (not ...), (field name 'value'),
+    name:'value', name:value, integer ranges (name:1..5, name:1.., name:..5),
+    trailing-* prefixes and bare values, which search the default fields.
+
+    """
+    tokens = _tokenize_bq(bq)
+    if not tokens:
+        raise QueryError("empty query")
+    node, pos = _parse_expr(tokens, 0)
+    if pos != len(tokens):
+        raise QueryError("unexpected %r in %r" % (tokens[pos][1], bq))
+    return node
+
+
+def _parse_expr(tokens, pos):
+    kind, value = tokens[pos]
+    if kind == "(":
+        if pos + 1 >= len(tokens) or tokens[pos + 1][0] != "atom":
+            raise QueryError("expected an operator")
+        op = tokens[pos + 1][1]
+        pos += 2
+        if op == "field":
+            if pos + 1 >= len(tokens) or tokens[pos][0] != "atom":
+                raise QueryError("(field ...) needs a field name")
+            name = tokens[pos][1]
+            node = Match(name, tokens[pos + 1][1])
+            pos += 2
+        elif op in ("and", "or", "not"):
+            children = []
+            while pos < len(tokens) and tokens[pos][0] != ")":
+                child, pos = _parse_expr(tokens, pos)
+                children.append(child)
+            if op == "not":
+                if len(children) != 1:
+                    raise QueryError("(not ...) takes one expression")
+                node = Not(children[0])
+            elif not children:
+                raise QueryError("(%s) needs expressions" % op)
+            else:
+                node = (And if op == "and" else Or)(children)
+        else:
+            raise QueryError("unknown operator %r" % op)
+        if pos >= len(tokens) or tokens[pos][0] != ")":
+            raise QueryError("missing )")
+        return node, pos + 1
+    elif kind == "str":
+        return Match(None, value), pos + 1
+    elif kind == "atom":
+        name, colon, rest = value.partition(":")
+        if not colon:
+            return Match(None, value), pos + 1
+        if rest:
+            return Match(name, rest), pos + 1
+        if pos + 1 < len(tokens) and tokens[pos + 1][0] == "str":
+            return Match(name, tokens[pos + 1][1]), pos + 2
+        raise QueryError("%r needs a value" % value)
+    raise QueryError("unexpected %r" % kind)
+
+
+_PLAIN_TOKEN = re.compile(r'([-+]?)(?:"([^"]*)"|(\S+))', re.UNICODE)
+
+def parse_plain(q):
+    """Parse a plain query: every word (or "quoted phrase") must match
+    the default fields, except -words, which must not"""
+    required = []
+    excluded = []
+    for sign, phrase, word in _PLAIN_TOKEN.findall(q):
+        node = Match(None, phrase or word)
+        (excluded if sign == "-" else required).append(node)
+    if not required and not excluded:
+        raise QueryError("empty query")
+    return And(required + [Not(node) for node in excluded])
+
+
+class Match(object):
+    def __init__(self, field, value):
+        self.field = field
+        self.value = value
+
+    def _int_range(self):
+        value = self.value
+        try:
+            if ".." in value:
+                lo, hi = value.split("..", 1)
+                return (int(lo) if lo else None, int(hi) if hi else None)
+            return int(value), int(value)
+        except ValueError:
+            raise QueryError("%r isn't an integer or range for %s"
+                             % (value, self.field))
+
+    def _keys(self, index, segment, field):
+        """The keys that this matches in a field, as a list of lists: a
+        document needs one key from every inner list"""
+        kind = index.schema.field_type(field)
+        value = self.value
+        prefix = value.endswith("*")
+        if prefix:
+            value = value[:-1]
+        if kind == "text":
+            words = tokenize(value)
+            keys = [[_term_key(field, word)] for word in words]
+            if prefix and words:
+                keys[-1] = list(segment.keys_with_prefix(
+                    _term_key(field, words[-1])))
+            return keys
+        if prefix:
+            return [list(segment.keys_with_prefix(_term_key(field, value)))]
+        return [[_term_key(field, value)]]
+
+    def match(self, index, segment):
+        if self.field is not None:
+            if index.schema.field_type(self.field) == "int":
+                lo, hi = self._int_range()
+                values = segment.ints.get(self.field, {})
+                return dict((docnum, 0.) for docnum, v in values.iteritems()
+                            if (lo is None or v >= lo) and
+                               (hi is None or v <= hi))
+            fields = [self.field]
+        else:
+            fields = index.schema.default_fields
+
+        result = None
+        # a document must match every word, in any of the fields
+        by_word = zip(*[self._keys(index, segment, field) for field in fields])
+        for alternatives in by_word:
+            scores = defaultdict(float)
+            for keys in alternatives:
+                for key in keys:
+                    idf = index.idf(key)
+                    for docnum, freq in zip(*segment.postings(key)):
+                        scores[docnum] += (1 + math.log(freq)) * idf
+            if result is None:
+                result = scores
+            else:
+                result = dict((docnum, score + scores[docnum])
+                              for docnum, score in result.iteritems()
+                              if docnum in scores)
+        return result or {}
+
+
+class And(object):
+    def __init__(self, children):
+        self.children = children
+
+    def match(self, index, segment):
+        positive = [c for c in self.children if not isinstance(c, Not)]
+        negative = [c.child for c in self.children if isinstance(c, Not)]
+        if positive:
+            result = positive[0].match(index, segment)
+            for child in positive[1:]:
+                if not result:
+                    return {}
+                scores = child.match(index, segment)
+                result = dict((docnum, score + scores[docnum])
+                              for docnum, score in result.iteritems()
+                              if docnum in scores)
+        else:
+            result = dict.fromkeys(segment.live_docnums(), 0.)
+        for child in negative:
+            if not result:
+                break
+            for docnum in child.match(index, segment):
+                result.pop(docnum, None)
+        return result
+
+
+class Or(object):
+    def __init__(self, children):
+        self.children = children
+
+    def match(self, index, segment):
+        result = defaultdict(float)
+        for child in self.children:
+            for docnum, score in child.match(index, segment).iteritems():
+                result[docnum] += score
+        return result
+
+
+class Not(object):
+    def __init__(self, child):
+        self.child = child
+
+    def match(self, index, segment):
+        excluded = self.child.match(index, segment)
+        return dict((docnum, 0.) for docnum in segment.live_docnums()
+                    if docnum not in excluded)
+
+
+### the index ###
+class LocalSearchIndex(object):
+    # once merge_factor adjacent segments are of a similar size (the same
+    # power of merge_factor) they're merged into one, so a document is only
+    # rewritten a logarithmic number of times
+    merge_factor = 4
+    # seconds a segment's file outlives the MANIFEST that last named it
+    retire_grace = 300
+    reload_interval = 1
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.segments = []
+        self.versions = {}
+        self.num_docs = 0
+        self.generation = 0
+        # fullname -> (segment, docnum) of the live document, or
+        # (segment, None) if it's deleted by a tombstone
+        self._owners = {}
+        self._manifest_stat = None
+        self._checked = 0
+        self._lock = threading.RLock()
+        self.reload()
+
+    @property
+    def _manifest_path(self):
+        return os.path.join(self.path, "MANIFEST")
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_path) as f:
+                manifest = json.load(f)
+        except IOError:
+            manifest = {"generation": 0, "segments": []}
+        manifest.setdefault("retired", {})
+        return manifest
+
+    def _write_manifest(self, manifest):
+        tmp = self._manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self._manifest_path)
+
+    def reload(self, force=False):
+        """Open the segments named in the MANIFEST if it has changed"""
+        with self._lock:
+            try:
+                st = os.stat(self._manifest_path)
+                stat = (st.st_ino, st.st_mtime, st.st_size)
+            except OSError:
+                stat = None
+            self._checked = time.time()
+            if stat == self._manifest_stat and not force:
+                return
+            manifest = self._read_manifest()
+            if manifest["segments"] != [s.name for s in self.segments]:
+                self._switch_segments(manifest["segments"])
+            self.generation = manifest["generation"]
+            self._manifest_stat = stat
+
+    def _switch_segments(self, names):
+        """Move to the segments named, only looking at the documents of
+        those that were added or dropped to work out which are live"""
+        opened = dict((s.name, s) for s in self.segments)
+        segments = []
+        added = []
+        for name in names:
+            segment = opened.pop(name, None)
+            if segment is None:
+                segment = Segment(os.path.join(self.path, name))
+                added.append(segment)
+            segments.append(segment)
+
+        # dropped segments were merged into one of the added ones, which
+        # has whatever of theirs is still live
+        for segment in opened.itervalues():
+            for fullname in chain(segment.fullnames, segment.tombstones):
+                owner = self._owners.get(fullname)
+                if owner and owner[0] is segment:
+                    del self._owners[fullname]
+                    del self.versions[fullname]
+                    if owner[1] is not None:
+                        self.num_docs -= 1
+            segment.close()
+
+        # later segments win, by document or by tombstone
+        position = dict((segment, i) for i, segment in enumerate(segments))
+        for segment in added:
+            for docnum, fullname in enumerate(segment.fullnames):
+                self._claim(fullname, segment.versions[docnum], segment,
+                            docnum, position)
+            for fullname, version in segment.tombstones.iteritems():
+                self._claim(fullname, version, segment, None, position)
+        self.segments = segments
+
+    def _claim(self, fullname, version, segment, docnum, position):
+        owner = self._owners.get(fullname)
+        if owner:
+            owner_segment, owner_docnum = owner
+            if position[owner_segment] > position[segment]:
+                if docnum is not None:
+                    segment.deleted.add(docnum)
+                return
+            if owner_docnum is not None:
+                owner_segment.deleted.add(owner_docnum)
+                self.num_docs -= 1
+        self._owners[fullname] = (segment, docnum)
+        self.versions[fullname] = version
+        if docnum is not None:
+            self.num_docs += 1
+
+    def maybe_reload(self):
+        if time.time() - self._checked >= self.reload_interval:
+            self.reload()
+
+    @contextmanager
+    def _write_lock(self):
+        """Hold the index's lock against writers in any process"""
+        with self._lock:
+            with open(os.path.join(self.path, "LOCK"), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def update(self, adds, deletes):
+        """Apply documents to the index.
+
+        adds is a list of (fullname, version, fields) and deletes a list of
+        (fullname, version). As with CloudSearch, changes with a version no
+        newer than what's indexed are ignored. Returns the number of adds
+        and deletes applied.
+
+        """
+        with self._write_lock():
+            return self._update(adds, deletes)
+
+    def _update(self, adds, deletes):
+        self.reload()
+        changes = {}
+        for fullname, version, fields in adds:
+            changes[fullname] = (version, fields)
+        for fullname, version in deletes:
+            if version >= changes.get(fullname, (0, None))[0]:
+                changes[fullname] = (version, None)
+
+        builder = SegmentBuilder(self.schema)
+        num_adds = num_deletes = 0
+        for fullname, (version, fields) in changes.iteritems():
+            if version <= self.versions.get(fullname, -1):
+                continue
+            if fields is None:
+                builder.delete(fullname, version)
+                num_deletes += 1
+            else:
+                builder.add(fullname, version, fields)
+                num_adds += 1
+        if not len(builder):
+            return 0, 0
+
+        manifest = self._read_manifest()
+        generation = manifest["generation"] + 1
+        name = "%010d.seg" % generation
+        builder.write(os.path.join(self.path, name))
+        self._write_manifest(dict(
+            generation=generation,
+            segments=manifest["segments"] + [name],
+            retired=self._retire(manifest, []),
+        ))
+        self.reload(force=True)
+
+        while True:
+            start = self._find_merge()
+            if start is None:
+                break
+            self._merge(start, self.merge_factor)
+        return num_adds, num_deletes
+
+    def _tier(self, segment):
+        size = len(segment) + len(segment.tombstones)
+        tier = 0
+        while size >= self.merge_factor:
+            size //= self.merge_factor
+            tier += 1
+        return tier
+
+    def _find_merge(self):
+        """Where the first run of merge_factor segments of one tier starts"""
+        tiers = [self._tier(segment) for segment in self.segments]
+        for start in xrange(len(tiers) - self.merge_factor + 1):
+            if len(set(tiers[start:start + self.merge_factor])) == 1:
+                return start
+        return None
+
+    def _merge(self, start, count):
+        """Replace count segments from start with one (holding the lock)"""
+        manifest = self._read_manifest()
+        merging = self.segments[start:start + count]
+        generation = manifest["generation"] + 1
+        name = "%010d.seg" % generation
+        # nothing older is left for the tombstones of the oldest segments
+        # to hide, so they can go
+        _merge_segments(os.path.join(self.path, name), merging,
+                        keep_tombstones=start > 0)
+        segments = [segment.name for segment in self.segments]
+        segments[start:start + count] = [name]
+        self._write_manifest(dict(
+            generation=generation,
+            segments=segments,
+            retired=self._retire(manifest, [s.name for s in merging]),
+        ))
+        self.reload(force=True)
+
+    def _retire(self, manifest, names):
+        """The MANIFEST's retired segments plus names, deleting the files
+        of any that were dropped long enough ago that no reader can still
+        be about to open them"""
+        now = time.time()
+        retired = {}
+        for name, when in manifest["retired"].iteritems():
+            if now - when < self.retire_grace:
+                retired[name] = when
+                continue
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+        for name in names:
+            retired[name] = now
+        return retired
+
+    def optimize(self):
+        """Merge all of the segments into one"""
+        with self._write_lock():
+            self.reload()
+            if self.segments:
+                self._merge(0, len(self.segments))
+
+    def idf(self, key):
+        doc_freq = sum(segment.doc_freq(key) for segment in self.segments)
+        return math.log(1. + (self.num_docs or 1) / (1. + doc_freq))
+
+    def _rank_key(self, rank, messages):
+        """A sort key function for hits from a CloudSearch rank parameter
+        (comma-separated names, each prefixed with - for descending)"""
+        keys = []
+        for name in rank.split(","):
+            name = name.strip()
+            descending = name.startswith("-")
+            name = name.lstrip("-")
+            if name in ("relevance", "text_relevance"):
+                fn = lambda hit: hit.relevance
+            elif name in self.schema.rank_expressions:
+                fn = self.schema.rank_expressions[name]
+            elif name in self.schema.int_fields:
+                fn = lambda hit, name=name: hit.get(name)
+            else:
+                messages.append({
+                    "code": "CS-InvalidFieldOrRankAliasInRankParameter",
+                    "severity": "warning",
+                    "message": "Unable to create score object for rank %r"
+                               % name,
+                })
+                continue
+            keys.append((fn, descending))
+        if not keys:
+            keys.append((lambda hit: hit.relevance, True))
+
+        def key(hit):
+            return tuple(-fn(hit) if descending else fn(hit)
+                         for fn, descending in keys)
+        return key
+
+    def _facets(self, hits, faceting):
+        facets = {}
+        for facet, options in (faceting or {}).iteritems():
+            counts = defaultdict(int)
+            for hit in hits:
+                segment = hit.segment
+                if facet in self.schema.int_fields:
+                    values = segment.ints.get(facet, {})
+                    if hit.docnum in values:
+                        counts[unicode(values[hit.docnum])] += 1
+                else:
+                    values = segment.literals.get(facet, {})
+                    for value in values.get(hit.docnum, ()):
+                        counts[value] += 1
+            if options.get("sort") == "alpha":
+                top = sorted(counts.iteritems())
+            else:
+                top = sorted(counts.iteritems(), key=lambda (v, n): (-n, v))
+            top = top[:options.get("count", 20)]
+            facets[facet] = {"constraints": [{"value": value, "count": count}
+                                             for value, count in top]}
+        return facets
+
+    def search(self, query=None, bq=None, faceting=None, size=10, start=0,
+               rank="-text_relevance", return_fields=None):
+        """Run a query, returning a response shaped like CloudSearch's"""
+        if not (query or bq):
+            raise ValueError("Need query or bq")
+        started = time.time()
+        if isinstance(bq, str):
+            bq = bq.decode("utf-8")
+        if isinstance(query, str):
+            query = query.decode("utf-8")
+        node = parse_bq(bq) if bq else parse_plain(query)
+
+        self.maybe_reload()
+        with self._lock:
+            segments = self.segments
+            hits = []
+            for segment in segments:
+                for docnum, score in node.match(self, segment).iteritems():
+                    if docnum not in segment.deleted:
+                        hits.append(Hit(segment, docnum, score))
+
+        messages = []
+        key = self._rank_key(rank, messages)
+        top = heapq.nsmallest(start + size, hits, key=key)[start:]
+
+        results = []
+        for hit in top:
+            result = {"id": hit.fullname}
+            if return_fields:
+                data = {}
+                for field in return_fields:
+                    if field in hit.segment.stored:
+                        value = hit.segment.stored[field].get(hit.docnum)
+                    elif field in hit.segment.literals:
+                        value = hit.segment.literals[field].get(hit.docnum)
+                    elif field in hit.segment.ints:
+                        value = hit.segment.ints[field].get(hit.docnum)
+                        value = None if value is None else [unicode(value)]
+                    else:
+                        value = None
+                    if value is not None:
+                        data[field] = list(value)
+                result["data"] = data
+            results.append(result)
+
+        elapsed = int((time.time() - started) * 1000)
+        return {
+            "rank": rank,
+            "match-expr": bq or query,
+            "hits": {"found": len(hits), "start": start, "hit": results},
+            "facets": self._facets(hits, faceting),
+            "info": {"rid": "local", "time-ms": elapsed,
+                     "cpu-time-ms": elapsed, "messages": messages},
+        }
+
+
+class LocalDocumentClient(object):
+    """Applies cloudsearch document batches to a LocalSearchIndex, in place
+    of CloudSearchDocumentClient"""
+
+    def __init__(self, index):
+        self.index = index
+        self.elapsed = 0.
+
+    def post(self, data, retries=0):
+        start = time.time()
+        try:
+            adds = []
+            deletes = []
+            for node in etree.fromstring(data):
+                version = int(node.get("version"))
+                if node.tag == "add":
+                    fields = defaultdict(list)
+                    for field in node.iterfind("field"):
+                        fields[field.get("name")].append(field.text or u"")
+                    adds.append((node.get("id"), version, dict(fields)))
+                elif node.tag == "delete":
+                    deletes.append((node.get("id"), version))
+            num_adds, num_deletes = self.index.update(adds, deletes)
+            return ('<response status="success" adds="%d" deletes="%d"/>'
+                    % (num_adds, num_deletes))
+        finally:
+            self.elapsed += time.time() - start
+
+    def post_many(self, batches, retries=0):
+        for data, token in batches:
+            yield token, self.post(data)
+
+    def close(self):
+        pass
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_index(path, schema):
+    """The (shared) LocalSearchIndex for path"""
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = LocalSearchIndex(path, schema)
+        return _indexes[path]
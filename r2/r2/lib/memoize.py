@@ -21,6 +21,9 @@
 ###############################################################################
 
 from hashlib import md5
+import math
+import random
+from time import time as epoch_time
 
 from r2.lib.filters import _force_utf8
 from r2.lib.cache import NoneResult, make_key
@@ -30,9 +33,90 @@ from pylons import g
 make_lock = g.make_lock
 memoizecache = g.memoizecache
 
-def memoize(iden, time = 0, stale=False, timeout=30):
+# how eager early recomputation is. values > 1 favour refreshing earlier.
+EARLY_RECOMPUTE_BETA = 1.0
+
+
+class EarlyRecomputeResult(object):
+    """A memoized value stored along with how long it took to compute and
+    when it expires.
+
+    This lets readers refresh it probabilistically before it expires
+    ("XFetch"): the closer it is to expiry and the more expensive it was to
+    compute, the more likely a reader is to volunteer to recompute it.
+
+    """
+
+    def __init__(self, value, delta, expiry):
+        self.value = value
+        self.delta = delta
+        self.expiry = expiry
+
+    def should_recompute(self, beta, now=None, _random=random.random):
+        now = now if now is not None else epoch_time()
+        # 1 - random() is in (0, 1] so the log is always defined
+        return now - self.delta * beta * math.log(1 - _random()) >= self.expiry
+
+
+def memoize(iden, time = 0, stale=False, timeout=30, early_recompute=False,
+            beta=EARLY_RECOMPUTE_BETA):
+    """Cache the results of the decorated function in the memoizecache.
+
+    With early_recompute, the value is refreshed by a single worker shortly
+    before it expires while everyone else keeps serving the old one, rather
+    than all readers piling up on a lock once it's gone. It requires a time.
+
+    """
+
+    if early_recompute and not time:
+        raise ValueError("early_recompute requires an expiry time")
+
     def memoize_fn(fn):
         from r2.lib.memoize import NoneResult
+
+        def calculate(key, a, kw):
+            start = epoch_time()
+            res = fn(*a, **kw)
+            if res is None:
+                res = NoneResult
+
+            if early_recompute:
+                end = epoch_time()
+                stored = EarlyRecomputeResult(res, end - start, end + time)
+            else:
+                stored = res
+            memoizecache.set(key, stored, time=time)
+            return res
+
+        def calculate_locked(key, update, a, kw):
+            # not cached, we should calculate it.
+            with make_lock("memoize", 'memoize_lock(%s)' % key,
+                           time=timeout, timeout=timeout):
+
+                # see if it was completed while we were waiting
+                # for the lock
+                stored = None if update else memoizecache.get(key)
+                if isinstance(stored, EarlyRecomputeResult):
+                    stored = stored.value
+                if stored is not None:
+                    # it was calculated while we were waiting
+                    return stored
+                else:
+                    # okay now go and actually calculate it
+                    return calculate(key, a, kw)
+
+        def recompute_early(key, stored, a, kw):
+            # only one worker gets to refresh it. everyone else, including
+            # us if we lose, just serves what's there until it's done.
+            lock_key = 'memoize_early(%s)' % key
+            if not g.lock_cache.add(lock_key, 1, time=timeout):
+                return stored.value
+
+            try:
+                return calculate(key, a, kw)
+            finally:
+                g.lock_cache.delete(lock_key)
+
         def new_fn(*a, **kw):
 
             #if the keyword param _update == True, the cache will be
@@ -43,23 +127,14 @@ def memoize(iden, time = 0, stale=False, timeout=30):
 
             res = None if update else memoizecache.get(key, stale=stale)
 
+            if isinstance(res, EarlyRecomputeResult):
+                if early_recompute and res.should_recompute(beta):
+                    res = recompute_early(key, res, a, kw)
+                else:
+                    res = res.value
+
             if res is None:
-                # not cached, we should calculate it.
-                with make_lock("memoize", 'memoize_lock(%s)' % key,
-                               time=timeout, timeout=timeout):
-
-                    # see if it was completed while we were waiting
-                    # for the lock
-                    stored = None if update else memoizecache.get(key)
-                    if stored is not None:
-                        # it was calculated while we were waiting
-                        res = stored
-                    else:
-                        # okay now go and actually calculate it
-                        res = fn(*a, **kw)
-                        if res is None:
-                            res = NoneResult
-                        memoizecache.set(key, res, time=time)
+                res = calculate_locked(key, update, a, kw)
 
             if res == NoneResult:
                 res = None
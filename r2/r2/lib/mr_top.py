@@ -34,66 +34,52 @@ export USER=ri
 export INI=production.ini
 cd ~/reddit/r2
 time psql -F"\t" -A -t -d newreddit -U $USER -h $LINKDBHOST \
-     -c "\\copy (select t.thing_id, 'thing', 'link',
-                        t.ups, t.downs, t.deleted, t.spam, extract(epoch from t.date)
+     -c "\\copy (select t.thing_id, 'link',
+                        t.ups, t.downs, t.deleted, t.spam, extract(epoch from t.date),
+                        coalesce(u.value, ''), s.value
                    from reddit_thing_link t
+                   join reddit_data_link s
+                     on s.thing_id = t.thing_id and s.key = 'sr_id'
+                   left join reddit_data_link u
+                     on u.thing_id = t.thing_id and u.key = 'url'
                   where not t.spam and not t.deleted
-                     and t.date > now() - interval '1 year'
-                  )
-                  to 'reddit_thing_link.dump'"
-time psql -F"\t" -A -t -d newreddit -U $USER -h $LINKDBHOST \
-     -c "\\copy (select d.thing_id, 'data', 'link',
-                        d.key, d.value
-                   from reddit_data_link d, reddit_thing_link t
-                  where t.thing_id = d.thing_id
-                    and not t.spam and not t.deleted
-                    and (d.key = 'url' or d.key = 'sr_id')
                     and t.date > now() - interval '1 year'
                   )
-                  to 'reddit_data_link.dump'"
-cat reddit_data_link.dump reddit_thing_link.dump | sort -T. -S200m | paster --plugin=r2 run $INI r2/lib/mr_top.py -c "join_links()" > links.joined
+                  to 'links.joined'"
+cat links.joined | paster --plugin=r2 run $INI r2/lib/mr_top.py -c "top_listings()"
+"""
+
+# top_listings() does the whole job in one process: it reads the links
+# into columns, works out every listing with a bounded heap (spread over
+# all of the cores) and writes them to the permacache in batches. That
+# can be run with s/year/hour/g and top_listings(times=('hour',)) for a
+# much faster version that just does the hour listings. Usually these
+# jobs dump the thing and data tables separately and join them with
+# mr_tools.join_things, but some quick profiling shows that getting
+# postgres to do the joining is ever-so-slightly-faster, so we have the
+# above dump make it in the same format the join_things would normally
+# produce. That's also what the older pipeline, which passes every
+# (listing, link) pair through sort as text, reads:
+"""
 cat links.joined | paster --plugin=r2 run $INI r2/lib/mr_top.py -c "time_listings()" | sort -T. -S200m | paster --plugin=r2 run $INI r2/lib/mr_top.py -c "write_permacache()"
 """
-## """
-## psql -F"\t" -A -t -d newreddit -U ri -h $LINKDBHOST \
-##     -c "\\copy (select t.thing_id,
-##                        'link',
-##                        t.ups,
-##                        t.downs,
-##                        t.deleted,
-##                        t.spam,
-##                        extract(epoch from t.date),
-##                        d.value
-##                   from reddit_thing_link t,
-##                        reddit_data_link d
-##                  where t.thing_id = d.thing_id
-##                    and not t.spam and not t.deleted
-##                    and d.key = 'sr_id'
-##                    and t.date > now() - interval '1 year'
-##                ) to 'links.year.joined'"
-## cat links.year.joined | paster --plugin=r2 run production.ini r2/lib/mr_top.py -c "time_listings()" \
-##  | sort -T. -S200mW \
-##  | paster --plugin=r2 run production.ini r2/lib/mr_top.py -c "write_permacache()"
-## """
-
-# that can be run with s/year/hour/g and
-# s/time_listings/time_listings(('hour',))/ for a much faster version
-# that just does the hour listings. Usually these jobs dump the thing
-# and data tables separately and join them with mr_tools.join_things,
-# but some quick profiling shows that getting postgres to do the
-# joining is ever-so-slightly-faster, so we have the above dump make
-# it in the same format the join_things would normally produce
 
 # Known bug: if a given listing hasn't had a submission in the
 # allotted time (e.g. the year listing in a subreddit that hasn't had
 # a submission in the last year), we won't write out an empty
 # list. I'll call it a feature.
 
+import array
+import bisect
+import heapq
+import multiprocessing
 import sys
 
+from pylons import g
+
 from r2.models import Account, Subreddit, Link
 from r2.lib.db.sorts import epoch_seconds, score, controversy
-from r2.lib.db import queries
+from r2.lib.db import queries, sorts
 from r2.lib import mr_tools
 from r2.lib.utils import timeago, UrlParser
 from r2.lib.jsontemplates import make_fullname # what a strange place
@@ -192,3 +178,191 @@ def write_permacache(fd = sys.stdin):
     mr_tools.mr_reduce_max_per_key(lambda x: map(float, x[:-1]), num=1000,
                                    post=store_keys,
                                    fd = fd)
+
+
+class LinkColumns(object):
+    """The listing data for many links, in a column per attribute.
+
+    Row i of each column is the same link. The rows are also indexed by
+    subreddit and by each of the permutations of the link's domain.
+
+    """
+
+    def __init__(self):
+        self.thing_ids = array.array('l')
+        self.ups = array.array('l')
+        self.downs = array.array('l')
+        self.timestamps = array.array('d')
+        # filled in by finish()
+        self.scores = None
+        self.controversies = None
+        self.by_sr = {}
+        self.by_domain = {}
+
+    def __len__(self):
+        return len(self.thing_ids)
+
+    def add(self, thing_id, ups, downs, timestamp, sr_id, url):
+        row = len(self.thing_ids)
+        self.thing_ids.append(thing_id)
+        self.ups.append(ups)
+        self.downs.append(downs)
+        self.timestamps.append(timestamp)
+
+        self.by_sr.setdefault(sr_id, array.array('l')).append(row)
+        if url:
+            for domain in UrlParser(url).domain_permutations():
+                self.by_domain.setdefault(domain,
+                                          array.array('l')).append(row)
+
+    def finish(self):
+        """Work out every link's sort values, once they've all been added."""
+        if sorts.batch_available:
+            def doubles(values):
+                return array.array('d', values.astype('float64').tostring())
+            self.scores = doubles(sorts.score_batch(self.ups, self.downs))
+            self.controversies = doubles(
+                sorts.controversy_batch(self.ups, self.downs))
+        else:
+            pairs = zip(self.ups, self.downs)
+            self.scores = array.array('d', (score(*p) for p in pairs))
+            self.controversies = array.array('d',
+                                             (controversy(*p) for p in pairs))
+
+def read_links(fd=sys.stdin, oldest=None):
+    """Read join_links-style lines into LinkColumns.
+
+    Spam and deleted links, and any from before oldest, are skipped.
+
+    """
+    columns = LinkColumns()
+    for line in fd:
+        (thing_id, thing_type, ups, downs, deleted, spam, timestamp,
+         url, sr_id) = line.rstrip('\n').split('\t')
+        if thing_type != 'link' or deleted == 't' or spam == 't':
+            continue
+        timestamp = float(timestamp)
+        if oldest is not None and timestamp <= oldest:
+            continue
+        columns.add(int(thing_id), int(ups), int(downs), timestamp,
+                    int(sr_id), url)
+    columns.finish()
+    return columns
+
+def group_listings(columns, rows, oldests, num=1000):
+    """The top and controversial listings of a group of links.
+
+    rows are the links' rows in columns and oldests maps each time
+    ('day', 'week', ...) to the timestamp its links must be newer than.
+    Returns a list of (sort, time, [(fullname, value, timestamp)]), each
+    listing the num best links, best first.
+
+    """
+    timestamps = columns.timestamps
+    # newest first, so that each time's links are a prefix of rows
+    rows = sorted(rows, key=timestamps.__getitem__, reverse=True)
+    negated = [-timestamps[row] for row in rows]
+
+    listings = []
+    for time, oldest in oldests.iteritems():
+        count = bisect.bisect_left(negated, -oldest)
+        if not count:
+            continue
+        eligible = rows[:count]
+        for sort, values in (('top', columns.scores),
+                             ('controversial', columns.controversies)):
+            best = heapq.nlargest(num, eligible,
+                                  key=lambda row: (values[row],
+                                                   timestamps[row]))
+            listings.append((sort, time,
+                             [(make_fullname(Link, columns.thing_ids[row]),
+                               values[row], timestamps[row])
+                              for row in best]))
+    return listings
+
+# the columns being worked on, for the worker processes (which get them
+# when they're forked rather than having them pickled over)
+_columns = None
+
+def _group_listings_worker(args):
+    kind, key, oldests, num = args
+    groups = _columns.by_sr if kind == 'sr' else _columns.by_domain
+    return kind, key, group_listings(_columns, groups[key], oldests, num)
+
+def compute_listings(columns, oldests, num=1000, workers=None):
+    """Yield (kind, key, listings) for each subreddit and domain.
+
+    kind is 'sr' (with the subreddit's id as key) or 'domain', and
+    listings are as returned by group_listings. The groups are spread
+    over workers processes (all of the cores by default).
+
+    """
+    global _columns
+
+    tasks = ([('sr', sr_id, oldests, num) for sr_id in columns.by_sr] +
+             [('domain', domain, oldests, num)
+              for domain in columns.by_domain])
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    _columns = columns
+    try:
+        if workers == 1:
+            for task in tasks:
+                yield _group_listings_worker(task)
+            return
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            for result in pool.imap_unordered(_group_listings_worker, tasks,
+                                              chunksize=100):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        _columns = None
+
+def write_listings(listings, batch_size=100):
+    """Store listings from compute_listings, batch_size groups at a time."""
+    def flush(batch):
+        queries.CachedResults._replace_multi(batch)
+        # don't hold on to everything that's been written
+        g.reset_caches()
+
+    batch = []
+    groups = 0
+    for kind, key, group in listings:
+        for sort, time, tuples in group:
+            if kind == 'sr':
+                q = queries._get_links(key, sort, time)
+            else:
+                q = queries.get_domain_links(key, sort, time)
+            batch.append((q, tuples))
+
+        groups += 1
+        if groups % batch_size == 0:
+            flush(batch)
+            batch = []
+
+    if batch:
+        flush(batch)
+
+def top_listings(fd=sys.stdin, times=('year','month','week','day','hour'),
+                 num=1000, workers=None, batch_size=100):
+    """Build and store the time-filtered top and controversial listings.
+
+    This does what time_listings and write_permacache do, but in one
+    process and without writing out a line for every listing that every
+    link is in.
+
+    """
+    oldests = dict((t, epoch_seconds(timeago('1 %s' % t)))
+                   for t in times)
+    columns = read_links(fd, oldest=min(oldests.itervalues()))
+    print >> sys.stderr, ("%d links in %d subreddits and %d domains" %
+                          (len(columns), len(columns.by_sr),
+                           len(columns.by_domain)))
+    listings = compute_listings(columns, oldests, num=num, workers=workers)
+    write_listings(listings, batch_size=batch_size)
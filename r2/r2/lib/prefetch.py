@@ -0,0 +1,328 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Run a request's independent lookups at the same time.
+
+    prefetch = Prefetch("wrap_items")
+    prefetch.add("authors", Account._byID, aids, data=True)
+    prefetch.add("subreddits", Subreddit.load_subreddits, items)
+    prefetch.add("mod_srs", mod_srs, after=["subreddits"])
+    results = prefetch.run()
+
+Each stage runs as soon as the stages named in its `after` have finished,
+and is passed their results as keyword arguments. The stages run on a few
+threads shared by the whole process (prefetch_threads in the ini), which
+bounds the extra database connections they hold. They see the request's
+pylons globals (c, g, request, ...), though each gets a copy of c to set
+attributes on. Each stage also starts with a copy of the request's local
+caches, and whatever it adds to them is merged back into the request's
+once it's finished. The time each stage took is sent to g.stats as
+prefetch.<name>.<stage>. With concurrent_prefetch off in the ini, the
+stages run one after another in the calling thread instead.
+
+"""
+
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
+
+import pylons
+from pylons import g
+
+
+# the pylons globals that a stage might use, by their name in pylons
+_PROXIES = ("app_globals", "tmpl_context", "request", "response",
+            "translator", "url", "session", "cache")
+
+
+class LazyThreadPool(object):
+    """A pool of threads shared by a whole process, for fanning a request's
+    work out without starting threads (and taking connections) per request.
+
+    The threads are started the first time the pool is used in a process,
+    so they're never inherited across a fork. size is a function returning
+    how many there should be, so that it can come from the config.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # marks the pool's threads while they're running a task, so that
+        # work handed to the pool from inside it doesn't wait on threads
+        # that may all be busy
+        self._local = threading.local()
+
+    def get(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPool(max(self.size(), 1))
+                self._pid = os.getpid()
+            return self._pool
+
+    def in_pool(self):
+        return getattr(self._local, "active", False)
+
+    @contextmanager
+    def working(self):
+        self._local.active = True
+        try:
+            yield
+        finally:
+            self._local.active = False
+
+    def run(self, fns, max_workers):
+        """Call each of fns on up to max_workers of the pool's threads and
+        return their results in the same order. The first exception raised
+        by any of them is re-raised here once they've all finished. Called
+        from one of the pool's threads, fns are run one after another."""
+        if len(fns) <= 1 or max_workers <= 1 or self.in_pool():
+            return [fn() for fn in fns]
+
+        results = [None] * len(fns)
+        errors = []
+        work = Queue()
+        for i, fn in enumerate(fns):
+            work.put((i, fn))
+
+        def worker():
+            with self.working():
+                while True:
+                    try:
+                        i, fn = work.get_nowait()
+                    except Empty:
+                        return
+                    try:
+                        results[i] = fn()
+                    except Exception:
+                        errors.append(sys.exc_info())
+
+        pool = self.get()
+        workers = [pool.apply_async(worker)
+                   for x in xrange(min(max_workers, len(fns)))]
+        for async_result in workers:
+            async_result.wait()
+
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+        return results
+
+
+_pool = LazyThreadPool(lambda: g.prefetch_threads)
+
+
+def _capture_context():
+    """The objects currently behind the pylons globals, as (proxy, object)"""
+    context = []
+    for name in _PROXIES:
+        proxy = getattr(pylons, name, None)
+        if proxy is None:
+            continue
+        try:
+            context.append((proxy, proxy._current_obj()))
+        except (TypeError, AttributeError):
+            # nothing registered for this thread
+            pass
+    return context
+
+
+def _copy_tmpl_context(obj):
+    # copy.copy would ask for __getstate__ and friends, which c answers
+    # with '' like any other missing attribute
+    clone = object.__new__(obj.__class__)
+    clone.__dict__.update(obj.__dict__)
+    return clone
+
+
+def _stage_context(context):
+    """The context for one stage, with a c of its own"""
+    return [(proxy, _copy_tmpl_context(obj)
+                    if proxy is pylons.tmpl_context else obj)
+            for proxy, obj in context]
+
+
+def _capture_caches():
+    """This thread's cache chains (which are thread locals), with their
+    LocalCaches and stats"""
+    chains = getattr(g, "cache_chains", {}) or {}
+    return [(chain, chain.caches[0], chain.stats)
+            for chain in chains.itervalues()]
+
+
+class _Stage(object):
+    def __init__(self, name, fn, a, kw, after):
+        self.name = name
+        self.fn = fn
+        self.a = a
+        self.kw = kw
+        self.after = tuple(after)
+        self.start = self.end = None
+
+
+class Prefetch(object):
+    def __init__(self, name, concurrent=None):
+        if concurrent is None:
+            concurrent = g.concurrent_prefetch
+        self.name = name
+        self.concurrent = concurrent
+        self.stages = []
+
+    def add(self, name, fn, *a, **kw):
+        """Add a stage that calls fn(*a, **kw).
+
+        Pass after=[stage names] to have it run once those stages are done,
+        with their results passed in as keyword arguments named after them.
+
+        """
+        after = kw.pop("after", ())
+        known = set(stage.name for stage in self.stages)
+        for dep in after:
+            if dep not in known:
+                raise ValueError("%s can't come after unknown stage %s"
+                                 % (name, dep))
+        self.stages.append(_Stage(name, fn, a, kw, after))
+
+    def _call(self, stage, results):
+        kw = dict(stage.kw)
+        for dep in stage.after:
+            kw[dep] = results[dep]
+        stage.start = time.time()
+        try:
+            return stage.fn(*stage.a, **kw)
+        finally:
+            stage.end = time.time()
+
+    def run(self):
+        """Run all the stages and return their results by name.
+
+        The first exception raised by a stage is re-raised here, once the
+        stages that had started have finished (stages depending on the one
+        that failed aren't run).
+
+        """
+        timer = g.stats.get_timer("prefetch.%s" % self.name)
+        timer.start()
+        if (self.concurrent and len(self.stages) > 1 and
+                not _pool.in_pool()):
+            results = self._run_concurrently()
+        else:
+            results = {}
+            for stage in self.stages:
+                results[stage.name] = self._call(stage, results)
+
+        for stage in self.stages:
+            if stage.start is not None:
+                timer.send(stage.name, stage.start, stage.end)
+        timer.stop()
+        return results
+
+    def _work(self, stage, inputs, context, seeds):
+        """Run a stage on one of the pool's threads.
+
+        Returns (stage, result, exc_info, what was added to each chain's
+        LocalCache).
+
+        """
+        result = exc_info = None
+        added = []
+        for proxy, obj in context:
+            proxy._push_object(obj)
+        try:
+            with _pool.working():
+                for chain, seed, stats in seeds:
+                    chain.reset()
+                    chain.caches[0].update(seed)
+                    chain.stats = stats
+
+                result = self._call(stage, inputs)
+
+                for chain, seed, stats in seeds:
+                    local = dict(chain.caches[0])
+                    added.append(dict((key, val)
+                                      for key, val in local.iteritems()
+                                      if seed.get(key) is not val))
+        except Exception:
+            exc_info = sys.exc_info()
+        finally:
+            # don't hang on to this request's objects until the next stage
+            for chain, seed, stats in seeds:
+                chain.reset()
+            for proxy, obj in reversed(context):
+                proxy._pop_object(obj)
+        return stage, result, exc_info, added
+
+    def _run_concurrently(self):
+        pool = _pool.get()
+        context = _capture_context()
+        caches = _capture_caches()
+        results = {}
+        errors = []
+        done = threading.Condition()
+        finished = []
+
+        def stage_done(outcome):
+            with done:
+                finished.append(outcome)
+                done.notify()
+
+        pending = list(self.stages)
+        running = 0
+        with done:
+            while True:
+                # the request's caches and results are only touched here,
+                # in the request's thread
+                while finished:
+                    stage, result, exc_info, added = finished.pop()
+                    running -= 1
+                    for (chain, local, stats), values in zip(caches, added):
+                        local.update(values)
+                    if exc_info:
+                        errors.append(exc_info)
+                    else:
+                        results[stage.name] = result
+
+                if not errors:
+                    for stage in list(pending):
+                        if all(dep in results for dep in stage.after):
+                            pending.remove(stage)
+                            running += 1
+                            seeds = [(chain, dict(local), stats)
+                                     for chain, local, stats in caches]
+                            pool.apply_async(
+                                self._work,
+                                (stage, dict(results),
+                                 _stage_context(context), seeds),
+                                callback=stage_done)
+                if not running:
+                    break
+                done.wait()
+
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+        return results
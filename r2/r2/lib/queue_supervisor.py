@@ -0,0 +1,217 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Run and scale the consumers of the amqp queues.
+
+A supervisor looks after the consumers of one or more of the queues declared
+in r2.config.queues, starting each one as its own paster process:
+
+    paster run run.ini -c "from r2.lib.queue_supervisor import supervise; \
+supervise('vote_link_q', 'scraper_q')"
+
+A sharded queue (see queue_shards in the ini) gets one consumer per shard, so
+each shard is still processed in order. Other queues get between
+queue_min_workers and queue_max_workers consumers, depending on how many
+messages are waiting: one per queue_backlog_per_worker. Consumers that die
+are replaced. When the supervisor is stopped, or scales a queue down, its
+consumers are sent SIGTERM and finish what they're working on before they
+exit (or are killed after queue_drain_timeout seconds).
+
+The upstart job for this is reddit-queue-supervisor. It replaces the
+per-queue reddit-consumer-* jobs, which mustn't also be run for the same
+queue: a second consumer on a shard would break its ordering.
+
+"""
+
+import importlib
+import math
+import signal
+import subprocess
+import time
+
+from pylons import g
+
+from r2.lib import amqp
+
+
+class Consumer(object):
+    """A consumer process for one queue."""
+
+    def __init__(self, queue_name, number, config_file):
+        self.queue_name = queue_name
+        command = ("from r2.lib.queue_supervisor import consume; "
+                   "consume(%r)" % queue_name)
+        self.process = subprocess.Popen([
+            "paster", "run",
+            "--proctitle", "%s%d" % (queue_name, number),
+            config_file,
+            "-c", command,
+        ])
+        self.stopped_at = None
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def stop(self):
+        """Ask the consumer to finish what it's doing and exit."""
+        if self.stopped_at is None:
+            self.stopped_at = time.time()
+            if self.alive:
+                self.process.terminate()
+
+    def kill(self):
+        if self.alive:
+            self.process.kill()
+
+
+class QueueSupervisor(object):
+    def __init__(self, queue_names, config_file=None):
+        self.config_file = config_file or g.config["__file__"]
+        # the parent of each shard queue we look after
+        self.sharded_from = {}
+        self.consumers = {}
+        for name in queue_names:
+            queue = g.queues[name]
+            if not queue.consumer:
+                raise ValueError("queue %s has no consumer" % name)
+            self.consumers[name] = []
+            for shard_name in queue.shard_names:
+                self.sharded_from[shard_name] = name
+                self.consumers[shard_name] = []
+        self.stopping = []
+        self.shutting_down = False
+
+    def worker_range(self, name):
+        """The least and most consumers to run for a queue."""
+        if name in self.sharded_from:
+            # more than one consumer would lose the shard's ordering
+            return 1, 1
+        elif g.queues[name].shard_names:
+            # only has what was in it before it was sharded
+            return 0, 1
+        return (g.queue_min_workers.get(name, 1),
+                g.queue_max_workers.get(name, 1))
+
+    def wanted_workers(self, name, backlog):
+        low, high = self.worker_range(name)
+        wanted = int(math.ceil(float(backlog) / g.queue_backlog_per_worker))
+        return min(max(wanted, low), high)
+
+    def start_consumer(self, name):
+        number = len(self.consumers[name]) + 1
+        consumer = Consumer(name, number, self.config_file)
+        self.consumers[name].append(consumer)
+        g.log.info("started consumer %d for %s (pid %d)", number, name,
+                   consumer.process.pid)
+        g.stats.event_count("queue_supervisor.%s" % name, "start")
+
+    def stop_consumer(self, name):
+        consumer = self.consumers[name].pop()
+        consumer.stop()
+        self.stopping.append(consumer)
+        g.stats.event_count("queue_supervisor.%s" % name, "stop")
+
+    def reap(self):
+        """Forget about consumers that have exited."""
+        for name, consumers in self.consumers.iteritems():
+            for consumer in list(consumers):
+                if not consumer.alive:
+                    g.log.warning("consumer for %s exited with %s", name,
+                                  consumer.process.returncode)
+                    g.stats.event_count("queue_supervisor.%s" % name, "died")
+                    consumers.remove(consumer)
+
+        now = time.time()
+        for consumer in list(self.stopping):
+            if not consumer.alive:
+                self.stopping.remove(consumer)
+            elif now - consumer.stopped_at > g.queue_drain_timeout:
+                g.log.warning("killing consumer for %s, it didn't stop",
+                              consumer.queue_name)
+                consumer.kill()
+
+    def scale(self):
+        """Start or stop consumers to match each queue's backlog."""
+        for name in sorted(self.consumers):
+            try:
+                backlog = amqp.queue_length(name)
+            except Exception as e:
+                # leave it as it is until amqp is back
+                g.log.warning("couldn't get the length of %s: %r", name, e)
+                amqp.connection_manager.get_channel(reconnect=True)
+                backlog = None
+
+            have = len(self.consumers[name])
+            if backlog is None:
+                wanted = max(have, self.worker_range(name)[0])
+            else:
+                wanted = self.wanted_workers(name, backlog)
+
+            for i in xrange(wanted - have):
+                self.start_consumer(name)
+
+            # scale down gently, in case the backlog comes straight back
+            if wanted < have:
+                self.stop_consumer(name)
+
+    def request_shutdown(self, signum, frame):
+        self.shutting_down = True
+
+    def shutdown(self):
+        for name in self.consumers:
+            while self.consumers[name]:
+                self.stop_consumer(name)
+
+        while self.stopping:
+            self.reap()
+            time.sleep(.1)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.request_shutdown)
+        signal.signal(signal.SIGINT, self.request_shutdown)
+
+        next_check = 0
+        while not self.shutting_down:
+            self.reap()
+            if time.time() >= next_check:
+                self.scale()
+                next_check = time.time() + g.queue_supervisor_interval
+            time.sleep(1)
+
+        g.log.info("draining consumers")
+        self.shutdown()
+
+
+def supervise(*queue_names):
+    """Run the consumers of queue_names until told to stop."""
+    QueueSupervisor(queue_names).run()
+
+
+def consume(queue_name):
+    """Run the consumer for a queue (in the current process)."""
+    queue = g.queues[queue_name]
+    module_name, fn_name = queue.consumer.split(":")
+    fn = getattr(importlib.import_module(module_name), fn_name)
+    if queue.consumer_takes_queue:
+        fn(queue_name)
+    else:
+        fn()
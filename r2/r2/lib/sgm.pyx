@@ -20,15 +20,279 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+import cPickle as pickle
+import os
+import threading
+from time import sleep, time as _now
+
+
+# how long a follower will wait on another thread's or process's load of a
+# key before giving up and loading it itself
+FLIGHT_TIMEOUT = 30
+# how long a cross-process lease lives in memcache if its holder dies
+LEASE_TIME = 30
+# how long to wait on another process's load before doing it ourselves. the
+# polling starts quick and backs off.
+LEASE_WAIT_TIMEOUT = 2
+LEASE_POLL_INTERVAL = .01
+LEASE_MAX_POLL_INTERVAL = .2
+# a leaseholder that finds a key doesn't exist leaves this in place of its
+# lease for a little while so that whoever is waiting on it can stop
+LEASE_NOT_FOUND = '<not found>'
+LEASE_NOT_FOUND_TIME = 2
+
+
+class _Flight(object):
+    """A load of a single cache key that is currently in progress in this
+    process. Other threads that miss on the same key wait on `done` and then
+    share the result rather than running their own query.
+
+    The result is kept pickled, the way the cache would have handed it
+    back, so that each follower gets its own copy to modify rather than
+    the leader's object.
+
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.owner = threading.current_thread().ident
+        self.found = False
+        self.failed = False
+        self.pickled = None
+
+    def land(self, value):
+        try:
+            self.pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            # followers will have to load it themselves
+            self.failed = True
+        else:
+            self.found = True
+
+    @property
+    def value(self):
+        return pickle.loads(self.pickled)
+
+
+# prefixed key -> _Flight
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _claim_flights(s_keys, prefix):
+    """Split the (string) keys into the ones this thread is now responsible
+    for loading and the ones some other thread is already loading."""
+    mine = {}
+    theirs = {}
+    me = threading.current_thread().ident
+
+    with _flights_lock:
+        for s_key in s_keys:
+            flight_key = prefix + s_key
+            flight = _flights.get(flight_key)
+            if flight is None:
+                flight = _flights[flight_key] = _Flight()
+                mine[s_key] = flight
+            elif flight.owner == me:
+                # we're being called recursively from our own miss_fn.
+                # waiting on ourselves would just time out, so load it
+                # without a flight.
+                mine[s_key] = None
+            else:
+                theirs[s_key] = flight
+
+    return mine, theirs
+
+
+def _land_flights(mine, prefix, calculated, failed):
+    with _flights_lock:
+        for s_key, flight in mine.iteritems():
+            if flight is not None and _flights.get(prefix + s_key) is flight:
+                del _flights[prefix + s_key]
+
+    for s_key, flight in mine.iteritems():
+        if flight is None:
+            continue
+        flight.failed = failed
+        if s_key in calculated:
+            flight.land(calculated[s_key])
+        flight.done.set()
+
+
+def _lease_key(prefix, s_key):
+    return 'sgm_lease(%s%s)' % (prefix, s_key)
+
+
+def _take_leases(lease_cache, s_keys, prefix, lease_time):
+    """Try to take a memcache lease on each key. Returns the keys we got
+    leases for and the keys that are being loaded by some other process."""
+    held = []
+    busy = []
+    my_info = '%s:%d' % (os.uname()[1], os.getpid())
+    for s_key in s_keys:
+        if lease_cache.add(_lease_key(prefix, s_key), my_info,
+                           time=lease_time):
+            held.append(s_key)
+        else:
+            busy.append(s_key)
+    return held, busy
+
+
+def _release_leases(lease_cache, held, prefix, calculated_s):
+    """Drop the leases we took. If the load went through (`calculated_s`
+    isn't None), the keys it didn't find are marked as not found instead."""
+    not_found = []
+    if calculated_s is not None:
+        not_found = [s_key for s_key in held if s_key not in calculated_s]
+    if not_found:
+        lease_cache.set_multi(dict((_lease_key(prefix, s_key), LEASE_NOT_FOUND)
+                                   for s_key in not_found),
+                              time=LEASE_NOT_FOUND_TIME)
+    lease_cache.delete_multi([_lease_key(prefix, s_key) for s_key in held
+                              if s_key not in not_found])
+
+
+def _wait_for_others(cache, lease_cache, s_keys, prefix, timeout):
+    """Poll for keys that other processes hold the leases on.
+
+    Returns the values that showed up in the cache and the keys that the
+    leaseholders found don't exist. Anything else (the leaseholder died or
+    failed, or is taking longer than `timeout`) is left to the caller.
+
+    """
+    found = {}
+    not_found = set()
+    waiting = set(s_keys)
+    interval = LEASE_POLL_INTERVAL
+    give_up = _now() + timeout
+    while True:
+        # read the leases before the cache: leaseholders write the cache
+        # before letting go, so a lease that's gone means the value (if
+        # there is one) is already there
+        lease_keys = dict((_lease_key(prefix, s_key), s_key)
+                          for s_key in waiting)
+        leases = lease_cache.get_multi(lease_keys.keys())
+        hits = cache.get_multi(list(waiting), prefix=prefix)
+        found.update(hits)
+        waiting.difference_update(hits.keys())
+        for lease_key, s_key in lease_keys.iteritems():
+            if s_key not in waiting:
+                continue
+            lease = leases.get(lease_key)
+            if lease == LEASE_NOT_FOUND:
+                not_found.add(s_key)
+                waiting.discard(s_key)
+            elif lease is None:
+                waiting.discard(s_key)
+
+        remaining = give_up - _now()
+        if not waiting or remaining <= 0:
+            break
+        sleep(min(interval, remaining))
+        interval = min(interval * 2, LEASE_MAX_POLL_INTERVAL)
+    return found, not_found
+
+
+def _load_and_cache(cache, keys, miss_fn, prefix, time):
+    calculated = miss_fn(keys)
+    calculated_to_cache = {}
+    for k, v in calculated.iteritems():
+        calculated_to_cache[str(k)] = v
+    cache.set_multi(calculated_to_cache, prefix=prefix, time=time)
+    return calculated, calculated_to_cache
+
+
+def _coalesced_miss(cache, still_need, miss_fn, prefix, time,
+                    lease_cache, lease_time):
+    """Run miss_fn for `still_need`, sharing loads that are already in flight
+    in this process (and, with a lease_cache, in other processes) so that a
+    popular key falling out of the cache results in one query rather than
+    one per requester."""
+    by_s_key = {}
+    for key in still_need:
+        by_s_key[str(key)] = key
+
+    ret = {}
+    mine, theirs = _claim_flights(by_s_key.keys(), prefix)
+
+    calculated_s = {}
+    failed = True
+    try:
+        to_load = mine.keys()
+
+        if lease_cache is not None and to_load:
+            held, busy = _take_leases(lease_cache, to_load, prefix,
+                                      lease_time)
+            loaded = False
+            try:
+                unleased = []
+                if busy:
+                    # another process is loading these. give them a chance
+                    # to finish and then load whatever didn't show up (the
+                    # leases on those are still theirs)
+                    others, not_found = _wait_for_others(
+                        cache, lease_cache, busy, prefix, LEASE_WAIT_TIMEOUT)
+                    for s_key, v in others.iteritems():
+                        ret[by_s_key[s_key]] = v
+                        calculated_s[s_key] = v
+                    unleased = [s_key for s_key in busy
+                                if s_key not in others
+                                and s_key not in not_found]
+
+                if held or unleased:
+                    calculated, loaded_s = _load_and_cache(
+                        cache, [by_s_key[s] for s in held + unleased],
+                        miss_fn, prefix, time)
+                    ret.update(calculated)
+                    calculated_s.update(loaded_s)
+                loaded = True
+            finally:
+                _release_leases(lease_cache, held, prefix,
+                                calculated_s if loaded else None)
+
+        elif to_load:
+            calculated, loaded_s = _load_and_cache(
+                cache, [by_s_key[s] for s in to_load], miss_fn, prefix, time)
+            ret.update(calculated)
+            calculated_s.update(loaded_s)
+
+        failed = False
+    finally:
+        _land_flights(mine, prefix, calculated_s, failed)
+
+    # only wait on the other threads after our own loads are done so that
+    # two threads leading each other's keys can't deadlock
+    stragglers = []
+    for s_key, flight in theirs.iteritems():
+        flight.done.wait(FLIGHT_TIMEOUT)
+        if flight.found:
+            ret[by_s_key[s_key]] = flight.value
+        elif flight.failed or not flight.done.is_set():
+            stragglers.append(by_s_key[s_key])
+        # otherwise the leader looked and it doesn't exist
+
+    if stragglers:
+        calculated, loaded_s = _load_and_cache(cache, stragglers, miss_fn,
+                                               prefix, time)
+        ret.update(calculated)
+
+    return ret
+
+
 # smart get multi:
 # For any keys not found in the cache, miss_fn() is run and the result is
 # stored in the cache. Then it returns everything, both the hits and misses.
-def sgm(cache, keys, miss_fn, str prefix='', int time=0, stale=False, found_fn=None, _update=False):
+#
+# With single_flight, concurrent misses on the same key within this process
+# wait on one call to miss_fn instead of each running their own. Passing a
+# lease_cache (which must support add) extends that across processes by
+# taking a short-lived lease on each key before loading it.
+def sgm(cache, keys, miss_fn, str prefix='', int time=0, stale=False, found_fn=None, _update=False,
+        single_flight=False, lease_cache=None, int lease_time=LEASE_TIME):
     cdef dict ret
     cdef dict s_keys
     cdef dict cached
     cdef dict calculated
-    cdef dict calculated_to_cache
     cdef set  still_need
 
     ret = {}
@@ -63,12 +327,12 @@ def sgm(cache, keys, miss_fn, str prefix='', int time=0, stale=False, found_fn=N
         # if we didn't get all of the keys from the cache, go to the
         # miss_fn with the keys they asked for minus the ones that we
         # found
-        calculated = miss_fn(still_need)
+        if single_flight:
+            calculated = _coalesced_miss(cache, still_need, miss_fn, prefix,
+                                         time, lease_cache, lease_time)
+        else:
+            calculated, calculated_to_cache = _load_and_cache(
+                cache, still_need, miss_fn, prefix, time)
         ret.update(calculated)
 
-        calculated_to_cache = {}
-        for k, v in calculated.iteritems():
-            calculated_to_cache[str(k)] = v
-        cache.set_multi(calculated_to_cache, prefix=prefix, time=time)
-
     return ret
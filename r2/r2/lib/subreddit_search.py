@@ -20,6 +20,16 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+from pylons import g
+
 from r2.models import Subreddit
 from r2.lib.memoize import memoize
 from r2.lib.db.operators import desc
@@ -33,25 +43,259 @@ class SubredditsByPartialName(tdb_cassandra.View):
     _connection_pool = 'main'
     _read_consistency_level = CL_ONE
 
-def load_all_reddits():
-    query_cache = {}
 
+_MAGIC = "RSN1"
+# magic, node count, top-k entry count, name count, then the offsets of the
+# nodes, labels, top-k entries, name offsets, over-18 flags and name data
+_HEADER = struct.Struct("<4s9I")
+# first child, number of children, first top-k entry, number of entries
+_NODE = struct.Struct("<4I")
+_UINT = "I"
+assert array(_UINT).itemsize == 4
+
+
+def build_prefix_index(names, per_prefix=10):
+    """A prefix index of names, a sequence of (name, over_18) from most to
+    least popular, as a string for PrefixIndex to map.
+
+    The index is a trie over the lowercased utf-8 bytes of the names. Each
+    node keeps the first per_prefix names under it, so a lookup is one
+    walk down the trie.
+
+    """
+    # nodes are [children by byte, top names]
+    root = [{}, []]
+    all_names = []
+    for name, over_18 in names:
+        num = len(all_names)
+        all_names.append((name, over_18))
+        node = root
+        for char in name.lower().encode("utf-8"):
+            node = node[0].setdefault(char, [{}, []])
+            if len(node[1]) < per_prefix:
+                node[1].append(num)
+
+    # number the nodes breadth first so each one's children are contiguous
+    nodes = array(_UINT)
+    labels = ["\x00"]
+    top = array(_UINT)
+    queue = [root]
+    next_num = 1
+    for node in queue:
+        children = sorted(node[0].iteritems())
+        nodes.extend((next_num, len(children), len(top), len(node[1])))
+        top.extend(node[1])
+        for char, child in children:
+            labels.append(char)
+            queue.append(child)
+        next_num += len(children)
+    labels = "".join(labels)
+
+    encoded = [name.encode("utf-8") for name, over_18 in all_names]
+    name_offsets = array(_UINT, [0])
+    for name in encoded:
+        name_offsets.append(name_offsets[-1] + len(name))
+    flags = "".join("\x01" if over_18 else "\x00"
+                    for name, over_18 in all_names)
+
+    sections = [nodes.tostring(), labels, top.tostring(),
+                name_offsets.tostring(), flags, "".join(encoded)]
+    offsets = []
+    position = _HEADER.size
+    for section in sections:
+        offsets.append(position)
+        position += len(section)
+
+    header = _HEADER.pack(_MAGIC, len(queue), len(top), len(all_names),
+                          *offsets)
+    return header + "".join(sections)
+
+
+def _write_file(path, data):
+    """Write data next to path and rename it into place, so that readers
+    see either the old file or the new one"""
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+def write_prefix_index(path, names, per_prefix=10):
+    """Write a prefix index of names (see build_prefix_index) to path"""
+    _write_file(path, build_prefix_index(names, per_prefix))
+
+
+class PrefixIndex(object):
+    """A memory-mapped index written by write_prefix_index"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _HEADER.unpack_from(self._mmap, 0)
+        if header[0] != _MAGIC:
+            raise ValueError("%s is not a subreddit prefix index" % path)
+        # what publish_prefix_index calls it
+        self.version = hashlib.md5(self._mmap).hexdigest()
+        (self.num_nodes, self.num_top, self.num_names, self._nodes,
+         self._labels, self._top, self._name_offsets, self._flags,
+         self._data) = header[1:]
+
+    def close(self):
+        self._mmap.close()
+
+    def _name(self, num):
+        start, end = struct.unpack_from("<2I", self._mmap,
+                                        self._name_offsets + 4 * num)
+        name = self._mmap[self._data + start:self._data + end]
+        over_18 = self._mmap[self._flags + num] != "\x00"
+        return name.decode("utf-8"), over_18
+
+    def search(self, prefix):
+        """(name, over_18) for the most popular names starting with prefix"""
+        if not isinstance(prefix, unicode):
+            prefix = prefix.decode("utf-8", "replace")
+        node = 0
+        for char in prefix.lower().encode("utf-8"):
+            first, count, top_start, top_count = _NODE.unpack_from(
+                self._mmap, self._nodes + _NODE.size * node)
+            start = self._labels + first
+            i = self._mmap[start:start + count].find(char)
+            if i < 0:
+                return []
+            node = first + i
+        first, count, top_start, top_count = _NODE.unpack_from(
+            self._mmap, self._nodes + _NODE.size * node)
+        top = struct.unpack_from("<%dI" % top_count, self._mmap,
+                                 self._top + 4 * top_start)
+        return [self._name(num) for num in top]
+
+
+# the update_sr_names job publishes the index to the permacache, where
+# every app server can fetch it from. it's split into chunks small enough
+# for the memcaches in front of it, and pointed to by _PUBLISHED_KEY.
+_PUBLISHED_KEY = "subreddit_autocomplete_index"
+_CHUNK_SIZE = 512 * 1024
+
+
+def _chunk_keys(version, num_chunks):
+    return ["%s_%s_%d" % (_PUBLISHED_KEY, version, i)
+            for i in xrange(num_chunks)]
+
+
+def publish_prefix_index(data):
+    """Store an index built by build_prefix_index in the permacache for
+    get_prefix_index to pick up"""
+    version = hashlib.md5(data).hexdigest()
+    chunks = [data[i:i + _CHUNK_SIZE]
+              for i in xrange(0, len(data), _CHUNK_SIZE)]
+    g.permacache.set_multi(dict(zip(_chunk_keys(version, len(chunks)),
+                                    chunks)))
+
+    # the pointer goes last so that nobody sees it before its chunks. the
+    # version before last is deleted now: anyone who read its pointer has
+    # had a whole run of the job to fetch it.
+    previous = g.permacache.get(_PUBLISHED_KEY, allow_local=False)
+    if previous and previous["previous"]:
+        g.permacache.delete_multi(_chunk_keys(*previous["previous"]))
+    g.permacache.set(_PUBLISHED_KEY, {
+        "version": version,
+        "chunks": len(chunks),
+        "previous": (previous["version"], previous["chunks"])
+                    if previous else None,
+    })
+
+
+def _fetch_published(published):
+    """The published index's data, or None if it isn't all there"""
+    keys = _chunk_keys(published["version"], published["chunks"])
+    chunks = g.permacache.get_multi(keys, allow_local=False)
+    if len(chunks) != len(keys):
+        return None
+    data = "".join(chunks[key] for key in keys)
+    if hashlib.md5(data).hexdigest() != published["version"]:
+        return None
+    return data
+
+
+_index = None
+# the index _index replaced, closed when it's replaced in turn, by which
+# time nothing's still searching it
+_previous_index = None
+_index_checked = 0
+_index_lock = threading.Lock()
+_INDEX_CHECK_INTERVAL = 30
+
+
+def get_prefix_index():
+    """The published PrefixIndex, kept in a local copy at
+    subreddit_autocomplete_path. None if there isn't one."""
+    global _index, _previous_index, _index_checked
+    path = g.subreddit_autocomplete_path
+    if not path:
+        return None
+    if time.time() - _index_checked < _INDEX_CHECK_INTERVAL:
+        return _index
+
+    with _index_lock:
+        _index_checked = time.time()
+        published = g.permacache.get(_PUBLISHED_KEY, allow_local=False)
+        if not published:
+            return _index
+        if _index and _index.version == published["version"]:
+            return _index
+
+        # another process on this server may have fetched it already
+        try:
+            index = PrefixIndex(path)
+        except (IOError, ValueError, struct.error):
+            index = None
+        if not index or index.version != published["version"]:
+            if index:
+                index.close()
+            data = _fetch_published(published)
+            if data is None:
+                return _index
+            _write_file(path, data)
+            index = PrefixIndex(path)
+
+        if _previous_index:
+            _previous_index.close()
+        _previous_index, _index = _index, index
+        return _index
+
+
+def load_all_reddits():
     q = Subreddit._query(Subreddit.c.type == 'public',
                          Subreddit.c._downs > 1,
                          sort = (desc('_downs'), desc('_ups')),
                          data = True)
-    for sr in utils.fetch_things2(q):
-        name = sr.name.lower()
-        for i in xrange(len(name)):
-            prefix = name[:i + 1]
-            names = query_cache.setdefault(prefix, [])
-            if len(names) < 10:
-                names.append((sr.name, sr.over_18))
+    names = ((sr.name, sr.over_18) for sr in utils.fetch_things2(q))
+
+    if g.subreddit_autocomplete_path:
+        publish_prefix_index(build_prefix_index(names))
+        return
+
+    query_cache = {}
+    for name, over_18 in names:
+        lower = name.lower()
+        for i in xrange(len(lower)):
+            prefix = lower[:i + 1]
+            tups = query_cache.setdefault(prefix, [])
+            if len(tups) < 10:
+                tups.append((name, over_18))
 
     for name_prefix, subreddits in query_cache.iteritems():
         SubredditsByPartialName._set_values(name_prefix, {'tups': subreddits})
 
 def search_reddits(query, include_over_18=True):
+    index = get_prefix_index()
+    if index:
+        return [name for (name, over_18) in index.search(query)
+                if not over_18 or include_over_18]
+
     query = str(query.lower())
 
     try:
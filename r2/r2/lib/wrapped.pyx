@@ -24,7 +24,34 @@ from itertools import chain
 from datetime import datetime
 import re, types
 
-from hashlib import md5
+
+cdef unsigned long long _fmix64(unsigned long long h):
+    h ^= h >> 33
+    h *= 0xff51afd7ed558ccdULL
+    h ^= h >> 33
+    h *= 0xc4ceb9fe1a85ec53ULL
+    h ^= h >> 33
+    return h
+
+def render_hash(key):
+    """
+    A fast, non-cryptographic 128 bit hash of key (as 32 hex digits),
+    for naming render cache entries.  It runs two independent 64 bit
+    hashes over the (utf8) bytes in a single pass.
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf8")
+    cdef bytes data = key
+    cdef unsigned char *p = <unsigned char *>data
+    cdef Py_ssize_t i, n = len(data)
+    cdef unsigned long long h1 = 0xcbf29ce484222325ULL
+    cdef unsigned long long h2 = <unsigned long long>n
+    for i in range(n):
+        # FNV-1a
+        h1 = (h1 ^ p[i]) * 0x100000001b3ULL
+        h2 = (h2 ^ p[i]) * 0x9e3779b97f4a7c15ULL
+        h2 ^= h2 >> 29
+    return "%016x%016x" % (_fmix64(h1 ^ <unsigned long long>n), _fmix64(h2))
 
 class _TemplateUpdater(object):
     # this class is just a hack to get around Cython's closure rules
@@ -93,6 +120,94 @@ class StringTemplate(object):
         """
         return self.update(d).template
 
+    def expand_stubs(self, expander):
+        """
+        Returns an updated Template with the stubs known to expander
+        (a _StubExpander) replaced.
+        """
+        return self.__class__(expander.expand(self.template))
+
+
+class _StubExpander(object):
+    """
+    Replaces cache stubs in a rendering with the renderings they stand
+    for, whose own stubs are replaced in turn, all in one pass over
+    each rendering.
+
+    stubs maps stub names to (StringTemplate, kw) pairs, where kw is
+    applied to the template before its stubs are replaced.  Names in
+    kwargs are replaced (with their values, also expanded) wherever
+    they turn up, ahead of stubs of the same name.
+    """
+    def __init__(self, stubs, kwargs=None):
+        self.stubs = stubs
+        self.kwargs = kwargs or {}
+        self.pattern = StringTemplate.pattern2
+        self.expanded = {}
+        self.expanded_objects = {}
+
+    def expand(self, text):
+        return self.pattern.sub(self._convert, text)
+
+    def expand_object(self, obj):
+        """
+        The same as expand, for the dicts and lists that the json
+        templates render to, where stubs are CacheStub objects rather
+        than (or as well as) strings.
+        """
+        if isinstance(obj, basestring):
+            return self.expand(obj)
+        elif isinstance(obj, dict):
+            return dict((k, self.expand_object(v)) for k, v in obj.iteritems())
+        elif isinstance(obj, (list, tuple)):
+            return map(self.expand_object, obj)
+        elif isinstance(obj, CacheStub):
+            return self._convert_object(obj)
+        return obj
+
+    def _convert_object(self, stub):
+        name = stub.name
+        try:
+            return self.expanded_objects[name]
+        except KeyError:
+            pass
+
+        if name in self.kwargs:
+            value = self.kwargs[name]
+        elif name in self.stubs:
+            template, kw = self.stubs[name]
+            value = template.finalize(kw)
+        else:
+            return stub
+
+        self.expanded_objects[name] = stub
+        value = self.expand_object(value)
+        self.expanded_objects[name] = value
+        return value
+
+    def _convert(self, m):
+        name = m.group("named")
+        try:
+            return self.expanded[name]
+        except KeyError:
+            pass
+
+        if name in self.kwargs:
+            value = self.kwargs[name]
+            if not isinstance(value, basestring):
+                return value
+        elif name in self.stubs:
+            template, kw = self.stubs[name]
+            value = template.finalize(kw)
+        else:
+            return m.group(0)
+
+        # anything that contains itself is left with the stub in place
+        self.expanded[name] = m.group(0)
+        value = self.expand(value)
+        self.expanded[name] = value
+        return value
+
 
 class CacheStub(object):
     """
@@ -207,8 +322,7 @@ class Templated(object):
 
         if self.render_class_name in g.timed_templates:
             timer = g.stats.get_timer('render.%s.nocache' %
-                                      self.render_class_name,
-                                      publish=False)
+                                      self.render_class_name)
             timer.start()
         else:
             timer = None
@@ -260,8 +374,9 @@ class Templated(object):
         and will substituted last.
         """
         from pylons import c, g
+        timed = self.render_class_name in g.timed_templates
         timer = g.stats.get_timer('render.%s.cached' % self.render_class_name,
-                                  publish=False)
+                                  publish=timed)
         timer.start()
 
         style = style or c.render_style or 'html'
@@ -274,7 +389,14 @@ class Templated(object):
         # insert a stub for cachable non-primary templates
         if self.cachable:
             res = CacheStub(self, style)
-            cache_key = self.cache_key(attr, style)
+            if timed:
+                key_timer = g.stats.get_timer('render.%s.cache_key' %
+                                              self.render_class_name)
+                key_timer.start()
+                cache_key = self.cache_key(attr, style)
+                key_timer.stop()
+            else:
+                cache_key = self.cache_key(attr, style)
             # in the tracker, we need to store:
             #  The render cache key (res.name)
             #  The memcached cache key(cache_key)
@@ -282,17 +404,18 @@ class Templated(object):
             #  (kwargs)
             c.render_tracker[res.name] = (cache_key, (self,
                                                       (attr, style, kwargs)))
+            timer.intermediate('cache-key')
         else:
             # either a primary template or not cachable, so render it
             res = self.render_nocache(attr, style)
-        timer.intermediate('self-render')
+            timer.intermediate('self-render')
 
         # if this is the primary template, let the caching games begin
         if primary:
-            # updates will be the (self-updated) list of all of
-            # the cached templates that have been cached or
-            # rendered.
-            updates = {}
+            # stubs will be the list of all of the cached templates
+            # that have been cached or rendered, by stub name, as
+            # (cache_key, rendering, kw)
+            stubs = {}
             # to_cache is just the keys of the cached templates
             # that were not in the cache.
             to_cache = set([])
@@ -308,11 +431,7 @@ class Templated(object):
                 # to value
                 cached = self._read_cache(dict(current.values()))
                 timer.intermediate('fetch-cache')
-                # replacements will be a map of key -> rendered content
-                # for updateing the current set of updates
-                replacements = {}
 
-                new_updates = {}
                 # render items that didn't make it into the cached list
                 for key, (cache_key, others) in current.iteritems():
                     # unbundle the remaining args
@@ -320,64 +439,42 @@ class Templated(object):
                     if cache_key not in cached:
                         # this had to be rendered, so cache it later
                         to_cache.add(cache_key)
-                        # render the item and apply the stored kw args
                         r = item.render_nocache(attr, style)
                     else:
                         r = cached[cache_key]
-                    # store the unevaluated templates in
-                    # cached for caching
-                    replacements[key] = r.finalize(kw)
-                    new_updates[key] = (cache_key, (r, kw))
+                    stubs[key] = (cache_key, r, kw)
                 timer.intermediate('sub-render')
 
-                # update the updates so that when we can do the
-                # replacement in one pass.
-                
-                # NOTE: keep kw, but don't update based on them.
-                # We might have to cache these later, and we want
-                # to have things like $child present.
-                for k in updates.keys():
-                    cache_key, (value, kw) = updates[k]
-                    value = value.update(replacements)
-                    updates[k] = cache_key, (value, kw)
-
-                updates.update(new_updates)
-    
-            # at this point, we haven't touched res, but updates now
-            # has the list of all the updates we could conceivably
-            # want to make, and to_cache is the list of cache keys
-            # that we didn't find in the cache.
+            # at this point, we haven't touched res, but stubs now has
+            # all the renderings we could conceivably want to insert,
+            # and to_cache is the list of cache keys that we didn't
+            # find in the cache.
 
-            # cache content that was newly rendered
+            # a stub is replaced by its rendering with its own kw
+            # applied and its own stubs replaced.
+            renderings = dict((k, (r, kw))
+                              for k, (cache_key, r, kw) in stubs.iteritems())
+
+            # cache content that was newly rendered, with the stubs
+            # replaced (they're only good for this request) but keeping
+            # its kw, so things like $child are present.
+            expander = _StubExpander(renderings)
             _to_cache = {}
-            for k, (v, kw) in updates.values():
-                if k in to_cache:
-                    _to_cache[k] = v
+            for k, (cache_key, r, kw) in stubs.iteritems():
+                if cache_key in to_cache:
+                    _to_cache[cache_key] = r.expand_stubs(expander)
             self._write_cache(_to_cache)
             timer.intermediate('write-cache')
 
             # edge case: this may be the primary tempalte and cachable
             if isinstance(res, CacheStub):
-                res = updates[res.name][1][0]
-            timer.intermediate('replace')
+                res = stubs[res.name][1]
 
-            # now we can update the updates to make use of their kw args.
-            _updates = {}
-            for k, (foo, (v, kw)) in updates.iteritems():
-                _updates[k] = v.finalize(kw)
-            updates = _updates
-
-            # update the response to use these values
-            # replace till we can't replace any more. 
-            npasses = 0
-            while True:
-                npasses += 1
-                r = res
-                res = res.update(kwargs).update(updates)
-                semi_final = res.finalize()
-                if r.finalize() == res.finalize():
-                    res = semi_final
-                    break
+            # update the response to use these values, and the args
+            # passed in, in one pass.
+            expander = _StubExpander(renderings, kwargs)
+            res = res.expand_stubs(expander).finalize()
+            timer.intermediate('replace')
 
             # wipe out the render tracker object
             c.render_tracker = None
@@ -390,8 +487,7 @@ class Templated(object):
         return res
 
     def _cache_key(self, key):
-        return 'render_%s(%s)' % (self.__class__.__name__,
-                                  md5(key).hexdigest())
+        return 'render_%s(%s)' % (self.__class__.__name__, render_hash(key))
 
     def _write_cache(self, keys):
         from pylons import g
@@ -439,27 +535,67 @@ class Uncachable(Exception): pass
 
 _easy_cache_cls = set([bool, int, long, float, unicode, str, types.NoneType,
                       datetime])
+
+def _cachable_easy(v, a):
+    try:
+        return unicode(v)
+    except UnicodeDecodeError:
+        try:
+            return unicode(v, "utf8")
+        except (TypeError, UnicodeDecodeError):
+            return repr(v)
+
+def _cachable_ignored(v, a):
+    return None
+
+def _cachable_sequence(v, a):
+    return repr([make_cachable(x, *a) for x in v])
+
+def _cachable_dict(v, a):
+    ret = {}
+    for k in sorted(v.iterkeys()):
+        ret[k] = make_cachable(v[k], *a)
+    return repr(ret)
+
+def _cachable_cache_key(v, a):
+    return v.cache_key(*a)
+
+def _cachable_converter(cls):
+    """
+    Picks the function make_cachable uses for instances of cls, or
+    None if it has to look at each instance.
+    """
+    try:
+        if cls in _easy_cache_cls or issubclass(cls, type):
+            return _cachable_easy
+        elif issubclass(cls, (types.MethodType, CachedVariable)):
+            return _cachable_ignored
+        elif issubclass(cls, (tuple, list, set)):
+            return _cachable_sequence
+        elif issubclass(cls, dict):
+            return _cachable_dict
+        elif hasattr(cls, "cache_key"):
+            return _cachable_cache_key
+    except TypeError:
+        # something with a strange __class__
+        return None
+
+# class -> converter, filled in as make_cachable sees new classes
+cdef dict _cachable_converters = {}
+
 def make_cachable(v, *a):
     """
-    Given an arbitrary object, 
+    Given an arbitrary object, return a string to represent it in a
+    cache key (or None, for things that don't matter to the
+    rendering).  Raises Uncachable if there's no way to do that.
     """
-    if v.__class__ in _easy_cache_cls or isinstance(v, type):
-        try:
-            return unicode(v)
-        except UnicodeDecodeError:
-            try:
-                return unicode(v, "utf8")
-            except (TypeError, UnicodeDecodeError):
-                return repr(v)
-    elif isinstance(v, (types.MethodType, CachedVariable) ):
-       return
-    elif isinstance(v, (tuple, list, set)):
-        return repr([make_cachable(x, *a) for x in v])
-    elif isinstance(v, dict):
-        ret = {}
-        for k in sorted(v.iterkeys()):
-            ret[k] = make_cachable(v[k], *a)
-        return repr(ret)
+    cls = v.__class__
+    try:
+        converter = _cachable_converters[cls]
+    except KeyError:
+        converter = _cachable_converters[cls] = _cachable_converter(cls)
+    if converter is not None:
+        return converter(v, a)
     elif hasattr(v, "cache_key"):
         return v.cache_key(*a)
     else:
@@ -479,30 +615,63 @@ class CachedTemplate(Templated):
                 ret.append((k, self.__dict__[k]))
         return ret
 
-    def cache_key(self, attr, style, *a):
+    def _context_keys(self, style, *a):
+        """
+        The parts of the cache key that come from the request rather
+        than the template, as the lists that go before and after the
+        template's hash.  They're usually the same for every template
+        rendered in a request, so converting them is only done once per
+        distinct set of values.
+        """
         from pylons import c
 
-        # if template debugging is on, there will be no hash and we
-        # can make the caching process-local.
-        template_hash = getattr(self.template(style), "hash",
-                                id(self.__class__))
-
         # these values are needed to render any link on the site, and
         # a menu is just a set of links, so we best cache against
         # them.
-        keys = [c.user_is_loggedin, c.user_is_admin, c.domain_prefix,
-                style, c.secure, c.cname, c.lang, c.site.path,
-                getattr(c.user, "gold", False),
-                template_hash]
+        before = (c.user_is_loggedin, c.user_is_admin, c.domain_prefix,
+                  style, c.secure, c.cname, c.lang, c.site.path,
+                  getattr(c.user, "gold", False))
 
         # if viewing a single subreddit, take flair settings into account.
+        after = ()
         if c.user and hasattr(c.site, '_id'):
-            keys.extend([
+            after = (
                 c.site.flair_enabled, c.site.flair_position,
                 c.site.link_flair_position,
                 c.user.flair_enabled_in_sr(c.site._id),
-                c.user.pref_show_flair, c.user.pref_show_link_flair])
-        keys = [make_cachable(x, *a) for x in keys]
+                c.user.pref_show_flair, c.user.pref_show_link_flair)
+
+        # the memo is keyed on the values themselves, since c.user can be
+        # swapped out mid-request (e.g. for the UnloggedUser a cached
+        # comment pane is rendered as)
+        memo = getattr(c, "render_context_keys", None)
+        if not isinstance(memo, dict):
+            memo = c.render_context_keys = {}
+        memo_key = (before, after) + a
+        try:
+            return memo[memo_key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable values
+            memo_key = None
+
+        keys = ([make_cachable(x, *a) for x in before],
+                [make_cachable(x, *a) for x in after])
+        if memo_key is not None:
+            memo[memo_key] = keys
+        return keys
+
+    def cache_key(self, attr, style, *a):
+        from pylons import c
+
+        # if template debugging is on, there will be no hash and we
+        # can make the caching process-local.
+        template_hash = getattr(self.template(style), "hash",
+                                id(self.__class__))
+
+        before, after = self._context_keys(style, *a)
+        keys = before + [make_cachable(template_hash, *a)] + after
 
         # add all parameters sent into __init__, using their current value
         auto_keys = [(k,  make_cachable(v, attr, style, *a))
@@ -50,11 +50,10 @@ class _CommentBuilder(Builder):
     def get_items(self, num):
         from r2.lib.lock import TimeoutExpired
         cdef list cid
-        cdef dict cid_tree
-        cdef dict depth
-        cdef dict parents
         cdef dict sorter
 
+        # cids, cid_tree, depth, num_children and parents are dicts (a list
+        # for cids) or, for compact trees, views with the same interface
         r = link_comments_and_sort(self.link, self.sort.col)
         cids, cid_tree, depth, num_children, parents, sorter = r
 
@@ -842,6 +842,6 @@ class AccountsActiveBySR(tdb_cassandra.View):
         return cls.get_count_cached(sr._id36, _update=not cached)
 
     @classmethod
-    @memoize('accounts_active', time=60)
+    @memoize('accounts_active', time=60, early_recompute=True)
     def get_count_cached(cls, sr_id):
         return cls._cf.get_count(sr_id)
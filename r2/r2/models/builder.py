@@ -25,7 +25,7 @@ from link import *
 from vote import *
 from report import *
 from listing import Listing
-from pylons import g
+from pylons import c, g, request
 from pylons.i18n import _
 
 import subreddit
@@ -37,8 +37,8 @@ from r2.lib.comment_tree import user_messages, subreddit_messages
 from r2.lib.wrapped import Wrapped
 from r2.lib import utils
 from r2.lib.db import operators, tdb_cassandra
+from r2.lib.prefetch import Prefetch
 from r2.lib.filters import _force_unicode
-from copy import deepcopy
 from r2.lib.utils import Storage
 
 from r2.models import wiki
@@ -50,6 +50,26 @@ from admintools import compute_votes, admintools, ip_span, is_banned_domain
 EXTRA_FACTOR = 1.5
 MAX_RECURSION = 10
 
+# a follow-up fetch never asks for more than this many times what's missing
+MAX_FETCH_FACTOR = 5
+# how many items the learned keep ratio of a listing is worth when it's
+# combined with what the current request has seen so far
+KEEP_RATIO_WEIGHT = 10
+# how far each request moves the learned keep ratio towards what it saw
+KEEP_RATIO_DECAY = 0.2
+KEEP_RATIO_TTL = 24 * 60 * 60
+
+
+def _copy_rules(rules):
+    """Copy the lists holding a query's rules, but not the rules themselves.
+
+    Rules are only ever added to a query, never modified (the db layer works
+    on its own copy), so this is enough to put a query back the way it was.
+
+    """
+    return [_copy_rules(r) if isinstance(r, list) else r for r in rules]
+
+
 class Builder(object):
     def __init__(self, wrap=Wrapped, keep_fn=None, stale=True, spam_listing=False):
         self.stale = stale
@@ -63,30 +83,15 @@ class Builder(object):
         else:
             return item.keep_item(item)
 
-    def wrap_items(self, items):
+    def _get_likes(self, user, items):
         from r2.lib.db import queries
-        from r2.lib.template_helpers import add_attr
-        user = c.user if c.user_is_loggedin else None
-
-        #get authors
-        #TODO pull the author stuff into add_props for links and
-        #comments and messages?
-        aids = set(l.author_id for l in items if hasattr(l, 'author_id')
-                   and l.author_id is not None)
-
-        authors = {}
-        cakes = {}
-        friend_rels = None
-        if aids:
-            authors = Account._byID(aids, data=True, stale=self.stale) if aids else {}
-            now = datetime.datetime.now(g.tz)
-            cakes = {a._id for a in authors.itervalues()
-                     if a.cake_expiration and a.cake_expiration >= now}
-            if user and user.gold:
-                friend_rels = user.friend_rels()
-
-        subreddits = Subreddit.load_subreddits(items, stale=self.stale)
+        try:
+            return queries.get_likes(user, items)
+        except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
+            g.log.warning("Cassandra vote lookup failed: %r", e)
+            return {}
 
+    def _sr_permissions(self, user, subreddits):
         can_ban_set = set()
         can_flair_set = set()
         can_own_flair_set = set()
@@ -98,13 +103,44 @@ class Builder(object):
                     can_flair_set.add(sr_id)
                 if sr.link_flair_self_assign_enabled:
                     can_own_flair_set.add(sr_id)
+        return can_ban_set, can_flair_set, can_own_flair_set
 
+    def wrap_items(self, items):
+        from r2.lib.template_helpers import add_attr
+        user = c.user if c.user_is_loggedin else None
+
+        #get authors
+        #TODO pull the author stuff into add_props for links and
+        #comments and messages?
+        aids = set(l.author_id for l in items if hasattr(l, 'author_id')
+                   and l.author_id is not None)
+
+        # none of these depend on each other (except the permissions on
+        # the subreddits), so look them up all at once
+        prefetch = Prefetch("wrap_items")
+        if aids:
+            prefetch.add("authors", Account._byID, aids, data=True,
+                         stale=self.stale)
+            if user and user.gold:
+                prefetch.add("friend_rels", user.friend_rels)
+        prefetch.add("subreddits", Subreddit.load_subreddits, items,
+                     stale=self.stale)
+        prefetch.add("permissions", self._sr_permissions, user,
+                     after=["subreddits"])
         #get likes/dislikes
-        try:
-            likes = queries.get_likes(user, items)
-        except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
-            g.log.warning("Cassandra vote lookup failed: %r", e)
-            likes = {}
+        prefetch.add("likes", self._get_likes, user, items)
+        prefetched = prefetch.run()
+
+        authors = prefetched.get("authors", {})
+        friend_rels = prefetched.get("friend_rels")
+        subreddits = prefetched["subreddits"]
+        can_ban_set, can_flair_set, can_own_flair_set = \
+            prefetched["permissions"]
+        likes = prefetched["likes"]
+
+        now = datetime.datetime.now(g.tz)
+        cakes = {a._id for a in authors.itervalues()
+                 if a.cake_expiration and a.cake_expiration >= now}
         uid = user._id if user else None
 
         types = {}
@@ -346,10 +382,71 @@ class QueryBuilder(Builder):
             q._reverse()
 
         q._data = True
-        self.orig_rules = deepcopy(q._rules)
+        self.orig_rules = _copy_rules(q._rules)
         if self.after:
             q._after(self.after)
 
+    def continue_after(self, last_item):
+        """Point the query at the items following last_item."""
+        q = self.query
+        q._rules = _copy_rules(self.orig_rules)
+        q._after(last_item)
+
+    def listing_name(self):
+        """The name this kind of listing's stats are kept under."""
+        try:
+            action = request.environ["pylons.routes_dict"]["action"]
+        except (TypeError, KeyError):
+            # not in a request
+            action = None
+        if action:
+            return "%s.%s" % (self.__class__.__name__, action)
+        return self.__class__.__name__
+
+    def _keep_ratio_key(self):
+        try:
+            site = getattr(c.site, "_id", None) or c.site.__class__.__name__
+        except (TypeError, AttributeError):
+            site = None
+        return "builder_keep_ratio-%s-%s" % (self.listing_name(), site)
+
+    def load_keep_ratio(self):
+        """Look up the share of fetched items this listing usually keeps."""
+        self.stored_keep_ratio = g.cache.get(self._keep_ratio_key())
+        if self.stored_keep_ratio is None:
+            self.learned_keep_ratio = 1.
+        else:
+            self.learned_keep_ratio = self.stored_keep_ratio
+
+    def save_keep_ratio(self, num_have):
+        """Fold the share of items kept this time into the learned one."""
+        if not self.num_seen:
+            return
+        seen_ratio = float(num_have) / self.num_seen
+        old_ratio = self.stored_keep_ratio
+        if old_ratio is None:
+            new_ratio = seen_ratio
+        else:
+            new_ratio = old_ratio + KEEP_RATIO_DECAY * (seen_ratio - old_ratio)
+            if abs(new_ratio - old_ratio) < 0.01:
+                # not worth the write
+                return
+        g.cache.set(self._keep_ratio_key(), new_ratio, time=KEEP_RATIO_TTL)
+
+    def keep_ratio(self, num_have):
+        """Estimate the share of the next fetched items that will be kept."""
+        return ((num_have + KEEP_RATIO_WEIGHT * self.learned_keep_ratio) /
+                (self.num_seen + KEEP_RATIO_WEIGHT))
+
+    def fetch_size(self, num_need, num_have):
+        """How many items to fetch to end up with num_need more."""
+        ratio = self.keep_ratio(num_have)
+        if ratio > 0:
+            factor = min(EXTRA_FACTOR / ratio, MAX_FETCH_FACTOR)
+        else:
+            factor = MAX_FETCH_FACTOR
+        return max(int(num_need * factor), 1)
+
     def fetch_more(self, last_item, num_have):
         done = False
         q = self.query
@@ -362,10 +459,9 @@ class QueryBuilder(Builder):
                 #q = self.query
                 #check last_item if we have a num because we may need to iterate
                 if last_item:
-                    q._rules = deepcopy(self.orig_rules)
-                    q._after(last_item)
+                    self.continue_after(last_item)
                     last_item = None
-                q._limit = max(int(num_need * EXTRA_FACTOR), 1)
+                q._limit = self.fetch_size(num_need, num_have)
         else:
             done = True
         new_items = list(q)
@@ -374,6 +470,9 @@ class QueryBuilder(Builder):
 
     def get_items(self):
         self.init_query()
+        self.num_seen = 0
+        if self.num:
+            self.load_keep_ratio()
 
         num_have = 0
         done = False
@@ -393,6 +492,7 @@ class QueryBuilder(Builder):
             self.loopcount += 1
             if self.loopcount == 20:
                 g.log.debug('BREAKING: %s' % self)
+                self.count_stat("loop_limit")
                 done = True
 
             #no results, we're done
@@ -424,6 +524,7 @@ class QueryBuilder(Builder):
             #skip and count
             while new_items and (not self.num or num_have < self.num):
                 i = new_items.pop(0)
+                self.num_seen += 1
 
                 if not (self.must_skip(i) or self.skip and not self.keep_item(i)):
                     items.append(i)
@@ -437,6 +538,11 @@ class QueryBuilder(Builder):
             if last_item and (self.prewrap_fn or self.wrap):
                 last_item = orig_items[last_item._id]
 
+        self.count_stat("listings")
+        self.count_stat("loops", self.loopcount)
+        if self.num:
+            self.save_keep_ratio(num_have)
+
         if self.reverse:
             items.reverse()
             last_item, first_item = first_item, have_next and last_item
@@ -454,6 +560,11 @@ class QueryBuilder(Builder):
                 before_count,
                 after_count)
 
+    def count_stat(self, name, delta=1):
+        counter = g.stats.get_counter("builder.%s" % self.listing_name())
+        if counter:
+            counter.increment(name, delta=delta)
+
 class IDBuilder(QueryBuilder):
     def thing_lookup(self, names):
         return Thing._by_fullname(names, data=True, return_dict=False,
@@ -495,7 +606,7 @@ class IDBuilder(QueryBuilder):
             else:
                 if last_item:
                     last_item = None
-                slice_size = max(int(num_need * EXTRA_FACTOR), 1)
+                slice_size = self.fetch_size(num_need, num_have)
         else:
             slice_size = len(names)
             done = True
@@ -20,6 +20,10 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Mapping
+
 from r2.lib.db import tdb_cassandra
 from r2.lib import utils
 from r2.models.last_modified import LastModified
@@ -32,6 +36,202 @@ from pycassa.system_manager import ASCII_TYPE, COUNTER_COLUMN_TYPE
 from pylons import g
 
 
+class _CompactTreeView(Mapping):
+    """dict-alike over one of the attributes of a CompactCommentTree.
+
+    Lookups go through to the tree's arrays. Assignments are kept in a
+    small overlay on the view and copy() gives a view with its own copy of
+    the overlay, so callers that treat these as scratch dicts work without
+    the whole thing ever being materialized.
+    """
+
+    def __init__(self, getter, keys, overrides=None):
+        self._getter = getter
+        self._keys = keys
+        self._overrides = overrides or {}
+
+    def __getitem__(self, key):
+        if key in self._overrides:
+            return self._overrides[key]
+        return self._getter(key)
+
+    def __setitem__(self, key, value):
+        self._overrides[key] = value
+
+    def __iter__(self):
+        for key in self._keys():
+            if key not in self._overrides:
+                yield key
+        for key in self._overrides:
+            yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def has_key(self, key):
+        return key in self
+
+    def copy(self):
+        return _CompactTreeView(self._getter, self._keys,
+                                dict(self._overrides))
+
+    def __repr__(self):
+        return "<%s with %d overrides>" % (self.__class__.__name__,
+                                          len(self._overrides))
+
+
+class CompactCommentTree(object):
+    """Read-only comment tree stored as flat arrays of ints.
+
+    The comments are kept sorted by id in `_cids` with their parent id,
+    depth and number of descendants at the same index of `_pids`,
+    `_depths` and `_num_children`. A second copy of the (parent, child)
+    pairs sorted by parent gives each comment's children as a contiguous
+    slice. Top-level comments have a parent of -1 in the arrays and None
+    everywhere else.
+
+    The cids, tree, depth, num_children and parents attributes give the
+    same information in the shape of CommentTree's attributes without
+    building any dicts; to_dicts() builds the real thing for code that
+    needs to modify the tree.
+    """
+
+    def __init__(self, cids, pids, depths, num_children):
+        self._cids = array('l', cids)
+        self._pids = array('l', pids)
+        self._depths = array('l', depths)
+        self._num_children = array('l', num_children)
+
+        # cids are sorted, so a stable sort by parent keeps siblings in order
+        pids = self._pids.tolist()
+        cids = self._cids.tolist()
+        order = sorted(xrange(len(pids)), key=pids.__getitem__)
+        self._by_parent_pids = array('l', map(pids.__getitem__, order))
+        self._by_parent_cids = array('l', map(cids.__getitem__, order))
+
+        self.cids = _CompactCidsView(self)
+        self.tree = _CompactTreeView(self.get_children, self._parent_ids)
+        self.depth = _CompactTreeView(self.get_depth, self._comment_ids)
+        self.num_children = _CompactTreeView(self.get_num_children,
+                                             self._comment_ids)
+        self.parents = _CompactTreeView(self.get_parent, self._comment_ids)
+
+    @classmethod
+    def from_row(cls, row):
+        """Build from CommentTreeStorageV2 columns.
+
+        row is an iterable of ((depth, parent_id, comment_id), subtree_size)
+        where a parent_id of -1 or None means a top-level comment.
+        """
+        entries = {}
+        for (d, pid, cid), val in row:
+            if cid == -1:
+                continue
+            # if a comment somehow appears twice the last one wins, same as
+            # the dicts
+            entries[cid] = (-1 if pid is None else pid, d, val - 1)
+        cids = sorted(entries)
+        if not cids:
+            return cls((), (), (), ())
+        pids, depths, num_children = zip(*map(entries.__getitem__, cids))
+        return cls(cids, pids, depths, num_children)
+
+    def _index(self, cid):
+        if cid is None:
+            raise KeyError(cid)
+        i = bisect_left(self._cids, cid)
+        if i == len(self._cids) or self._cids[i] != cid:
+            raise KeyError(cid)
+        return i
+
+    def _children_range(self, pid):
+        if pid is None:
+            pid = -1
+        return (bisect_left(self._by_parent_pids, pid),
+                bisect_right(self._by_parent_pids, pid))
+
+    def _comment_ids(self):
+        return iter(self._cids)
+
+    def _parent_ids(self):
+        last = None
+        for pid in self._by_parent_pids:
+            if pid != last:
+                yield None if pid == -1 else pid
+                last = pid
+
+    def __contains__(self, cid):
+        try:
+            self._index(cid)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._cids)
+
+    def __iter__(self):
+        return iter(self._cids)
+
+    def get_parent(self, cid):
+        pid = self._pids[self._index(cid)]
+        return None if pid == -1 else pid
+
+    def get_depth(self, cid):
+        return self._depths[self._index(cid)]
+
+    def get_num_children(self, cid):
+        return self._num_children[self._index(cid)]
+
+    def get_children(self, pid):
+        """List of ids of pid's immediate children; KeyError if none."""
+        start, end = self._children_range(pid)
+        if start == end:
+            raise KeyError(pid)
+        return self._by_parent_cids[start:end].tolist()
+
+    def has_children(self, pid):
+        start, end = self._children_range(pid)
+        return start != end
+
+    def to_dicts(self):
+        """The tree as keyword arguments for CommentTree."""
+        tree = {}
+        parents = {}
+        for pid, cid in zip(self._by_parent_pids, self._by_parent_cids):
+            pid = None if pid == -1 else pid
+            tree.setdefault(pid, []).append(cid)
+            parents[cid] = pid
+        return dict(cids=self._cids.tolist(),
+                    tree=tree,
+                    depth=dict(zip(self._cids, self._depths)),
+                    num_children=dict(zip(self._cids, self._num_children)),
+                    parents=parents)
+
+    def __repr__(self):
+        return "<%s with %d comments>" % (self.__class__.__name__, len(self))
+
+
+class _CompactCidsView(object):
+    """List-alike of a CompactCommentTree's comment ids."""
+
+    def __init__(self, tree):
+        self._tree = tree
+
+    def __contains__(self, cid):
+        return cid in self._tree
+
+    def __iter__(self):
+        return iter(self._tree)
+
+    def __len__(self):
+        return len(self._tree)
+
+    def __repr__(self):
+        return "<%s of %d comments>" % (self.__class__.__name__,
+                                        len(self._tree))
+
+
 class CommentTreeStorageBase(object):
     _maintain_num_children = True
 
@@ -190,40 +390,39 @@ class CommentTreeStorageV2(CommentTreeStorageBase):
     @classmethod
     def get_row(cls, key):
         row = []
-        size = 0
-        column_start = ''
+        batch = cls._cf.get(key, column_count=cls.COLUMN_READ_BATCH_SIZE)
+        row.extend(batch.iteritems())
+        if len(batch) < cls.COLUMN_READ_BATCH_SIZE:
+            return row
+
+        # the row didn't fit in one read. every comment's ancestors have
+        # columns at each lower depth, so the depths are contiguous and the
+        # first one with no columns is the end of the row. fetch the rest of
+        # the current depth and the next few depths at once until we get
+        # to it.
+        fanout = max(tdb_cassandra.column_fetch_fanout, 1)
+        depth, pid, cid = row[-1][0]
+        ranges = [(key, (depth, pid if pid is not None else -1, cid + 1),
+                   (depth,))]
+        depth += 1
         while True:
-            batch = cls._cf.get(key, column_count=cls.COLUMN_READ_BATCH_SIZE,
-                                column_start=column_start)
-            row.extend(batch.iteritems())
-            num_fetched = len(row) - size
-            size = len(row)
-            if num_fetched < cls.COLUMN_READ_BATCH_SIZE:
+            ranges.extend((key, (d,), (d,))
+                          for d in xrange(depth, depth + fanout))
+            slices = tdb_cassandra.get_column_ranges(
+                cls._cf, ranges, page_size=cls.COLUMN_READ_BATCH_SIZE,
+                max_workers=fanout)
+            for columns in slices:
+                row.extend(columns.iteritems())
+            if not slices[-1]:
                 break
-            depth, pid, cid = row[-1][0]
-            column_start = (depth, pid if pid is not None else -1, cid + 1)
+            depth += fanout
+            ranges = []
         return row
 
     @classmethod
     def _from_row(cls, row):
-        # row is a dict of {(depth, parent_id, comment_id): subtree_size}
-        cids = []
-        tree = {}
-        depth = {}
-        parents = {}
-        num_children = {}
-        for (d, pid, cid), val in row:
-            if cid == -1:
-                continue
-            if pid == -1:
-                pid = None
-            cids.append(cid)
-            tree.setdefault(pid, []).append(cid)
-            depth[cid] = d
-            parents[cid] = pid
-            num_children[cid] = val - 1
-        return dict(cids=cids, tree=tree, depth=depth,
-                    num_children=num_children, parents=parents)
+        # row is a list of ((depth, parent_id, comment_id), subtree_size)
+        return dict(compact=CompactCommentTree.from_row(row))
 
     @classmethod
     @tdb_cassandra.will_write
@@ -391,6 +590,9 @@ class CommentTree:
       - parents: dict of int to int; each entry in cids has a key in this dict,
           and the corresponding value is the ID of that comment's parent (or
           None in the case of top-level comments)
+      - compact: CompactCommentTree or None; implementations that load the
+          whole tree at once (V2) return it in this form, and the attributes
+          above are only built from it when something asks for them
     """
 
     IMPLEMENTATIONS = {
@@ -400,11 +602,23 @@ class CommentTree:
 
     DEFAULT_IMPLEMENTATION = 2
 
+    TREE_ATTRS = ('cids', 'tree', 'depth', 'num_children', 'parents')
+
     def __init__(self, link, **kw):
         self.link = link
         self.link_id = link._id
+        self.compact = None
         self.__dict__.update(kw)
 
+    def __getattr__(self, attr):
+        # only called for attributes that aren't set, i.e. the dicts of a
+        # tree that was loaded in compact form
+        if attr in self.TREE_ATTRS and self.compact is not None:
+            self.__dict__.update(self.compact.to_dicts())
+            self.compact = None
+            return self.__dict__[attr]
+        raise AttributeError(attr)
+
     @classmethod
     def mutation_context(cls, link, timeout=None):
         impl = cls.IMPLEMENTATIONS[link.comment_tree_version]
@@ -37,7 +37,7 @@ from subreddit import DefaultSR, DomainSR, Subreddit
 from printable import Printable
 from r2.config import cache, extensions
 from r2.lib.memoize import memoize
-from r2.lib.filters import _force_utf8, _force_unicode
+from r2.lib.filters import _force_utf8, _force_unicode, prefetch_markdown
 from r2.lib import hooks, utils
 from r2.lib.log import log_text
 from mako.filters import url_escape
@@ -1140,6 +1140,13 @@ class Comment(Thing, Printable):
 
             item.lastedited = CachedVariable("lastedited")
 
+        # have the bodies' markdown looked up in one go when usertext.html
+        # renders the first of them (if the listing is rendered at all)
+        target_override = '_blank' if c.user.pref_newwindow else None
+        prefetch_markdown([(item.body, item.nofollow,
+                            target_override or item.target)
+                           for item in wrapped])
+
         # Run this last
         Printable.add_props(user, wrapped)
 
@@ -35,7 +35,7 @@ from link import Link, Comment
 from pylons import g
 from datetime import datetime, timedelta
 
-__all__ = ['Vote', 'score_changes']
+__all__ = ['Vote', 'VoteDirections', 'score_changes']
 
 def score_changes(amount, old_amount):
     uc = dc = 0
@@ -248,8 +248,18 @@ class Vote(MultiRelation('vote',
         from r2.models import Account
         assert isinstance(sub, Account)
 
+        return cls.likes_multi((sub, obj) for obj in objs)
+
+    @classmethod
+    def likes_multi(cls, pairs):
+        """The vote directions for many (account, thing) pairs at once.
+
+        The accounts can all be different: each vote rel is read with a
+        single multiget across all of them.
+
+        """
         rels = {}
-        for obj in objs:
+        for sub, obj in pairs:
             try:
                 types = VotesByAccount.rel(sub.__class__, obj.__class__)
             except TdbException:
@@ -257,13 +267,73 @@ class Vote(MultiRelation('vote',
                 # skip them
                 continue
 
-            rels.setdefault(types, []).append(obj)
-
-        dirs_by_name = {"1": True, "0": None, "-1": False}
+            rels.setdefault(types, []).append((sub, obj))
 
         ret = {}
-        for relcls, items in rels.iteritems():
-            votes = relcls.fast_query(sub, items)
+        for relcls, rel_pairs in rels.iteritems():
+            votes = relcls.fast_query_multi(rel_pairs)
             for cross, name in votes.iteritems():
-                ret[cross] = dirs_by_name[name]
+                ret[cross] = VoteDirections.dirs_by_name[name]
         return ret
+
+
+class VoteDirections(object):
+    """The vote directions of some accounts on a shared list of things.
+
+    Each account's directions are kept as a pair of bitsets over the
+    positions of the things (one for upvotes, one for downvotes), so the
+    votes of many accounts on a listing take little room to keep around or
+    cache.
+
+        directions = VoteDirections(links)
+        directions.update(queries.get_likes_multi(pairs))
+        directions.get(user, link)      # True, False or None
+        directions.for_account(user)    # [True, None, ...] in links' order
+
+    """
+
+    dirs_by_name = {"1": True, "0": None, "-1": False}
+
+    def __init__(self, things):
+        self.fullnames = [thing._fullname for thing in things]
+        self.positions = {fullname: i
+                          for i, fullname in enumerate(self.fullnames)}
+        self.ups = {}
+        self.downs = {}
+
+    def __len__(self):
+        return len(self.fullnames)
+
+    def set(self, account, thing, direction):
+        bit = 1 << self.positions[thing._fullname]
+        ups = self.ups.get(account._id, 0) & ~bit
+        downs = self.downs.get(account._id, 0) & ~bit
+        if direction is True:
+            ups |= bit
+        elif direction is False:
+            downs |= bit
+        self.ups[account._id] = ups
+        self.downs[account._id] = downs
+
+    def update(self, likes):
+        """Add the directions from a {(account, thing): direction} dict."""
+        for (account, thing), direction in likes.iteritems():
+            if thing._fullname in self.positions:
+                self.set(account, thing, direction)
+
+    def get(self, account, thing):
+        i = self.positions.get(thing._fullname)
+        if i is None:
+            return None
+        if self.ups.get(account._id, 0) >> i & 1:
+            return True
+        elif self.downs.get(account._id, 0) >> i & 1:
+            return False
+        return None
+
+    def for_account(self, account):
+        """The account's directions, in the order of the things."""
+        ups = self.ups.get(account._id, 0)
+        downs = self.downs.get(account._id, 0)
+        return [True if ups >> i & 1 else False if downs >> i & 1 else None
+                for i in xrange(len(self.fullnames))]
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import collections
+import unittest
+
+from r2.tests import stage_for_paste
+
+stage_for_paste()
+
+from r2.config.queues import declare_queues
+from r2.lib.amqp import shard_for
+from r2.lib.utils import Storage
+
+
+def config(**kw):
+    g = Storage(queue_shards={}, shard_link_vote_queues=False,
+                shard_commentstree_queues=False)
+    g.update(kw)
+    return g
+
+
+class ShardTest(unittest.TestCase):
+    def test_shard_for(self):
+        shards = [shard_for(key, 10) for key in xrange(10000)]
+        self.assertEqual(shards, [shard_for(key, 10) for key in xrange(10000)])
+
+        counts = collections.Counter(shards)
+        self.assertEqual(sorted(counts), range(10))
+        self.assertTrue(min(counts.values()) > 800)
+
+        # only the keys that go to the new shard move
+        for key in xrange(10000):
+            shard = shard_for(key, 11)
+            self.assertTrue(shard == shards[key] or shard == 10)
+
+    def test_declare_shards(self):
+        queues = declare_queues(config(queue_shards={"vote_link_q": 3}))
+        self.assertEqual(queues.vote_link_q.shard_names,
+                         ["vote_link_0_q", "vote_link_1_q", "vote_link_2_q"])
+        self.assertTrue(("vote_link_1_q", "vote_link_1_q") in queues.bindings)
+        self.assertEqual(queues.vote_link_1_q.consumer,
+                         queues.vote_link_q.consumer)
+        self.assertEqual(queues.commentstree_q.shard_names, [])
+
+        queues = declare_queues(config(shard_commentstree_queues=True))
+        self.assertEqual(len(queues.commentstree_q.shard_names), 10)
+
+        self.assertRaises(ValueError, declare_queues,
+                          config(queue_shards={"scraper_q": 2}))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from r2.lib import cache
+from r2.lib.invalidation import LocalInvalidationChannel
+
+
+class BoundedLocalCacheTest(unittest.TestCase):
+    def test_lru_eviction(self):
+        lc = cache.BoundedLocalCache(max_items=2)
+        lc.set('a', 1)
+        lc.set('b', 2)
+        self.assertEquals(1, lc.get('a'))  # 'b' is now the oldest
+        lc.set('c', 3)
+        self.assertEquals({'a': 1, 'c': 3},
+                          lc.simple_get_multi(['a', 'b', 'c']))
+        self.assertEquals(1, lc.evictions)
+
+    def test_byte_limit(self):
+        lc = cache.BoundedLocalCache(max_bytes=25)
+        lc.set('a', 'x' * 10)
+        lc.set('b', 'y' * 10)
+        self.assertEquals(22, lc.bytes)
+        lc.set('c', 'z' * 10)
+        self.assertFalse('a' in lc)
+        self.assertEquals(22, lc.bytes)
+        lc.delete('b')
+        self.assertEquals(11, lc.bytes)
+
+    def test_expiry(self):
+        now = [1000.]
+        orig_time = cache.time_module.time
+        cache.time_module.time = lambda: now[0]
+        try:
+            lc = cache.BoundedLocalCache()
+            lc.set('a', 1, time=10)
+            lc.set('b', 2)
+            lc.set('c', 3, time=now[0] + cache.MAX_RELATIVE_TIME + 5)
+            now[0] += 11
+            self.assertEquals(None, lc.get('a'))
+            self.assertFalse('a' in lc)
+            self.assertEquals(2, lc.get('b'))
+            self.assertEquals(3, lc.get('c'))
+            self.assertEquals(1, lc.expirations)
+            self.assertTrue(lc.add('a', 4))
+            self.assertFalse(lc.add('a', 5))
+        finally:
+            cache.time_module.time = orig_time
+
+    def test_dict_interface(self):
+        lc = cache.BoundedLocalCache(max_items=2)
+        lc.update({'a': 1, 'b': 2, 'c': 3})
+        self.assertEquals(2, len(lc))
+        lc.incr('c', 5)
+        self.assertEquals(8, lc['c'])
+        self.assertRaises(KeyError, lambda: lc['nope'])
+        lc.clear()
+        self.assertEquals(0, len(lc))
+        self.assertEquals(0, lc.bytes)
+
+    def test_counters(self):
+        lc = cache.BoundedLocalCache()
+        lc.set('a', 1)
+        lc.get('a')
+        lc.get('b')
+        lc.simple_get_multi(['a', 'b'])
+        self.assertEquals((2, 2), (lc.hits, lc.misses))
+
+
+class DictCache(cache.CacheUtils):
+    """A stand-in for memcache (chains treat a LocalCache as in-process)"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def simple_get_multi(self, keys):
+        return dict((key, self.data[key]) for key in keys if key in self.data)
+
+    def set(self, key, val, time=0):
+        self.data[key] = val
+
+    def set_multi(self, keys, prefix='', time=0):
+        for key, val in keys.iteritems():
+            self.set(prefix + str(key), val)
+
+
+class ProcessCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.channel = LocalInvalidationChannel()
+        self.pc = cache.ProcessCache(['Link_'], time=30, channel=self.channel)
+
+    def test_only_wanted_prefixes(self):
+        self.pc.set_multi({'Link_1': 1, 'Comment_1': 2})
+        self.assertEquals({'Link_1': 1},
+                          self.pc.simple_get_multi(['Link_1', 'Comment_1']))
+
+    def test_returns_copies(self):
+        self.pc.set('Link_1', [1])
+        self.pc.get('Link_1').append(2)
+        self.assertEquals([1], self.pc.get('Link_1'))
+
+    def test_invalidation(self):
+        self.pc.set('Link_1', 1)
+        self.pc.set('Link_2', 2)
+        self.pc.publish_invalidation(['Link_1', 'Comment_1'])
+        self.assertEquals(None, self.pc.get('Link_1'))
+        self.assertEquals(2, self.pc.get('Link_2'))
+        self.pc.invalidate(None)
+        self.assertEquals(None, self.pc.get('Link_2'))
+
+    def test_survives_chain_reset(self):
+        memcache = cache.LocalCache()
+        chain = cache.CacheChain((cache.LocalCache(), self.pc, memcache))
+        memcache.set('Link_1', 1)
+        self.assertEquals(1, chain.get('Link_1'))
+        memcache.delete('Link_1')
+        chain.reset()
+        self.assertEquals(1, chain.get('Link_1'))
+        self.assertEquals(None, chain.get('Link_1', allow_local=False))
+
+    def test_stale_chain_skips_process_cache(self):
+        memcache = DictCache()
+        chain = cache.StaleCacheChain(cache.LocalCache(), cache.LocalCache(),
+                                      memcache, processcache=self.pc)
+        chain.set('Link_1', 1)
+        self.assertEquals(1, self.pc.get('Link_1'))
+
+        # written by another process whose invalidation hasn't arrived yet
+        memcache.set('Link_1', 2)
+        chain.reset()
+        self.assertEquals(1, chain.get('Link_1'))
+        chain.reset()
+        self.assertEquals({'Link_1': 1},
+                          chain.simple_get_multi(['Link_1'], allow_local=True))
+
+        # but reads that won't take local results go past it
+        self.assertEquals({'Link_1': 2},
+                          chain.simple_get_multi(['Link_1'], allow_local=False))
+        memcache.set('Link_1', 3)
+        self.assertEquals(3, chain.get('Link_1', allow_local=False))
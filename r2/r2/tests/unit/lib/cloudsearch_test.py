@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import BaseHTTPServer
+import threading
+import unittest
+
+from lxml import etree
+
+from r2.lib.cloudsearch import (chunk_docs, CloudSearchDocumentClient,
+                                CloudSearchHTTPError)
+
+
+class FakeDocumentHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        with server.lock:
+            server.bodies.append(body)
+            server.connections.add(self.client_address)
+        if "fail" in body:
+            self.send_response(400)
+            response = "bad"
+        else:
+            self.send_response(200)
+            response = '<response status="success" adds="%d" deletes="0"/>'
+            response = response % body.count("<add")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *a):
+        pass
+
+
+class FakeDocumentServer(BaseHTTPServer.HTTPServer):
+    """Local stand-in for a cloudsearch document endpoint"""
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           FakeDocumentHandler)
+        self.lock = threading.Lock()
+        self.bodies = []
+        self.connections = set()
+
+
+class ThreadedFakeDocumentServer(FakeDocumentServer):
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.finish_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        thread.start()
+
+    def finish_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def make_doc(i):
+    return etree.Element("add", id="t3_%d" % i, version="1", lang="en")
+
+
+class ChunkDocsTest(unittest.TestCase):
+    def test_one_chunk(self):
+        chunks = list(chunk_docs(make_doc(i) for i in xrange(3)))
+        self.assertEqual(len(chunks), 1)
+        batch = etree.fromstring(chunks[0])
+        self.assertEqual([doc.get("id") for doc in batch],
+                         ["t3_0", "t3_1", "t3_2"])
+
+    def test_size_bounded(self):
+        doc_size = len(etree.tostring(make_doc(0)))
+        max_size = doc_size * 4
+        chunks = list(chunk_docs((make_doc(i) for i in xrange(10)),
+                                 max_size=max_size))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(len(chunk) < max_size for chunk in chunks))
+        ids = [doc.get("id") for chunk in chunks
+               for doc in etree.fromstring(chunk)]
+        self.assertEqual(ids, ["t3_%d" % i for i in xrange(10)])
+
+    def test_accepts_batch_element(self):
+        batch = etree.Element("batch")
+        batch.extend(make_doc(i) for i in xrange(2))
+        self.assertEqual(list(chunk_docs(batch)), [etree.tostring(batch)])
+
+    def test_empty(self):
+        self.assertEqual(list(chunk_docs([])), [])
+
+
+class DocumentClientTest(unittest.TestCase):
+    server_class = FakeDocumentServer
+    connections = 1
+
+    def setUp(self):
+        self.server = self.server_class()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        host, port = self.server.server_address
+        self.client = CloudSearchDocumentClient(host, port=port,
+                                                connections=self.connections)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for i in xrange(3):
+            response = self.client.post("<batch><add/></batch>")
+            self.assertEqual(etree.fromstring(response).get("adds"), "1")
+        self.assertEqual(len(self.server.bodies), 3)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_error(self):
+        self.assertRaises(CloudSearchHTTPError, self.client.post,
+                          "<batch><fail/></batch>")
+
+    def test_post_many_in_order(self):
+        batches = (("<batch>%s</batch>" % ("<add/>" * i), i)
+                   for i in xrange(10))
+        results = list(self.client.post_many(batches))
+        self.assertEqual([token for token, response in results], range(10))
+        self.assertEqual([etree.fromstring(response).get("adds")
+                          for token, response in results],
+                         [str(i) for i in xrange(10)])
+
+
+class ParallelDocumentClientTest(DocumentClientTest):
+    server_class = ThreadedFakeDocumentServer
+    connections = 3
+
+    def test_post_many_reuses_connections(self):
+        batches = (("<batch><add/></batch>", i) for i in xrange(20))
+        list(self.client.post_many(batches))
+        self.assertEqual(len(self.server.bodies), 20)
+        self.assertTrue(len(self.server.connections) <= 3)
+
+    def test_post_many_raises(self):
+        batches = [("<batch><add/></batch>", 0), ("<batch><fail/></batch>", 1)]
+        self.assertRaises(CloudSearchHTTPError, list,
+                          self.client.post_many(batches))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import cPickle as pickle
+import unittest
+
+from r2.lib.db import packed_results
+
+
+class PackedResultsTest(unittest.TestCase):
+    def test_round_trip(self):
+        tuples = [('t3_zz', 1234.5, 1367000000.25),
+                  ('t3_1', 12.0, 1367000000.0),
+                  ('t3_abc', -3.0, 1366000000.5)]
+        packed = packed_results.pack_results(tuples)
+        self.assertTrue(packed_results.is_packed(packed))
+        self.assertEquals(tuples, packed_results.unpack_results(packed))
+        self.assertTrue(len(packed) < len(pickle.dumps(tuples, -1)))
+
+    def test_unpackable_left_alone(self):
+        mixed_types = [('t3_1', 1.0), ('t1_2', 0.5)]
+        self.assertEquals(mixed_types,
+                          packed_results.pack_results(mixed_types))
+        strings = [('t3_1', 'a')]
+        self.assertEquals(strings, packed_results.pack_results(strings))
+        self.assertEquals([], packed_results.pack_results([]))
+
+    def test_reads_old_values(self):
+        old = [('t3_1', 5.0, 1.0)]
+        self.assertEquals(old, packed_results.unpack_results(old))
+        self.assertEquals(None, packed_results.unpack_results(None))
+
+    def test_insert_sorted(self):
+        data = [('t3_a', 5.0, 3.0), ('t3_b', 5.0, 1.0), ('t3_c', 2.0, 9.0)]
+        packed_results.insert_sorted(data, ('t3_d', 5.0, 2.0))
+        packed_results.insert_sorted(data, ('t3_e', 2.0, 9.0))
+        packed_results.insert_sorted(data, ('t3_f', 9.0, 0.0))
+        packed_results.insert_sorted(data, ('t3_g', 0.0, 0.0))
+        self.assertEquals(['t3_f', 't3_a', 't3_d', 't3_b', 't3_c', 't3_e',
+                           't3_g'],
+                          [x[0] for x in data])
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import threading
+import time
+import unittest
+
+from r2.lib.db.queries import CachedResultsBatcher
+from r2.lib.utils import Storage
+
+
+class FakeQuery(object):
+    def __init__(self, iden):
+        self.iden = iden
+        self.applied = []
+
+    def make_item_tuple(self, item):
+        return (item._fullname, item.score)
+
+    def filter(self, item):
+        return item
+
+    def _apply_changes(self, changes):
+        self.applied.append(list(changes.itervalues()))
+
+
+def item(fullname, score=1):
+    return Storage(_fullname=fullname, score=score)
+
+
+class CachedResultsBatcherTest(unittest.TestCase):
+    def test_merge(self):
+        query = FakeQuery("hot")
+        batcher = CachedResultsBatcher("test", window=None)
+        batcher.insert(query, [item("t3_a"), item("t3_b")])
+
+        vote = CachedResultsBatcher("test", window=None)
+        vote.insert(query, item("t3_a", score=2))
+        vote.delete(query, item("t3_c"))
+        other_query = FakeQuery("new")
+        vote.insert(other_query, item("t3_c"))
+        batcher.merge(vote)
+
+        batcher.flush()
+        # the merged changes come after (and replace) the batcher's own
+        self.assertEqual(query.applied,
+                         [[("t3_b", 1), ("t3_a", 2), None]])
+        self.assertEqual(other_query.applied, [[("t3_c", 1)]])
+
+    def test_unmerged_changes_not_applied(self):
+        query = FakeQuery("hot")
+        batcher = CachedResultsBatcher("test", window=None)
+        failed_vote = CachedResultsBatcher("test", window=None)
+        failed_vote.insert(query, item("t3_a"))
+        batcher.flush()
+        self.assertEqual(query.applied, [])
+
+    def test_last_change_wins(self):
+        query = FakeQuery("hot")
+        batcher = CachedResultsBatcher("test", window=None)
+        batcher.insert(query, [item("t3_a"), item("t3_b")])
+        batcher.delete(query, item("t3_a"))
+        batcher.insert(query, item("t3_b", score=3))
+        batcher.flush()
+        self.assertEqual(query.applied, [[None, ("t3_b", 3)]])
+
+        batcher.flush()
+        self.assertEqual(len(query.applied), 1)
+
+    def test_flushes_applied_in_order(self):
+        release = threading.Event()
+        applying = threading.Event()
+        query = FakeQuery("hot")
+        def slow_apply(changes):
+            applying.set()
+            release.wait(5)
+            query.applied.append(list(changes.itervalues()))
+        query._apply_changes = slow_apply
+
+        batcher = CachedResultsBatcher("test", window=None)
+        batcher.insert(query, item("t3_a", score=1))
+        first = threading.Thread(target=batcher.flush)
+        first.start()
+        applying.wait(5)
+
+        # e.g. drain_batcher while the flusher thread is mid-batch
+        query._apply_changes = FakeQuery._apply_changes.__get__(query)
+        batcher.insert(query, item("t3_a", score=2))
+        second = threading.Thread(target=batcher.flush)
+        second.start()
+        time.sleep(0.05)
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(query.applied, [[("t3_a", 1)], [("t3_a", 2)]])
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from r2.tests import stage_for_paste
+
+stage_for_paste()
+
+from r2.lib.db import sorts
+
+
+VOTES = [
+    (0, 0), (1, 0), (0, 1), (5, 5), (10, 3), (3, 10), (0, 100), (400, 0),
+    # either side of the precomputed confidence table's edges
+    (399, 99), (400, 99), (399, 100), (400, 100), (1000, 2000),
+    (10 ** 6, 10 ** 5), (123456789, 987654321), (2 ** 30, 2 ** 30 - 1),
+]
+DATES = [0., 1134028003., 1134028003.5, 1.4e9, 1.1e9 + 0.123456]
+
+
+@unittest.skipUnless(sorts.batch_available, "numpy is required")
+class BatchSortsTest(unittest.TestCase):
+    def setUp(self):
+        self.ups = [ups for ups, downs in VOTES]
+        self.downs = [downs for ups, downs in VOTES]
+
+    def assertMatches(self, batch, scalar):
+        self.assertEqual(len(batch), len(scalar))
+        for got, expected in zip(batch.tolist(), scalar):
+            # exact, not almost: listings mix the two
+            self.assertEqual(got, expected)
+
+    def test_score(self):
+        self.assertMatches(sorts.score_batch(self.ups, self.downs),
+                           [sorts.score(u, d) for u, d in VOTES])
+
+    def test_hot(self):
+        ups, downs, dates = [], [], []
+        for u, d in VOTES:
+            for date in DATES:
+                ups.append(u)
+                downs.append(d)
+                dates.append(date)
+        self.assertMatches(sorts.hot_batch(ups, downs, dates),
+                           [sorts._hot(u, d, t)
+                            for u, d, t in zip(ups, downs, dates)])
+
+    def test_controversy(self):
+        self.assertMatches(sorts.controversy_batch(self.ups, self.downs),
+                           [sorts.controversy(u, d) for u, d in VOTES])
+
+    def test_confidence(self):
+        self.assertMatches(sorts.confidence_batch(self.ups, self.downs),
+                           [sorts.confidence(u, d) for u, d in VOTES])
+
+    def test_mismatched_lengths(self):
+        self.assertRaises(ValueError, sorts.score_batch, [1, 2], [1])
+        self.assertRaises(ValueError, sorts.hot_batch, [1], [1], [])
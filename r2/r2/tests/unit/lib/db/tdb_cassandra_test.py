@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import threading
+import time
+import unittest
+
+from pycassa.cassandra.ttypes import NotFoundException
+from pycassa.util import OrderedDict
+
+from r2.lib.db import tdb_cassandra
+from r2.lib.db.tdb_cassandra import (batched_commits, current_commit_batch,
+                                     get_column_range, get_column_ranges,
+                                     run_concurrently)
+
+
+class FakeColumnFamily(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.gets = []
+
+    def get(self, key, column_start='', column_finish='', column_count=100):
+        self.gets.append((key, column_start))
+        if key not in self.rows:
+            raise NotFoundException()
+        columns = [(k, v) for k, v in sorted(self.rows[key].iteritems())
+                   if (column_start == '' or k >= column_start) and
+                      (column_finish == '' or k <= column_finish)]
+        if not columns:
+            raise NotFoundException()
+        return OrderedDict(columns[:column_count])
+
+
+class ColumnRangeTest(unittest.TestCase):
+    def setUp(self):
+        self.cf = FakeColumnFamily({
+            "wide": dict((i, str(i)) for i in xrange(25)),
+            "narrow": {1: "1", 2: "2"},
+        })
+
+    def test_pages_through_row(self):
+        columns = get_column_range(self.cf, "wide", page_size=10)
+        self.assertEqual(columns.keys(), range(25))
+        self.assertEqual(len(self.cf.gets), 3)
+
+    def test_bounded_range(self):
+        columns = get_column_range(self.cf, "wide", 5, 14, page_size=4)
+        self.assertEqual(columns.keys(), range(5, 15))
+
+    def test_missing_row(self):
+        self.assertEqual(get_column_range(self.cf, "nope"), {})
+
+    def test_ranges_keep_order(self):
+        ranges = [("wide", 20, ''), ("nope", '', ''), ("narrow", '', '')]
+        results = get_column_ranges(self.cf, ranges, page_size=3,
+                                    max_workers=2)
+        self.assertEqual([r.keys() for r in results],
+                         [range(20, 25), [], [1, 2]])
+
+
+class RunConcurrentlyTest(unittest.TestCase):
+    def test_results_in_order(self):
+        fns = [(lambda i=i: i * 2) for i in xrange(10)]
+        self.assertEqual(run_concurrently(fns, 3), range(0, 20, 2))
+
+    def test_bounded_fanout(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def fn():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        run_concurrently([fn] * 10, 3)
+        self.assertTrue(running[1] <= 3)
+
+    def test_shared_threads(self):
+        threads = set()
+        def fn():
+            threads.add(threading.current_thread())
+            time.sleep(0.01)
+        for i in xrange(3):
+            run_concurrently([fn] * 4, 2)
+        # the process's pool, not new threads for each call
+        self.assertTrue(len(threads) <= tdb_cassandra.column_fetch_fanout)
+        self.assertFalse(threading.current_thread() in threads)
+
+    def test_nested(self):
+        def fn():
+            return sum(run_concurrently([lambda: 1] * 4, 4))
+        self.assertEqual(run_concurrently([fn] * 8, 4), [4] * 8)
+
+    def test_reraises(self):
+        def fail():
+            raise ValueError("nope")
+        self.assertRaises(ValueError, run_concurrently,
+                          [lambda: 1, fail, lambda: 2], 2)
+
+
+class FakeMutator(object):
+    sent = []
+
+    def __init__(self, pool, queue_size, write_consistency_level):
+        self.pool = pool
+        self.wcl = write_consistency_level
+        self.queue = []
+
+    def insert(self, cf, key, columns, ttl=None):
+        self.queue.append(("insert", cf, key, columns, ttl))
+
+    def remove(self, cf, key, columns):
+        self.queue.append(("remove", cf, key, columns))
+
+    def send(self):
+        self.sent.append((self.pool, self.wcl, self.queue))
+        self.queue = []
+
+
+class FakeCache(dict):
+    def set_multi(self, keys):
+        self.update(keys)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.pop(key, None)
+
+
+class FakeCF(object):
+    pool = "pool"
+
+
+class FakeThing(object):
+    _cf = FakeCF()
+    _write_consistency_level = "ONE"
+    _default_ttls = {}
+
+    def __init__(self, _id, columns, on_finish=None):
+        self._id = _id
+        self.columns = columns
+        self.finished = False
+        self.on_finish = on_finish
+
+    @classmethod
+    def _wcl(cls, wcl):
+        return wcl or cls._write_consistency_level
+
+    @classmethod
+    def _cache_key_id(cls, _id):
+        return "thing_" + _id
+
+    def _cache_key(self):
+        return self._cache_key_id(self._id)
+
+    def _prepare_commit(self):
+        if self.finished:
+            return None
+        return [(self.columns, None)], set()
+
+    def _finish_commit(self):
+        self.finished = True
+        if self.on_finish:
+            self.on_finish()
+
+    def _commit(self):
+        current_commit_batch().add(self)
+
+
+class CommitBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.orig = tdb_cassandra.Mutator, tdb_cassandra.thing_cache
+        tdb_cassandra.Mutator = FakeMutator
+        tdb_cassandra.thing_cache = self.cache = FakeCache()
+        FakeMutator.sent = []
+
+    def tearDown(self):
+        tdb_cassandra.Mutator, tdb_cassandra.thing_cache = self.orig
+
+    def test_writes_on_exit(self):
+        things = [FakeThing(str(i), {"x": str(i)}) for i in xrange(3)]
+        with batched_commits(batch_size=10) as batch:
+            for thing in things:
+                thing._commit()
+            things[0]._commit()
+            self.assertEqual(FakeMutator.sent, [])
+            self.assertEqual(len(batch), 3)
+
+        self.assertEqual(len(FakeMutator.sent), 1)
+        pool, wcl, queue = FakeMutator.sent[0]
+        self.assertEqual(wcl, "ONE")
+        self.assertEqual([item[2] for item in queue], ["0", "1", "2"])
+        self.assertTrue(all(thing.finished for thing in things))
+        self.assertEqual(sorted(self.cache), ["thing_0", "thing_1", "thing_2"])
+        self.assertEqual(current_commit_batch(), None)
+
+    def test_flushes_every_batch_size(self):
+        with batched_commits(batch_size=2, write_consistency_level="ALL"):
+            for i in xrange(5):
+                FakeThing(str(i), {}, None)._commit()
+            self.assertEqual(len(FakeMutator.sent), 2)
+        self.assertEqual(len(FakeMutator.sent), 3)
+        self.assertEqual(set(wcl for p, wcl, q in FakeMutator.sent),
+                         set(["ALL"]))
+
+    def test_hook_writes_are_flushed(self):
+        child = FakeThing("child", {})
+        parent = FakeThing("parent", {}, on_finish=child._commit)
+        with batched_commits():
+            parent._commit()
+        self.assertTrue(child.finished)
+        self.assertEqual(len(FakeMutator.sent), 2)
+
+    def test_values_invalidate_cache(self):
+        self.cache["thing_row"] = "stale"
+        with batched_commits() as batch:
+            batch.set_values(FakeThing, "row", {"a": "1"}, ttl=10)
+        (pool, wcl, queue), = FakeMutator.sent
+        self.assertEqual(queue, [("insert", FakeThing._cf, "row",
+                                  {"a": "1"}, 10)])
+        self.assertFalse("thing_row" in self.cache)
+
+    def test_dropped_on_error(self):
+        thing = FakeThing("0", {})
+        try:
+            with batched_commits():
+                thing._commit()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(FakeMutator.sent, [])
+        self.assertFalse(thing.finished)
+        self.assertEqual(current_commit_batch(), None)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+from datetime import datetime
+
+from r2.lib.db import operators
+from r2.lib.db.thing import MergeCursor, NotFound
+
+
+class Item(object):
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.__dict__.update(attrs)
+
+
+class ListCursor(object):
+    def __init__(self, items):
+        self.items = iter(items)
+
+    def fetchone(self):
+        item = self.items.next()
+        if item is NotFound:
+            raise NotFound
+        return item
+
+
+class MergeCursorTest(unittest.TestCase):
+    def merge(self, listings, sorts):
+        cursors = [ListCursor(l) for l in listings]
+        return [i.name for i in MergeCursor(cursors, sorts).fetchall()]
+
+    def test_desc(self):
+        listings = [
+            [Item('a', score=10), Item('d', score=4)],
+            [Item('b', score=8), Item('c', score=6), Item('e', score=1)],
+            [],
+        ]
+        self.assertEquals(['a', 'b', 'c', 'd', 'e'],
+                          self.merge(listings, [operators.desc('score')]))
+
+    def test_mixed_directions(self):
+        early, late = datetime(2013, 1, 1), datetime(2013, 6, 1)
+        listings = [
+            [Item('a', score=1, date=late), Item('c', score=2, date=late)],
+            [Item('b', score=1, date=early), Item('d', score=2, date=early)],
+        ]
+        sorts = [operators.asc('score'), operators.desc('date')]
+        self.assertEquals(['a', 'b', 'c', 'd'], self.merge(listings, sorts))
+
+    def test_first_differing_column_decides(self):
+        # the scores aren't all the same, so the first query's row wins on
+        # score even though the second's is newer
+        early, late = datetime(2013, 1, 1), datetime(2013, 6, 1)
+        listings = [
+            [Item('a', score=5, date=early)],
+            [Item('b', score=5, date=late)],
+            [Item('c', score=3, date=late)],
+        ]
+        sorts = [operators.desc('score'), operators.desc('date')]
+        self.assertEquals(['a', 'b', 'c'], self.merge(listings, sorts))
+
+    def test_desc_with_missing_values(self):
+        listings = [
+            [Item('a', score=2), Item('c', score=None)],
+            [Item('b', score=1.5), Item('d', score=None)],
+        ]
+        self.assertEquals(['a', 'b', 'c', 'd'],
+                          self.merge(listings, [operators.desc('score')]))
+
+    def test_ties_favour_earlier_query(self):
+        listings = [
+            [Item('a1', score=5), Item('a2', score=5)],
+            [Item('b1', score=5)],
+        ]
+        self.assertEquals(['a1', 'a2', 'b1'],
+                          self.merge(listings, [operators.desc('score')]))
+
+    def test_no_sorts_concatenates(self):
+        listings = [[Item('a'), Item('b')], [Item('c')]]
+        self.assertEquals(['a', 'b', 'c'], self.merge(listings, []))
+
+    def test_skips_not_found(self):
+        listings = [
+            [Item('a', score=3), NotFound, Item('c', score=1)],
+            [NotFound, Item('b', score=2)],
+        ]
+        self.assertEquals(['a', 'b', 'c'],
+                          self.merge(listings, [operators.desc('score')]))
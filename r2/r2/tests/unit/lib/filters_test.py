@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+from cStringIO import StringIO
+
+from lxml import etree
+
+from r2.tests import stage_for_paste
+
+stage_for_paste()
+
+from pylons import c, g
+
+from r2.lib.filters import (MD_END, MD_START, SC_OFF, SC_ON, SouptestTarget,
+                             _markdown_key, markdown_dtd, markdown_ok_tags,
+                             markdown_souptest, prefetch_markdown,
+                             safemarkdown, wiki_postprocess)
+
+
+class FakeRenderCache(object):
+    def __init__(self):
+        self.data = {}
+        self.lookups = []
+
+    def get_multi(self, keys, prefix=''):
+        self.lookups.append(sorted(keys))
+        return dict((key, self.data[prefix + key]) for key in keys
+                    if prefix + key in self.data)
+
+    def set_multi(self, values, prefix='', time=0):
+        for key, value in values.iteritems():
+            self.data[prefix + key] = value
+
+
+class MarkdownCacheTest(unittest.TestCase):
+    def setUp(self):
+        c.markdown_renders = {}
+        c.markdown_pending = {}
+        self.rendercache = FakeRenderCache()
+        self.real_rendercache = g.rendercache
+        g.rendercache = self.rendercache
+
+    def tearDown(self):
+        c.markdown_renders = {}
+        c.markdown_pending = {}
+        g.rendercache = self.real_rendercache
+
+    def test_key(self):
+        keys = set([
+            _markdown_key("*hi*", False, None),
+            _markdown_key("*hi*", True, None),
+            _markdown_key("*hi*", False, "_top"),
+            _markdown_key("*hi*", False, None, renderer="wiki"),
+            _markdown_key("*hi* ", False, None),
+        ])
+        self.assertEqual(len(keys), 5)
+        self.assertEqual(_markdown_key("*hi*", 0, ""),
+                         _markdown_key("*hi*", False, None))
+
+    def test_uses_prefetched(self):
+        rendered = safemarkdown(u"*hi*", nofollow=True, target=None)
+        c.markdown_renders[_markdown_key("*hi*", False, None)] = "cached"
+        self.assertEqual(safemarkdown(u"*hi*", target=None),
+                         SC_OFF + MD_START + "cached" + MD_END + SC_ON)
+        # other options are rendered for themselves
+        self.assertEqual(safemarkdown(u"*hi*", nofollow=True, target=None),
+                         rendered)
+
+    def test_prefetch_is_lazy(self):
+        expected = safemarkdown(u"*a*", target=None)
+        prefetch_markdown([(u"*a*", False, None), (u"*b*", False, None)])
+        # nothing until one of them is rendered
+        self.assertEqual(self.rendercache.lookups, [])
+
+        self.assertEqual(safemarkdown(u"*a*", target=None), expected)
+        self.assertEqual(len(self.rendercache.lookups), 1)
+        self.assertEqual(len(self.rendercache.lookups[0]), 2)
+        self.assertEqual(len(self.rendercache.data), 2)
+
+        # the rest were looked up along with the first
+        safemarkdown(u"*b*", target=None)
+        self.assertEqual(len(self.rendercache.lookups), 1)
+
+
+class WikiPostprocessTest(unittest.TestCase):
+    @staticmethod
+    def img_swap(src):
+        if src == "%%kitten%%":
+            return "http://example.com/kitten.png"
+
+    def test_images(self):
+        html = (u'<p><img src="%%kitten%%" alt="a"/>'
+                u'<img src="http://evil.com/x.png" alt="b"/></p>')
+        self.assertEqual(wiki_postprocess(html, self.img_swap),
+                         u'<p><img src="http://example.com/kitten.png"'
+                         u' alt="a"/></p>')
+
+    def test_toc(self):
+        html = (u'<h1>Intro</h1><p>x</p><h2 id="old">Some &amp; <em>more'
+                u'</em></h2><h2>Some &amp; more</h2><h1></h1><h1>End</h1>')
+        self.assertEqual(wiki_postprocess(html, self.img_swap), (
+            u'<div class="toc"><ul>'
+            u'<li class="wiki_intro"><a href="#wiki_intro">Intro</a></li>'
+            u'<ul><li class="wiki_some_.26amp.3B_more">'
+            u'<a href="#wiki_some_.26amp.3B_more">Some &amp; more</a></li>'
+            u'<li class="wiki_some_.26amp.3B_more2">'
+            u'<a href="#wiki_some_.26amp.3B_more2">Some &amp; more</a></li>'
+            u'</ul>'
+            u'<li class="wiki_end"><a href="#wiki_end">End</a></li>'
+            u'</ul></div>'
+            u'<h1 id="wiki_intro">Intro</h1><p>x</p>'
+            u'<h2 id="wiki_some_.26amp.3B_more">Some &amp; <em>more</em></h2>'
+            u'<h2 id="wiki_some_.26amp.3B_more2">Some &amp; more</h2>'
+            u'<h1></h1><h1 id="wiki_end">End</h1>'))
+
+    def test_no_toc(self):
+        html = u'<h1>Intro</h1>'
+        self.assertEqual(wiki_postprocess(html, self.img_swap,
+                                          include_toc=False), html)
+
+
+class SouptestTest(unittest.TestCase):
+    def test_allowed(self):
+        markdown_souptest(u"*hi* [there](http://example.com) &amp; you")
+
+    def test_rejected(self):
+        for html in ('<div class="md"><script>x</script></div>',
+                     '<div class="md"><p onclick="x">x</p></div>',
+                     '<div class="md"><a href="javascript:x">x</a></div>'):
+            parser = etree.XMLParser(load_dtd=True,
+                                     target=SouptestTarget(markdown_ok_tags))
+            self.assertRaises(ValueError, etree.parse,
+                              StringIO(markdown_dtd + html), parser)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import gzip
+import unittest
+from cStringIO import StringIO
+
+from r2.lib.gzipper import (GzipMiddleware, PRECOMPRESSED_ENVIRON_KEY,
+                            PRECOMPRESS_ENVIRON_KEY, parse_content_type_levels)
+
+
+BODY = "hello world " * 200
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+class GzipMiddlewareTest(unittest.TestCase):
+    def setUp(self):
+        self.content_type = "text/html; charset=UTF-8"
+        self.body = BODY
+        self.seen_environ = None
+
+    def app(self, environ, start_response):
+        self.seen_environ = environ
+        start_response("200 OK", [("Content-Type", self.content_type),
+                                  ("Content-Length", str(len(self.body)))])
+        return [self.body]
+
+    def call(self, middleware, **environ):
+        environ.setdefault("HTTP_ACCEPT_ENCODING", "gzip")
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = dict(headers)
+        body = "".join(middleware(environ, start_response))
+        return response["headers"], body
+
+    def test_compresses(self):
+        middleware = GzipMiddleware(self.app, 6, 100)
+        headers, body = self.call(middleware)
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(headers["Content-Length"], str(len(body)))
+        self.assertEqual(gunzip(body), BODY)
+
+        headers, body = self.call(middleware, HTTP_ACCEPT_ENCODING="identity")
+        self.assertTrue("Content-Encoding" not in headers)
+        self.assertEqual(body, BODY)
+
+    def test_stream(self):
+        middleware = GzipMiddleware(self.app, 6, 100, stream_min_size=1000)
+        headers, body = self.call(middleware)
+        self.assertTrue("Content-Length" not in headers)
+        self.assertEqual(gunzip(body), BODY)
+
+    def test_precompressed(self):
+        middleware = GzipMiddleware(self.app, 1, 100, precompress_level=9)
+        self.call(middleware)
+        precompress = self.seen_environ[PRECOMPRESS_ENVIRON_KEY]
+        precompressed = precompress([("Content-Type", self.content_type)],
+                                    BODY)
+        self.assertEqual(gunzip(precompressed[1]), BODY)
+
+        # the precompressed body is sent as is
+        fake = (len(BODY), "precompressed")
+        headers, body = self.call(middleware,
+                                  **{PRECOMPRESSED_ENVIRON_KEY: fake})
+        self.assertEqual(body, "precompressed")
+        self.assertEqual(headers["Content-Length"], str(len(body)))
+
+        # unless it doesn't match the body being sent
+        fake = (len(BODY) + 1, "precompressed")
+        headers, body = self.call(middleware,
+                                  **{PRECOMPRESSED_ENVIRON_KEY: fake})
+        self.assertEqual(gunzip(body), BODY)
+
+        # responses that wouldn't be compressed aren't precompressed
+        self.assertEqual(precompress([("Content-Type", "image/png")], BODY),
+                         None)
+        self.assertEqual(precompress([("Content-Type", "text/html")], "hi"),
+                         None)
+
+    def test_content_type_levels(self):
+        self.assertEqual(parse_content_type_levels(""), {})
+        levels = parse_content_type_levels("text/html:6, application/json:1")
+        self.assertEqual(levels, {"text/html": 6, "application/json": 1})
+        self.assertRaises(ValueError, parse_content_type_levels, "text/html")
+
+        middleware = GzipMiddleware(self.app, 9, 100,
+                                    content_type_levels=levels)
+        self.content_type = "application/json"
+        headers, fast = self.call(middleware)
+        self.content_type = "text/plain"
+        headers, slow = self.call(middleware)
+        self.assertEqual(gunzip(fast), gunzip(slow))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import datetime
+import time
+import unittest
+
+import pytz
+
+from r2.tests import stage_for_paste
+
+stage_for_paste()
+
+from r2.lib.jsontemplates import (MoreCommentJsonTemplate, ObjectTemplate,
+                                  ThingJsonTemplate, epoch_seconds,
+                                  local_epoch_seconds)
+
+
+class Stub(object):
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+class EpochTest(unittest.TestCase):
+    def test_matches_mktime(self):
+        date = datetime.datetime(2013, 6, 1, 12, 30, 15, tzinfo=pytz.UTC)
+        self.assertEqual(epoch_seconds(date), 1370089815.)
+        self.assertEqual(local_epoch_seconds(date),
+                         time.mktime(date.timetuple()))
+        eastern = date.astimezone(pytz.timezone("US/Eastern"))
+        self.assertEqual(epoch_seconds(eastern), 1370089815.)
+
+
+class CompiledAttrsTest(unittest.TestCase):
+    def test_getters(self):
+        class Template(ThingJsonTemplate):
+            _data_attrs_ = ThingJsonTemplate.data_attrs(
+                title="title",
+                shouting="shouting",
+            )
+            _attr_getters_ = ThingJsonTemplate.attr_getters(
+                shouting=lambda template, thing: thing.title.upper(),
+            )
+
+        thing = Stub(_id36="a", _fullname="t3_a", title=u"hi",
+                     _date=datetime.datetime(2013, 6, 1, tzinfo=pytz.UTC))
+        data = Template().raw_data(thing)
+        self.assertEqual(data["shouting"], u"HI")
+        self.assertEqual(data["title"], u"hi")
+        self.assertEqual(data["name"], "t3_a")
+        self.assertEqual(data["created_utc"], 1370044800.)
+        self.assertEqual(Template().thing_attr(thing, "shouting"), u"HI")
+        self.assertTrue(Template.compiled_attrs() is Template.compiled_attrs())
+
+    def test_thing_attr_override(self):
+        class Template(ThingJsonTemplate):
+            _data_attrs_ = dict(title="title", id="_id36")
+
+            def thing_attr(self, thing, attr):
+                if attr == "title":
+                    return "overridden"
+                return ThingJsonTemplate.thing_attr(self, thing, attr)
+
+        thing = Stub(_id36="a", title=u"hi")
+        self.assertEqual(Template().raw_data(thing),
+                         {"title": "overridden", "id": "a"})
+
+    def test_more_comments(self):
+        thing = Stub(_id36="a", _fullname="t1_a", children=[10, 11],
+                     count=2, parent_id=None, link_id=1)
+        data = MoreCommentJsonTemplate().raw_data(thing)
+        self.assertEqual(data["children"], ["a", "b"])
+        self.assertEqual(data["parent_id"], "t3_1")
+
+
+class ObjectTemplateTest(unittest.TestCase):
+    def test_finalize(self):
+        d = {"a": [u"x<$>v</$>", "y"]}
+        self.assertEqual(ObjectTemplate(d).finalize(), d)
+        self.assertEqual(ObjectTemplate(d).finalize({"v": u"!"}),
+                         {"a": [u"x!", "y"]})
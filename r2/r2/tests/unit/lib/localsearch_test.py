@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lxml import etree
+
+from r2.lib.localsearch import (IndexSchema, LocalDocumentClient,
+                                LocalSearchIndex, QueryError, parse_bq)
+
+
+SCHEMA = IndexSchema(
+    text_fields=["title", "selftext"],
+    int_fields=["sr_id", "timestamp", "ups"],
+    stored_fields=["title"],
+    rank_expressions={"top": lambda hit: hit.get("ups")},
+)
+
+
+def link(title, reddit, sr_id, timestamp, ups=0, selftext=u""):
+    return {
+        "title": [title],
+        "selftext": [selftext],
+        "reddit": [reddit],
+        "sr_id": [str(sr_id)],
+        "timestamp": [str(timestamp)],
+        "ups": [str(ups)],
+    }
+
+
+class LocalSearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = LocalSearchIndex(self.path, SCHEMA)
+        self.index.update([
+            ("t3_1", 1, link(u"Hello world", u"pics", 1, 100, ups=5)),
+            ("t3_2", 1, link(u"hello there", u"funny", 2, 200, ups=50)),
+            ("t3_3", 1, link(u"goodbye", u"pics", 1, 300,
+                             selftext=u"hello again")),
+        ], [])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def ids(self, **kw):
+        response = self.index.search(**kw)
+        return [hit["id"] for hit in response["hits"]["hit"]]
+
+    def test_plain_query(self):
+        self.assertEqual(sorted(self.ids(query="hello")),
+                         ["t3_1", "t3_2", "t3_3"])
+        self.assertEqual(self.ids(query="hello world"), ["t3_1"])
+        self.assertEqual(sorted(self.ids(query="hello -world")),
+                         ["t3_2", "t3_3"])
+
+    def test_boolean_query(self):
+        self.assertEqual(self.ids(bq="(and title:'hello' sr_id:1)"),
+                         ["t3_1"])
+        self.assertEqual(sorted(self.ids(bq="(or reddit:'funny' goodbye)")),
+                         ["t3_2", "t3_3"])
+        self.assertEqual(self.ids(bq="(and hello (not reddit:'pics'))"),
+                         ["t3_2"])
+        self.assertEqual(self.ids(bq="(field title 'good*')"), ["t3_3"])
+        self.assertEqual(sorted(self.ids(bq="timestamp:150..")),
+                         ["t3_2", "t3_3"])
+
+    def test_invalid_query(self):
+        self.assertRaises(QueryError, parse_bq, "(and hello")
+        self.assertRaises(QueryError, parse_bq, "(xor a b)")
+
+    def test_rank(self):
+        self.assertEqual(self.ids(query="hello", rank="-timestamp"),
+                         ["t3_3", "t3_2", "t3_1"])
+        self.assertEqual(self.ids(query="hello", rank="-top,timestamp"),
+                         ["t3_2", "t3_1", "t3_3"])
+        self.assertEqual(self.ids(query="hello", rank="-timestamp",
+                                  size=1, start=1), ["t3_2"])
+
+    def test_facets_and_fields(self):
+        response = self.index.search(bq="hello", faceting={"reddit": {}},
+                                     rank="timestamp",
+                                     return_fields=["title", "reddit"])
+        self.assertEqual(response["hits"]["found"], 3)
+        self.assertEqual(response["facets"]["reddit"]["constraints"],
+                         [{"value": u"pics", "count": 2},
+                          {"value": u"funny", "count": 1}])
+        self.assertEqual(response["hits"]["hit"][0]["data"],
+                         {"title": [u"Hello world"], "reddit": [u"pics"]})
+
+    def test_versions(self):
+        # stale updates are ignored, newer ones replace the document
+        self.index.update([("t3_1", 0, link(u"stale", u"pics", 1, 100))], [])
+        self.assertEqual(self.ids(query="stale"), [])
+        self.index.update([("t3_1", 2, link(u"fresh", u"pics", 1, 100))], [])
+        self.assertEqual(self.ids(query="fresh"), ["t3_1"])
+        self.assertEqual(self.ids(query="world"), [])
+
+        self.index.update([], [("t3_2", 2)])
+        self.assertEqual(sorted(self.ids(query="hello")), ["t3_3"])
+
+    def test_optimize(self):
+        self.index.update([], [("t3_2", 2)])
+        self.index.optimize()
+        self.assertEqual(len(self.index.segments), 1)
+        self.assertEqual(sorted(self.ids(query="hello")), ["t3_1", "t3_3"])
+
+    def test_tiered_merge(self):
+        for i in xrange(3):
+            self.index.update([("t3_%d" % (i + 4), 1,
+                                link(u"hello", u"pics", 1, 400))], [])
+        # the four small segments were merged, so that one's left alone
+        self.assertEqual(len(self.index.segments), 1)
+        merged = self.index.segments[0].name
+        for i in xrange(4):
+            self.index.update([("t3_%d" % (i + 7), 1,
+                                link(u"hello", u"pics", 1, 400))], [])
+        self.assertEqual(len(self.index.segments), 2)
+        self.assertEqual(self.index.segments[0].name, merged)
+        self.assertEqual(len(self.ids(query="hello", size=20)), 10)
+
+    def test_merge_keeps_tombstones(self):
+        reader = LocalSearchIndex(self.path, SCHEMA)
+        self.index.merge_factor = 3
+        self.index.update([], [("t3_2", 2)])
+        self.index.update([("t3_4", 1, link(u"news", u"pics", 1, 400))], [])
+        self.index.update([("t3_5", 1, link(u"news", u"pics", 1, 500))], [])
+        # the last three merged, but the first segment still has t3_2
+        self.assertEqual(len(self.index.segments), 2)
+        self.assertEqual(sorted(self.ids(query="hello")), ["t3_1", "t3_3"])
+        self.assertEqual(self.index.versions["t3_2"], 2)
+        self.assertEqual(self.index.num_docs, 4)
+
+        reader.reload()
+        self.assertEqual(sorted(reader.search(query="hello")["hits"]["hit"]),
+                         [{"id": "t3_1"}, {"id": "t3_3"}])
+        self.assertEqual(reader.num_docs, 4)
+
+    def test_replaced_segments_kept(self):
+        self.index.update([], [("t3_2", 2)])
+        old = [segment.path for segment in self.index.segments]
+        self.index.optimize()
+        self.assertTrue(all(os.path.exists(path) for path in old))
+
+        self.index.retire_grace = 0
+        self.index.update([("t3_4", 1, link(u"news", u"pics", 1, 400))], [])
+        self.assertFalse(any(os.path.exists(path) for path in old))
+
+    def test_other_readers_see_updates(self):
+        reader = LocalSearchIndex(self.path, SCHEMA)
+        self.index.update([("t3_4", 1, link(u"news", u"pics", 1, 400))], [])
+        reader.reload()
+        response = reader.search(query="news")
+        self.assertEqual(response["hits"]["hit"], [{"id": "t3_4"}])
+
+
+class LocalDocumentClientTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = LocalSearchIndex(self.path, SCHEMA)
+        self.client = LocalDocumentClient(self.index)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_post(self):
+        batch = etree.Element("batch")
+        add = etree.SubElement(batch, "add", id="t3_1", version="1")
+        etree.SubElement(add, "field", name="title").text = u"hello"
+        etree.SubElement(add, "field", name="reddit").text = u"pics"
+        etree.SubElement(batch, "delete", id="t3_2", version="1")
+
+        response = etree.fromstring(self.client.post(etree.tostring(batch)))
+        self.assertEqual(response.get("adds"), "1")
+        self.assertEqual(response.get("deletes"), "1")
+        self.assertEqual(self.index.search(bq="reddit:'pics'")["hits"]["found"],
+                         1)
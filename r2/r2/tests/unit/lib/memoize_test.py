@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+
+from r2.tests import stage_for_paste
+
+stage_for_paste()
+
+from pylons import g
+
+from r2.lib import memoize
+from r2.lib.cache import make_key
+from r2.lib.memoize import EarlyRecomputeResult
+
+
+class DictCache(dict):
+    def get(self, key, stale=False):
+        return dict.get(self, key)
+
+    def set(self, key, val, time=0):
+        self[key] = val
+
+    def add(self, key, val, time=0):
+        if key in self:
+            return False
+        self[key] = val
+        return True
+
+    def delete(self, key):
+        self.pop(key, None)
+
+
+class ShouldRecomputeTest(unittest.TestCase):
+    def test_never_far_from_expiry(self):
+        stored = EarlyRecomputeResult("old", delta=1, expiry=100)
+        for r in (0, .5, .999, 1 - 1e-9):
+            self.assertFalse(stored.should_recompute(1, now=50,
+                                                     _random=lambda: r))
+
+    def test_always_at_expiry(self):
+        stored = EarlyRecomputeResult("old", delta=1, expiry=100)
+        for r in (0, .5, .999):
+            self.assertTrue(stored.should_recompute(1, now=100,
+                                                    _random=lambda: r))
+
+    def test_eager_for_expensive_values(self):
+        should = lambda delta, beta=1: EarlyRecomputeResult(
+            "old", delta=delta, expiry=100).should_recompute(
+                beta, now=95, _random=lambda: .5)
+        self.assertFalse(should(1))
+        self.assertTrue(should(10))
+        self.assertTrue(should(1, beta=10))
+
+
+class EarlyRecomputeTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DictCache()
+        self.lock_cache = DictCache()
+        self.real = (memoize.memoizecache, memoize.make_lock, g.lock_cache)
+        memoize.memoizecache = self.cache
+        g.lock_cache = self.lock_cache
+        self.calls = []
+
+    def tearDown(self):
+        memoize.memoizecache, memoize.make_lock, g.lock_cache = self.real
+
+    def test_one_worker_recomputes(self):
+        release = threading.Event()
+        @memoize.memoize("early_test", time=60, early_recompute=True)
+        def fn(x):
+            self.calls.append(x)
+            release.wait(5)
+            return "new"
+
+        key = make_key("early_test", 1)
+        # due now, so everyone will want to recompute it
+        self.cache[key] = EarlyRecomputeResult("old", 1, time.time())
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(fn(1)))
+                   for i in xrange(5)]
+        for t in threads:
+            t.start()
+        deadline = time.time() + 5
+        while len(results) < 4 and time.time() < deadline:
+            time.sleep(.01)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(sorted(results), ["new"] + ["old"] * 4)
+        self.assertEqual(self.cache[key].value, "new")
+        self.assertEqual(self.lock_cache, {})
+
+    def test_locked_calculation_unwraps(self):
+        @memoize.memoize("early_test", time=60)
+        def fn(x):
+            self.calls.append(x)
+            return "ours"
+
+        key = make_key("early_test", 1)
+        @contextmanager
+        def make_lock(group, lock_key, **kw):
+            # another process with early_recompute on finished it while we
+            # were waiting for the lock
+            self.cache[key] = EarlyRecomputeResult("theirs", 1,
+                                                   time.time() + 60)
+            yield
+        memoize.make_lock = make_lock
+
+        self.assertEqual(fn(1), "theirs")
+        self.assertEqual(self.calls, [])
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from r2.tests import stage_for_paste
+
+stage_for_paste()
+
+from r2.lib.db.sorts import controversy, score
+from r2.lib.mr_top import compute_listings, read_links
+
+
+def line(thing_id, ups, downs, timestamp, sr_id, url, spam="f"):
+    return "\t".join(map(str, [thing_id, "link", ups, downs, "f", spam,
+                               timestamp, url, sr_id])) + "\n"
+
+
+LINES = [
+    line(1, 10, 1, 1000., 1, "http://www.example.com/a"),
+    line(2, 50, 40, 2000., 1, "http://example.com/b"),
+    line(3, 5, 0, 3000., 1, ""),
+    line(4, 100, 0, 3500., 2, "http://imgur.com/c"),
+    line(5, 999, 0, 3600., 1, "http://example.com/d", spam="t"),
+    line(6, 1, 0, 10., 1, "http://example.com/e"),
+]
+OLDESTS = {"day": 1500., "year": 500.}
+
+
+class ReadLinksTest(unittest.TestCase):
+    def test_columns(self):
+        columns = read_links(iter(LINES), oldest=500.)
+        self.assertEqual(list(columns.thing_ids), [1, 2, 3, 4])
+        self.assertEqual(columns.scores[1], score(50, 40))
+        self.assertEqual(columns.controversies[1], controversy(50, 40))
+        self.assertEqual(dict((k, list(v)) for k, v in columns.by_sr.items()),
+                         {1: [0, 1, 2], 2: [3]})
+        self.assertEqual(list(columns.by_domain["example.com"]), [0, 1])
+        self.assertEqual(list(columns.by_domain["www.example.com"]), [0])
+
+
+class ComputeListingsTest(unittest.TestCase):
+    def test_listings(self):
+        columns = read_links(iter(LINES), oldest=500.)
+        listings = {}
+        for kind, key, group in compute_listings(columns, OLDESTS, num=2,
+                                                 workers=1):
+            for sort, time, tuples in group:
+                listings[(kind, key, sort, time)] = tuples
+
+        self.assertEqual(listings[("sr", 1, "top", "year")],
+                         [("t3_2", score(50, 40), 2000.),
+                          ("t3_1", score(10, 1), 1000.)])
+        self.assertEqual(listings[("sr", 1, "top", "day")],
+                         [("t3_2", score(50, 40), 2000.),
+                          ("t3_3", score(5, 0), 3000.)])
+        self.assertEqual(listings[("sr", 1, "controversial", "day")][0][0],
+                         "t3_2")
+        self.assertEqual(listings[("domain", "example.com", "top", "day")],
+                         [("t3_2", score(50, 40), 2000.)])
+        # no empty listings are made
+        self.assertTrue(("domain", "www.example.com", "top", "day")
+                        not in listings)
+        self.assertEqual(len(listings), 2 * (2 + 2 + 2 + 1 + 2))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import threading
+import time
+import unittest
+
+from r2.tests import stage_for_paste
+
+stage_for_paste()
+
+from pylons import c, g
+
+from r2.lib.prefetch import Prefetch
+
+
+class PrefetchTest(unittest.TestCase):
+    concurrent = True
+
+    def make(self):
+        return Prefetch("test", concurrent=self.concurrent)
+
+    def test_results(self):
+        prefetch = self.make()
+        prefetch.add("a", lambda x, y=0: x + y, 1, y=2)
+        prefetch.add("b", lambda: "b")
+        prefetch.add("c", lambda a, b: (a, b), after=["a", "b"])
+        self.assertEqual(prefetch.run(), {"a": 3, "b": "b", "c": (3, "b")})
+
+    def test_unknown_dependency(self):
+        prefetch = self.make()
+        self.assertRaises(ValueError, prefetch.add, "a", lambda b: b,
+                          after=["b"])
+
+    def test_error(self):
+        ran = []
+        def fail():
+            raise KeyError("nope")
+        prefetch = self.make()
+        prefetch.add("fail", fail)
+        prefetch.add("after_fail", lambda fail: ran.append(fail),
+                     after=["fail"])
+        self.assertRaises(KeyError, prefetch.run)
+        self.assertEqual(ran, [])
+
+    def test_context(self):
+        c.prefetch_test_value = "request"
+        prefetch = self.make()
+        prefetch.add("value", lambda: c.prefetch_test_value)
+        prefetch.add("other", lambda: None)
+        self.assertEqual(prefetch.run()["value"], "request")
+
+    def test_local_cache(self):
+        local = lambda: g.cache.caches[0]
+        local()["prefetch_test_seen"] = "request"
+        prefetch = self.make()
+        prefetch.add("seen", lambda: local().get("prefetch_test_seen"))
+        prefetch.add("added",
+                     lambda: local().set("prefetch_test_added", "stage"))
+        self.assertEqual(prefetch.run()["seen"], "request")
+        self.assertEqual(local().get("prefetch_test_added"), "stage")
+
+
+class ConcurrentPrefetchTest(PrefetchTest):
+    def test_concurrent(self):
+        threads = set()
+        def slow():
+            threads.add(threading.current_thread())
+            time.sleep(0.1)
+        prefetch = self.make()
+        for i in xrange(4):
+            prefetch.add(str(i), slow)
+        start = time.time()
+        prefetch.run()
+        self.assertTrue(time.time() - start < 0.35)
+        # on the process's few threads, not one each
+        self.assertTrue(1 < len(threads) <= g.prefetch_threads)
+        self.assertTrue(threading.current_thread() not in threads)
+
+    def test_own_context(self):
+        def stage():
+            c.prefetch_test_stage = True
+        prefetch = self.make()
+        prefetch.add("a", stage)
+        prefetch.add("b", lambda: None)
+        prefetch.run()
+        self.assertFalse(getattr(c, "prefetch_test_stage", None))
+
+    def test_nested(self):
+        def inner():
+            prefetch = self.make()
+            for i in xrange(g.prefetch_threads + 1):
+                prefetch.add(str(i), lambda: i)
+            return len(prefetch.run())
+        prefetch = self.make()
+        for i in xrange(g.prefetch_threads + 1):
+            prefetch.add(str(i), inner)
+        self.assertEqual(set(prefetch.run().values()),
+                         set([g.prefetch_threads + 1]))
+
+
+class SequentialPrefetchTest(PrefetchTest):
+    concurrent = False
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import threading
+import time
+import unittest
+
+from r2.lib import sgm
+
+
+class DictCache(dict):
+    def get_multi(self, keys, prefix=''):
+        return dict((k, self[prefix + k]) for k in keys if prefix + k in self)
+
+    def set_multi(self, keys, prefix='', time=0):
+        for k, v in keys.iteritems():
+            self[prefix + k] = v
+
+    def add(self, key, val, time=0):
+        if key in self:
+            return False
+        self[key] = val
+        return True
+
+    def delete_multi(self, keys):
+        for k in keys:
+            self.pop(k, None)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DictCache()
+        self.calls = []
+
+    def miss_fn(self, keys):
+        self.calls.append(sorted(keys))
+        time.sleep(0.1)
+        return dict((k, k * 2) for k in keys if k != 3)
+
+    def run_concurrently(self, n, **kw):
+        results = []
+        def fetch():
+            results.append(sgm.sgm(self.cache, [1, 2, 3], self.miss_fn,
+                                   prefix='p', single_flight=True, **kw))
+        threads = [threading.Thread(target=fetch) for i in xrange(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_concurrent_misses_share_one_load(self):
+        results = self.run_concurrently(10)
+        self.assertEquals([[1, 2, 3]], self.calls)
+        self.assertEquals([{1: 2, 2: 4}] * 10, results)
+        self.assertEquals({'p1': 2, 'p2': 4}, self.cache)
+
+    def test_followers_get_their_own_copy(self):
+        def miss_fn(keys):
+            time.sleep(0.1)
+            return dict((k, {'id': k}) for k in keys)
+
+        results = []
+        def fetch():
+            results.append(sgm.sgm(self.cache, [1], miss_fn,
+                                   single_flight=True)[1])
+        threads = [threading.Thread(target=fetch) for i in xrange(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEquals([{'id': 1}] * 2, results)
+        self.assertFalse(results[0] is results[1])
+
+    def test_leases_released(self):
+        results = self.run_concurrently(5, lease_cache=self.cache)
+        self.assertEquals([[1, 2, 3]], self.calls)
+        self.assertEquals([{1: 2, 2: 4}] * 5, results)
+        # 3 doesn't exist, which anyone waiting on it is told
+        self.assertEquals({'p1': 2, 'p2': 4,
+                           'sgm_lease(p3)': sgm.LEASE_NOT_FOUND}, self.cache)
+
+    def test_waits_for_other_process_lease(self):
+        self.cache['sgm_lease(p1)'] = 'elsewhere'
+        def other_process():
+            time.sleep(0.05)
+            self.cache['p1'] = 'loaded elsewhere'
+        threading.Thread(target=other_process).start()
+
+        res = sgm.sgm(self.cache, [1, 2], self.miss_fn, prefix='p',
+                      single_flight=True, lease_cache=self.cache)
+        self.assertEquals({1: 'loaded elsewhere', 2: 4}, res)
+        self.assertEquals([[2]], self.calls)
+
+    def test_other_process_finds_nothing(self):
+        self.cache['sgm_lease(p3)'] = 'elsewhere'
+        def other_process():
+            time.sleep(0.05)
+            self.cache['sgm_lease(p3)'] = sgm.LEASE_NOT_FOUND
+        threading.Thread(target=other_process).start()
+
+        start = time.time()
+        res = sgm.sgm(self.cache, [3], self.miss_fn, prefix='p',
+                      single_flight=True, lease_cache=self.cache,
+                      lease_time=30)
+        self.assertEquals({}, res)
+        self.assertEquals([], self.calls)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_gives_up_on_slow_lease(self):
+        self.cache['sgm_lease(p1)'] = 'elsewhere'
+        wait_timeout = sgm.LEASE_WAIT_TIMEOUT
+        sgm.LEASE_WAIT_TIMEOUT = 0.1
+        try:
+            res = sgm.sgm(self.cache, [1], self.miss_fn, prefix='p',
+                          single_flight=True, lease_cache=self.cache)
+        finally:
+            sgm.LEASE_WAIT_TIMEOUT = wait_timeout
+        self.assertEquals({1: 2}, res)
+        self.assertEquals([[1]], self.calls)
+        # the lease isn't ours to release
+        self.assertEquals('elsewhere', self.cache['sgm_lease(p1)'])
+
+    def test_failed_leader_lets_followers_retry(self):
+        calls = []
+        def flaky_miss_fn(keys):
+            calls.append(sorted(keys))
+            time.sleep(0.1)
+            if len(calls) == 1:
+                raise ValueError
+            return dict((k, k) for k in keys)
+
+        errors = []
+        results = []
+        def fetch():
+            try:
+                results.append(sgm.sgm(self.cache, [1], flaky_miss_fn,
+                                       single_flight=True))
+            except ValueError:
+                errors.append(True)
+        threads = [threading.Thread(target=fetch) for i in xrange(2)]
+        for t in threads:
+            t.start()
+            time.sleep(0.01)
+        for t in threads:
+            t.join()
+
+        self.assertEquals([True], errors)
+        self.assertEquals([{1: 1}], results)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from r2.tests import stage_for_paste
+
+stage_for_paste()
+
+from pylons import g
+
+from r2.lib import subreddit_search
+from r2.lib.subreddit_search import (PrefixIndex, build_prefix_index,
+                                     get_prefix_index, publish_prefix_index,
+                                     write_prefix_index)
+
+
+# most popular first
+NAMES = [
+    (u"pics", False),
+    (u"politics", False),
+    (u"programming", False),
+    (u"Python", False),
+    (u"gonewild", True),
+    (u"gaming", False),
+    (u"p\xe9tanque", False),
+]
+
+
+class PrefixIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "srnames")
+        write_prefix_index(self.path, NAMES, per_prefix=3)
+        self.index = PrefixIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir)
+
+    def search(self, prefix):
+        return [name for name, over_18 in self.index.search(prefix)]
+
+    def test_top_names(self):
+        self.assertEqual(self.search("p"), [u"pics", u"politics",
+                                            u"programming"])
+        self.assertEqual(self.search("po"), [u"politics"])
+        self.assertEqual(self.search("PY"), [u"Python"])
+        self.assertEqual(self.search("g"), [u"gonewild", u"gaming"])
+        self.assertEqual(self.search(u"p\xe9"), [u"p\xe9tanque"])
+
+    def test_whole_name(self):
+        self.assertEqual(self.search("pics"), [u"pics"])
+        self.assertEqual(self.search("picsx"), [])
+
+    def test_missing(self):
+        self.assertEqual(self.search("z"), [])
+
+    def test_over_18(self):
+        self.assertEqual(self.index.search("go"), [(u"gonewild", True)])
+
+    def test_replace(self):
+        write_prefix_index(self.path, [(u"zebras", False)])
+        # the open index still has the old names
+        self.assertEqual(self.search("p"), [u"pics", u"politics",
+                                            u"programming"])
+        index = PrefixIndex(self.path)
+        self.assertEqual([name for name, over_18 in index.search("z")],
+                         [u"zebras"])
+        self.assertEqual(index.search("p"), [])
+        index.close()
+
+
+class DictCache(dict):
+    def get(self, key, default=None, allow_local=True):
+        return dict.get(self, key, default)
+
+    def get_multi(self, keys, allow_local=True):
+        return dict((key, self[key]) for key in keys if key in self)
+
+    def set(self, key, val):
+        self[key] = val
+
+    def set_multi(self, keys):
+        self.update(keys)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.pop(key, None)
+
+
+class PublishedIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.real = (g.permacache, g.subreddit_autocomplete_path,
+                     subreddit_search._CHUNK_SIZE)
+        g.permacache = DictCache()
+        g.subreddit_autocomplete_path = os.path.join(self.dir, "srnames")
+        # so that the index takes a few
+        subreddit_search._CHUNK_SIZE = 64
+        self.reset()
+
+    def tearDown(self):
+        for index in (subreddit_search._index,
+                      subreddit_search._previous_index):
+            if index:
+                index.close()
+        self.reset()
+        (g.permacache, g.subreddit_autocomplete_path,
+         subreddit_search._CHUNK_SIZE) = self.real
+        shutil.rmtree(self.dir)
+
+    def reset(self):
+        subreddit_search._index = None
+        subreddit_search._previous_index = None
+        subreddit_search._index_checked = 0
+
+    def names(self, index, prefix):
+        return [name for name, over_18 in index.search(prefix)]
+
+    def test_nothing_published(self):
+        self.assertEqual(get_prefix_index(), None)
+
+    def test_fetch(self):
+        publish_prefix_index(build_prefix_index(NAMES))
+        index = get_prefix_index()
+        self.assertEqual(self.names(index, "py"), [u"Python"])
+        self.assertTrue(os.path.exists(g.subreddit_autocomplete_path))
+
+        # another process on the server uses the local copy
+        g.permacache.delete_multi([key for key in g.permacache
+                                   if key != "subreddit_autocomplete_index"])
+        subreddit_search._index = None
+        subreddit_search._index_checked = 0
+        self.assertEqual(self.names(get_prefix_index(), "py"), [u"Python"])
+        index.close()
+
+    def test_new_version(self):
+        publish_prefix_index(build_prefix_index(NAMES))
+        first = get_prefix_index()
+
+        publish_prefix_index(build_prefix_index([(u"zebras", False)]))
+        subreddit_search._index_checked = 0
+        second = get_prefix_index()
+        self.assertEqual(self.names(second, "z"), [u"zebras"])
+        # the first might still be in use, so it's left open for now
+        self.assertEqual(self.names(first, "py"), [u"Python"])
+
+        publish_prefix_index(build_prefix_index([(u"yaks", False)]))
+        subreddit_search._index_checked = 0
+        self.assertEqual(self.names(get_prefix_index(), "y"), [u"yaks"])
+        self.assertRaises(ValueError, first.search, "py")
+
+        # only the last two versions' chunks are kept
+        versions = set(key.split("_")[-2] for key in g.permacache
+                       if key != "subreddit_autocomplete_index")
+        self.assertEqual(versions, set([second.version,
+                                        subreddit_search._index.version]))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from pylons import c
+
+from r2.lib.wrapped import (CacheStub, CachedTemplate, CachedVariable,
+                            StringTemplate, Uncachable, _StubExpander,
+                            make_cachable, render_hash)
+
+
+def stub(name):
+    return str(CachedVariable(name))
+
+
+class RenderHashTest(unittest.TestCase):
+    def test_stable(self):
+        self.assertEqual(render_hash("abc"), render_hash("abc"))
+        self.assertEqual(len(render_hash("abc")), 32)
+
+    def test_unicode(self):
+        self.assertEqual(render_hash(u"\xe9"), render_hash("\xc3\xa9"))
+
+    def test_distinct(self):
+        keys = ["<Link:[%d]>" % i for i in xrange(10000)] + ["", "a", "aa"]
+        self.assertEqual(len(set(render_hash(k) for k in keys)), len(keys))
+
+
+class MakeCachableTest(unittest.TestCase):
+    def test_simple(self):
+        self.assertEqual(make_cachable(1), u"1")
+        self.assertEqual(make_cachable("\xc3\xa9"), u"\xe9")
+        self.assertEqual(make_cachable(None), u"None")
+        self.assertEqual(make_cachable(CachedVariable("x")), None)
+        self.assertEqual(make_cachable([1, (2,)]), repr([u"1", repr([u"2"])]))
+        self.assertEqual(make_cachable({"b": 1, "a": 2}),
+                         repr({"a": u"2", "b": u"1"}))
+
+    def test_cache_key(self):
+        class Keyed(object):
+            def cache_key(self, *a):
+                return "keyed%r" % (a,)
+        self.assertEqual(make_cachable(Keyed(), "x"), "keyed('x',)")
+
+    def test_uncachable(self):
+        class Opaque(object):
+            pass
+        self.assertRaises(Uncachable, make_cachable, Opaque())
+        # but a cache_key on the instance is still used
+        thing = Opaque()
+        thing.cache_key = lambda *a: "instance"
+        self.assertEqual(make_cachable(thing), "instance")
+
+
+class ContextKeysTest(unittest.TestCase):
+    class Context(object):
+        user_is_loggedin = False
+        user_is_admin = False
+        domain_prefix = None
+        secure = False
+        cname = False
+        lang = "en"
+
+    class Site(object):
+        _id = 1
+        path = "/r/pics/"
+        flair_enabled = True
+        flair_position = "right"
+        link_flair_position = "left"
+
+    class User(object):
+        gold = False
+        pref_show_link_flair = True
+
+        def __init__(self, pref_show_flair):
+            self.pref_show_flair = pref_show_flair
+
+        def flair_enabled_in_sr(self, sr_id):
+            return True
+
+    def setUp(self):
+        self.context = self.Context()
+        self.context.site = self.Site()
+        c._push_object(self.context)
+
+    def tearDown(self):
+        c._pop_object(self.context)
+
+    def test_swapped_user(self):
+        template = CachedTemplate()
+        c.user = self.User(pref_show_flair=True)
+        shown = template._context_keys("html")
+        # a user swapped in mid-request (which may even get the same id)
+        c.user = self.User(pref_show_flair=False)
+        hidden = template._context_keys("html")
+        self.assertNotEqual(shown, hidden)
+        c.user = self.User(pref_show_flair=True)
+        self.assertEqual(template._context_keys("html"), shown)
+
+
+class StubExpanderTest(unittest.TestCase):
+    def test_nested(self):
+        stubs = {
+            "outer": (StringTemplate("[%s %s]" % (stub("inner"), stub("v"))),
+                      {"v": u"outer-v"}),
+            "inner": (StringTemplate("(%s)" % stub("v")), {"v": u"inner-v"}),
+        }
+        expander = _StubExpander(stubs)
+        self.assertEqual(expander.expand(u"%s!" % stub("outer")),
+                         u"[(inner-v) outer-v]!")
+
+    def test_kwargs(self):
+        stubs = {"a": (StringTemplate("<%s>" % stub("top")), {})}
+        expander = _StubExpander(stubs, {"top": u"T"})
+        self.assertEqual(expander.expand(u"%s %s %s" % (stub("a"), stub("top"),
+                                                        stub("missing"))),
+                         u"<T> T %s" % stub("missing"))
+
+    def test_cycle(self):
+        stubs = {"a": (StringTemplate("a%s" % stub("a")), {})}
+        self.assertEqual(_StubExpander(stubs).expand(stub("a")),
+                         u"a%s" % stub("a"))
+
+    def test_objects(self):
+        class DictTemplate(object):
+            def __init__(self, d):
+                self.d = d
+
+            def finalize(self, kw):
+                return dict((k, kw.get(v.name, v)
+                             if isinstance(v, CacheStub) else v)
+                            for k, v in self.d.iteritems())
+
+        stubs = {
+            "link": (DictTemplate({"title": u"hi", "replies": CachedVariable(
+                "child")}), {"child": u""}),
+            "html": (StringTemplate(u"<p>%s</p>" % stub("v")), {"v": u"v"}),
+        }
+        expander = _StubExpander(stubs, {"modhash": u"m"})
+        listing = {"children": [CachedVariable("link"), CachedVariable("link")],
+                   "content": u"%s %s" % (stub("html"), stub("modhash")),
+                   "other": CachedVariable("missing")}
+        expanded = expander.expand_object(listing)
+        self.assertEqual(expanded["children"],
+                         [{"title": u"hi", "replies": u""}] * 2)
+        self.assertEqual(expanded["content"], u"<p>v</p> m")
+        self.assertTrue(isinstance(expanded["other"], CacheStub))
+
+    def test_expand_stubs(self):
+        stubs = {"a": (StringTemplate(u"A"), {})}
+        template = StringTemplate(u"<%s>" % stub("a"))
+        expanded = template.expand_stubs(_StubExpander(stubs))
+        self.assertTrue(isinstance(expanded, StringTemplate))
+        self.assertEqual(expanded.finalize(), u"<A>")
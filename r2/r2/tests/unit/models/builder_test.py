@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from r2.lib.utils import Storage
+from r2.models.builder import (EXTRA_FACTOR, MAX_FETCH_FACTOR, SimpleBuilder,
+                               _copy_rules)
+
+
+class FakeStats(object):
+    def __init__(self):
+        self.counts = {}
+
+    def get_counter(self, name):
+        return self
+
+    def increment(self, name, delta=1):
+        self.counts[name] = self.counts.get(name, 0) + delta
+
+
+class LearningBuilder(SimpleBuilder):
+    """A SimpleBuilder that keeps its learned keep ratio on the class."""
+    stored = None
+
+    def load_keep_ratio(self):
+        self.stored_keep_ratio = LearningBuilder.stored
+        self.learned_keep_ratio = self.stored_keep_ratio or 1.
+
+    def save_keep_ratio(self, num_have):
+        LearningBuilder.stored = float(num_have) / self.num_seen
+
+    def count_stat(self, name, delta=1):
+        self.stats.increment(name, delta)
+
+
+def make_items(n):
+    return [Storage(_id=i) for i in xrange(n)]
+
+
+class QueryBuilderTest(unittest.TestCase):
+    def setUp(self):
+        LearningBuilder.stored = None
+
+    def build(self, items, num):
+        builder = LearningBuilder(items, wrap=None, skip=True, num=num,
+                                  keep_fn=lambda item: item._id % 4 == 0)
+        builder.stats = FakeStats()
+        return builder, builder.get_items()
+
+    def test_copy_rules(self):
+        rule = object()
+        rules = [[rule], [rule, rule]]
+        copied = _copy_rules(rules)
+        copied[0].append(rule)
+        self.assertEqual(rules, [[rule], [rule, rule]])
+        self.assertTrue(copied[1][0] is rule)
+
+    def test_fetch_size(self):
+        builder = LearningBuilder([], num=10)
+        builder.num_seen = 0
+        builder.learned_keep_ratio = 1.
+        self.assertEqual(builder.fetch_size(10, 0), int(10 * EXTRA_FACTOR))
+
+        builder.learned_keep_ratio = .01
+        self.assertEqual(builder.fetch_size(10, 0), 10 * MAX_FETCH_FACTOR)
+
+        # what the request has seen counts against the learned ratio
+        builder.learned_keep_ratio = 1.
+        builder.num_seen = 90
+        self.assertEqual(builder.keep_ratio(0), .1)
+
+    def test_learns_keep_ratio(self):
+        items = make_items(400)
+        builder, result = self.build(items, 10)
+        self.assertEqual([i._id for i in result[0]], range(0, 40, 4))
+        first_loops = builder.stats.counts["loops"]
+        self.assertEqual(LearningBuilder.stored, 10 / 37.)
+
+        # a second listing of the same kind gets there in fewer fetches
+        builder, result = self.build(items, 10)
+        self.assertEqual([i._id for i in result[0]], range(0, 40, 4))
+        self.assertTrue(builder.stats.counts["loops"] < first_loops)
+        self.assertEqual(builder.stats.counts["listings"], 1)
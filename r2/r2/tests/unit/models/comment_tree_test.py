@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from r2.models.comment_tree import CompactCommentTree
+
+#   1
+#   +- 3
+#   |  +- 7
+#   +- 4
+#   2
+#   5 (orphaned reply to 6, which isn't in the row)
+ROW = [
+    ((0, -1, 1), 4),
+    ((0, -1, 2), 1),
+    ((0, 6, 5), 1),
+    ((1, 1, 3), 2),
+    ((1, 1, 4), 1),
+    ((2, 3, 7), 1),
+]
+
+
+class CompactCommentTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = CompactCommentTree.from_row(ROW)
+
+    def test_lookups(self):
+        tree = self.tree
+        self.assertEqual(len(tree), 6)
+        self.assertEqual(list(tree.cids), [1, 2, 3, 4, 5, 7])
+        self.assertTrue(7 in tree.cids)
+        self.assertFalse(6 in tree.cids)
+        self.assertFalse(None in tree.cids)
+
+        self.assertEqual(tree.depth[7], 2)
+        self.assertEqual(tree.num_children[1], 3)
+        self.assertEqual(tree.num_children[7], 0)
+        self.assertEqual(tree.parents[3], 1)
+        self.assertEqual(tree.parents[1], None)
+        self.assertEqual(tree.parents[5], 6)
+        self.assertRaises(KeyError, lambda: tree.depth[6])
+
+    def test_children(self):
+        tree = self.tree
+        self.assertEqual(tree.tree[None], [1, 2])
+        self.assertEqual(tree.tree[1], [3, 4])
+        self.assertEqual(tree.tree[6], [5])
+        self.assertTrue(tree.tree.has_key(3))
+        self.assertFalse(tree.tree.has_key(7))
+        self.assertEqual(tree.tree.get(7, ()), ())
+        self.assertEqual(sorted(tree.tree), [None, 1, 3, 6])
+
+    def test_matches_dicts(self):
+        self.assertEqual(self.tree.to_dicts(), dict(
+            cids=[1, 2, 3, 4, 5, 7],
+            tree={None: [1, 2], 1: [3, 4], 3: [7], 6: [5]},
+            depth={1: 0, 2: 0, 3: 1, 4: 1, 5: 0, 7: 2},
+            num_children={1: 3, 2: 0, 3: 1, 4: 0, 5: 0, 7: 0},
+            parents={1: None, 2: None, 3: 1, 4: 1, 5: 6, 7: 3},
+        ))
+
+    def test_copy_overlay(self):
+        cid_tree = self.tree.tree.copy()
+        cid_tree[1] = [4]
+        self.assertEqual(cid_tree[1], [4])
+        self.assertEqual(self.tree.tree[1], [3, 4])
+        self.assertEqual(sorted(cid_tree), [None, 1, 3, 6])
+
+    def test_duplicates_and_placeholders(self):
+        tree = CompactCommentTree.from_row([
+            ((0, -1, -1), 1),
+            ((0, -1, 1), 1),
+            ((1, 2, 1), 1),
+        ])
+        self.assertEqual(list(tree.cids), [1])
+        self.assertEqual(tree.parents[1], 2)
+        self.assertEqual(tree.depth[1], 1)
+
+    def test_empty(self):
+        tree = CompactCommentTree.from_row([])
+        self.assertEqual(len(tree.cids), 0)
+        self.assertFalse(tree.cids)
+        self.assertEqual(tree.tree.get(None, ()), ())
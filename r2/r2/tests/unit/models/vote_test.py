@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import unittest
+
+from r2.models.vote import VoteDirections
+
+
+class Stub(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+def thing(fullname):
+    return Stub(_fullname=fullname)
+
+
+def account(_id):
+    return Stub(_id=_id)
+
+
+class VoteDirectionsTest(unittest.TestCase):
+    def setUp(self):
+        self.things = [thing("t3_%d" % i) for i in xrange(70)]
+        self.alice, self.bob = account(1), account(2)
+        self.directions = VoteDirections(self.things)
+
+    def test_get(self):
+        things = self.things
+        self.directions.update({
+            (self.alice, things[0]): True,
+            (self.alice, things[69]): False,
+            (self.bob, things[0]): False,
+            (self.bob, things[1]): None,
+            (self.bob, thing("t3_other")): True,
+        })
+        self.assertEqual(self.directions.get(self.alice, things[0]), True)
+        self.assertEqual(self.directions.get(self.alice, things[69]), False)
+        self.assertEqual(self.directions.get(self.alice, things[1]), None)
+        self.assertEqual(self.directions.get(self.bob, things[0]), False)
+        self.assertEqual(self.directions.get(self.bob, thing("t3_other")),
+                         None)
+        self.assertEqual(self.directions.get(account(3), things[0]), None)
+
+    def test_set_replaces(self):
+        link = self.things[5]
+        self.directions.set(self.alice, link, True)
+        self.directions.set(self.alice, link, False)
+        self.assertEqual(self.directions.get(self.alice, link), False)
+        self.directions.set(self.alice, link, None)
+        self.assertEqual(self.directions.get(self.alice, link), None)
+
+    def test_for_account(self):
+        self.directions.set(self.alice, self.things[1], True)
+        self.directions.set(self.alice, self.things[2], False)
+        expected = [None] * len(self.things)
+        expected[1:3] = [True, False]
+        self.assertEqual(self.directions.for_account(self.alice), expected)
+        self.assertEqual(self.directions.for_account(self.bob),
+                         [None] * len(self.things))
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Time the json api serialization of a front page and a comments page.
+
+Builds /.json-style listings of 100 links and 500 comments from stand-in
+things (so no database is needed) and times, for each, building the
+"data" dicts attribute by attribute through thing_attr against the
+compiled raw_data, and then the whole listing through to the json text
+the api sends. Run with paster:
+
+    paster run run.ini ../scripts/benchmark_jsontemplates.py -c "main()"
+
+"""
+
+import datetime
+import time
+
+import pytz
+import simplejson
+from pylons import c
+
+from r2.lib import filters
+from r2.lib.jsontemplates import (CommentJsonTemplate, LinkJsonTemplate,
+                                  ObjectTemplate)
+from r2.lib.utils import to36
+from r2.models import Comment, Link
+
+
+START = datetime.datetime(2013, 6, 1, tzinfo=pytz.UTC)
+
+
+class FakeAuthor(object):
+    _deleted = False
+    name = "someone"
+    flair_1_text = "flair"
+    flair_1_css_class = None
+
+    def flair_enabled_in_sr(self, sr_id):
+        return True
+
+
+class FakeSubreddit(object):
+    _id = 1
+    _fullname = "t5_1"
+    name = "pics"
+
+    def is_moderator(self, user):
+        return False
+
+
+class FakeThing(object):
+    def __init__(self, i, **kw):
+        self._id36 = to36(i)
+        self._fullname = "%s_%s" % (self._kind, self._id36)
+        self._date = START + datetime.timedelta(minutes=i)
+        self._spam = False
+        self.author = FakeAuthor()
+        self.subreddit = FakeSubreddit()
+        self.distinguished = "no"
+        self.editted = False
+        self.likes = None
+        self.reported = 0
+        self.downvotes = 1
+        self.upvotes = 10
+        self.__dict__.update(kw)
+
+
+class FakeLink(FakeThing):
+    _type_id = Link._type_id
+    _kind = "t3"
+
+
+class FakeComment(FakeThing):
+    _type_id = Comment._type_id
+    _kind = "t1"
+
+
+def make_links(n):
+    return [FakeLink(i, domain="example.com", hidden=False, is_self=False,
+                     flair_css_class=None, flair_text=None, media_object=None,
+                     secure_media_object=None, num_comments=i, over_18=False,
+                     permalink="/r/pics/comments/%s/" % to36(i), saved=False,
+                     score=9, selftext=u"", expunged=False, stickied=False,
+                     thumbnail="", title=u"link number %d" % i,
+                     url="http://example.com/%d" % i, visited=False)
+            for i in xrange(n)]
+
+
+def make_comments(n):
+    return [FakeComment(i, body=u"comment number %d" % i, gildings=0,
+                        link_id=1, parent_id=i - 1 if i else None,
+                        score_hidden=False)
+            for i in xrange(n)]
+
+
+def by_thing_attr(template, thing):
+    return dict((k, template.thing_attr(thing, v))
+                for k, v in template._data_attrs_.iteritems())
+
+
+def serialize(template, things, data):
+    children = [ObjectTemplate(dict(kind=template.kind(thing),
+                                    data=data(template, thing))).finalize()
+                for thing in things]
+    listing = ObjectTemplate(dict(kind="Listing",
+                                  data=dict(children=children, after=None,
+                                            before=None, modhash="")))
+    return filters.websafe_json(simplejson.dumps(listing.finalize()))
+
+
+def best_of(fn, repeat):
+    timings = []
+    for i in xrange(repeat):
+        start = time.time()
+        fn()
+        timings.append(time.time() - start)
+    return min(timings) * 1000
+
+
+def main(links=100, comments=500, repeat=10):
+    c.user_is_loggedin = False
+    c.cname = False
+    c.markdown_renders = {}
+
+    print "%-9s %6s %14s %14s" % ("listing", "things", "thing_attr ms",
+                                  "compiled ms")
+    for name, template, things, text_attr in (
+            ("links", LinkJsonTemplate(), make_links(links), "selftext"),
+            ("comments", CommentJsonTemplate(), make_comments(comments),
+             "body")):
+        # render the markdown up front; it isn't what's being measured
+        filters.prefetch_markdown([(getattr(thing, text_attr), False, None)
+                                   for thing in things])
+        old = best_of(lambda: serialize(template, things, by_thing_attr),
+                      repeat)
+        new = best_of(lambda: serialize(template, things,
+                                        type(template).raw_data), repeat)
+        print "%-9s %6d %14.2f %14.2f" % (name, len(things), old, new)
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Compare the heap-based MergeCursor with the linear scan it replaced.
+
+Merges many sorted cursors of fake links, the way multireddits and the
+front page fall back to merging per-subreddit queries. Run with paster:
+
+    paster run run.ini ../scripts/benchmark_merge.py -c "main()"
+
+"""
+
+import random
+import time
+
+from r2.lib.db import operators
+from r2.lib.db.thing import MergeCursor
+
+
+class FakeLink(object):
+    __slots__ = ('_id', '_hot', '_date')
+
+    def __init__(self, _id, hot, date):
+        self._id = _id
+        self._hot = hot
+        self._date = date
+
+
+class FakeCursor(object):
+    def __init__(self, items):
+        self.items = iter(items)
+
+    def fetchone(self):
+        return self.items.next()
+
+
+def linear_merge(cursors, sorts):
+    """The MergeCursor algorithm before it used a heap, for comparison."""
+    def safe_next(c):
+        try:
+            return [c, c.fetchone(), False]
+        except StopIteration:
+            return c, None, True
+
+    def undone(pairs):
+        return [p for p in pairs if not p[2]]
+
+    pairs = undone(safe_next(c) for c in cursors)
+
+    while pairs:
+        if len(pairs) == 1:
+            c, item, done = pair = pairs[0]
+            while not done:
+                yield item
+                c, item, done = safe_next(c)
+                pair[:] = c, item, done
+        else:
+            yield_pair = pairs[0]
+            for s in sorts:
+                col = s.col
+                max_fn = min if isinstance(s, operators.asc) else max
+
+                vals = [(getattr(i[1], col), i) for i in pairs]
+                max_pair = vals[0]
+                all_equal = True
+                for pair in vals[1:]:
+                    if all_equal and pair[0] != max_pair[0]:
+                        all_equal = False
+                    max_pair = max_fn(max_pair, pair, key=lambda x: x[0])
+
+                if not all_equal:
+                    yield_pair = max_pair[1]
+                    break
+
+            c, item, done = yield_pair
+            yield item
+            yield_pair[:] = safe_next(c)
+
+        pairs = undone(pairs)
+
+
+def make_cursors(num_cursors, per_cursor, seed=0):
+    rng = random.Random(seed)
+    listings = []
+    next_id = 0
+    for i in xrange(num_cursors):
+        links = []
+        for j in xrange(per_cursor):
+            links.append(FakeLink(next_id, round(rng.uniform(0, 10000), 7),
+                                  rng.randint(0, 10 ** 9)))
+            next_id += 1
+        links.sort(key=lambda l: (-l._hot, -l._date))
+        listings.append(links)
+    return listings
+
+
+def main(num_cursors=150, per_cursor=1000):
+    sorts = [operators.desc('_hot'), operators.desc('_date')]
+    listings = make_cursors(num_cursors, per_cursor)
+
+    print "merging %d cursors of %d items" % (num_cursors, per_cursor)
+    results = {}
+    for name, merge in (("linear", linear_merge),
+                        ("heap", MergeCursor(None, None)._execute)):
+        cursors = [FakeCursor(l) for l in listings]
+        start = time.time()
+        results[name] = [l._id for l in merge(cursors, sorts)]
+        print "%-8s %8.2fs" % (name, time.time() - start)
+
+    print "identical: %s" % (results["linear"] == results["heap"])
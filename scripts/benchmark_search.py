@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Compare search latency of the local index with CloudSearch over HTTP.
+
+Runs the same link searches the search page sends (each sort, with and
+without a subreddit restriction) against both backends. Fill the local
+index first, from the same data CloudSearch has, by running
+rebuild_link_index with search_backend = local. Then run with paster:
+
+    paster run run.ini ../scripts/benchmark_search.py -c "main()"
+
+Leave CLOUDSEARCH_SEARCH_API empty to time only the local index.
+
+"""
+
+import time
+
+import l2cs
+from pylons import g
+
+from r2.lib import cloudsearch
+from r2.lib.cloudsearch import LinkSearchQuery
+
+
+QUERIES = [
+    "cats",
+    "funny cats",
+    "title:python",
+    "self:yes programming",
+    "reddit:pics dog",
+    "site:imgur.com",
+    "ask*",
+]
+
+
+def make_bqs(queries, sr_ids=()):
+    bqs = []
+    for query in queries:
+        bq = l2cs.convert(query.decode("utf-8"), LinkSearchQuery.lucene_parser)
+        bqs.append(bq)
+        for sr_id in sr_ids:
+            bqs.append("(and %s sr_id:%s)" % (bq, sr_id))
+    return [bq.encode("utf-8") for bq in bqs]
+
+
+def time_backend(run, bqs, repeat):
+    timings = []
+    found = []
+    for bq in bqs:
+        for sort in LinkSearchQuery.sorts.itervalues():
+            for i in xrange(repeat):
+                start = time.time()
+                response = run(bq, sort)
+                timings.append(time.time() - start)
+            found.append(response["hits"]["found"])
+    return sorted(timings), found
+
+
+def percentile(timings, p):
+    return timings[min(len(timings) - 1, int(len(timings) * p))]
+
+
+def main(repeat=5, sr_ids=()):
+    bqs = make_bqs(QUERIES, sr_ids)
+    options = dict(query=None, faceting=cloudsearch.DEFAULT_FACETS, size=25,
+                   start=0, return_fields=None, record_stats=False)
+
+    backends = [("local", lambda bq, rank: cloudsearch._local_query(
+        "links", bq=bq, rank=rank, **options))]
+    if g.CLOUDSEARCH_SEARCH_API:
+        backends.append(("http", lambda bq, rank: cloudsearch._cloudsearch_query(
+            g.CLOUDSEARCH_SEARCH_API, bq=bq, rank=rank, **options)))
+
+    print "%d queries x %d sorts x %d runs" % (len(bqs),
+                                              len(LinkSearchQuery.sorts),
+                                              repeat)
+    print "%-8s %10s %10s %10s" % ("backend", "p50 ms", "p95 ms", "max ms")
+    results = {}
+    for name, run in backends:
+        timings, results[name] = time_backend(run, bqs, repeat)
+        print "%-8s %10.2f %10.2f %10.2f" % (name,
+                                             percentile(timings, .5) * 1000,
+                                             percentile(timings, .95) * 1000,
+                                             timings[-1] * 1000)
+
+    if len(results) > 1:
+        print "same hit counts: %s" % (results["local"] == results["http"])
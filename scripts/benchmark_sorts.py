@@ -0,0 +1,83 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Compare the scalar and batch sort functions in r2.lib.db.sorts.
+
+Run with paster:
+
+    paster run run.ini ../scripts/benchmark_sorts.py -c "main()"
+
+"""
+
+import time
+
+import numpy
+
+from r2.lib.db import sorts
+
+
+def synthetic_votes(count, seed=0):
+    """Mostly small vote counts with a long tail, like real things."""
+    rng = numpy.random.RandomState(seed)
+    ups = rng.pareto(1.2, count).astype(numpy.int_)
+    downs = (ups * rng.uniform(0, 0.6, count)).astype(numpy.int_)
+    dates = rng.uniform(1.1e9, 1.4e9, count)
+    return ups, downs, dates
+
+
+def _timed(fn):
+    start = time.time()
+    result = fn()
+    return result, time.time() - start
+
+
+def main(count=10 * 1000 * 1000):
+    ups, downs, dates = synthetic_votes(count)
+    py_ups, py_downs, py_dates = ups.tolist(), downs.tolist(), dates.tolist()
+    votes = zip(py_ups, py_downs, py_dates)
+
+    benchmarks = [
+        ("hot",
+         lambda: [sorts._hot(u, d, t) for u, d, t in votes],
+         lambda: sorts.hot_batch(ups, downs, dates)),
+        ("score",
+         lambda: [sorts.score(u, d) for u, d, t in votes],
+         lambda: sorts.score_batch(ups, downs)),
+        ("controversy",
+         lambda: [sorts.controversy(u, d) for u, d, t in votes],
+         lambda: sorts.controversy_batch(ups, downs)),
+        ("confidence",
+         lambda: [sorts.confidence(u, d) for u, d, t in votes],
+         lambda: sorts.confidence_batch(ups, downs)),
+    ]
+
+    print "%d votes" % count
+    print "%-12s %10s %10s %8s  %s" % ("sort", "scalar", "batch", "speedup",
+                                       "identical")
+    for name, scalar_fn, batch_fn in benchmarks:
+        scalar, scalar_time = _timed(scalar_fn)
+        batch, batch_time = _timed(batch_fn)
+        identical = numpy.array_equal(numpy.array(scalar, dtype=batch.dtype),
+                                      batch)
+        print "%-12s %9.2fs %9.2fs %7.1fx  %s" % (
+            name, scalar_time, batch_time, scalar_time / batch_time,
+            identical)
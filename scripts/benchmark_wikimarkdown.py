@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Time wiki markdown post-processing on large pages.
+
+Compares the single pass wiki_postprocess that wikimarkdown uses with the
+old way of doing the same thing: parsing snudown's output with
+BeautifulSoup, swapping the images, adding the table of contents and
+serializing the soup again. Also checks that both give the same page. Run
+with paster:
+
+    paster run run.ini ../scripts/benchmark_wikimarkdown.py -c "main()"
+
+"""
+
+import time
+
+import snudown
+from BeautifulSoup import BeautifulSoup
+
+from r2.lib import filters
+
+
+def make_page(sections=200):
+    parts = []
+    for i in xrange(sections):
+        parts.append("# Section %d & friends\n\n" % i)
+        parts.append("Some *text* with [a link](http://example.com/%d) "
+                     "and ![an image](%%%%img%d%%%%).\n\n" % (i, i % 10))
+        parts.append("## Details of %d\n\n" % i)
+        parts.append("* one\n* two\n* three\n\n")
+        parts.append("|a|b|\n|-|-|\n|1|2|\n\n")
+    return "".join(parts)
+
+
+def img_swap(src):
+    name = src and filters.custom_img_url.search(src)
+    if name and name.group(1) in ("img0", "img1", "img2"):
+        return "http://example.com/%s.png" % name.group(1)
+
+
+def soup_postprocess(html, img_swap, include_toc=True, prefix="wiki"):
+    soup = BeautifulSoup(html)
+    for img in soup.findAll("img"):
+        url = img_swap(img["src"])
+        if url:
+            img["src"] = url
+        else:
+            img.extract()
+    if include_toc:
+        tocdiv = filters.generate_table_of_contents(soup, prefix=prefix)
+        if tocdiv:
+            soup.insert(0, tocdiv)
+    return unicode(soup)
+
+
+def time_postprocess(fn, html, repeat):
+    timings = []
+    for i in xrange(repeat):
+        start = time.time()
+        result = fn(html, img_swap)
+        timings.append(time.time() - start)
+    return sorted(timings), result
+
+
+def main(sections=200, repeat=10):
+    text = make_page(sections)
+    html = snudown.markdown(text, True, None,
+                            renderer=snudown.RENDERER_WIKI).decode("utf-8")
+
+    print "%d byte page, %d runs" % (len(html), repeat)
+    print "%-8s %10s %10s" % ("method", "p50 ms", "max ms")
+    results = {}
+    for name, fn in (("soup", soup_postprocess),
+                     ("single", filters.wiki_postprocess)):
+        timings, results[name] = time_postprocess(fn, html, repeat)
+        print "%-8s %10.2f %10.2f" % (name, timings[len(timings) / 2] * 1000,
+                                      timings[-1] * 1000)
+
+    # the soup reserializes the page, so compare after a round trip through it
+    same = (unicode(BeautifulSoup(results["single"])) ==
+            unicode(BeautifulSoup(results["soup"])))
+    print "same output: %s" % same